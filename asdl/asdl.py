@@ -1,28 +1,66 @@
 # coding=utf-8
 from collections import OrderedDict, Counter
+import functools
+import hashlib
 from itertools import chain
+import weakref
+
+import numpy as np
 
 from .utils import remove_comment
 
 
+# kinds of types, and cardinalities of fields, in the integer arrays of a compiled `ASDLGrammar`
+PRIMITIVE_TYPE, COMPOSITE_TYPE = 0, 1
+CARDINALITIES = ['single', 'optional', 'multiple']
+
+
 class ASDLGrammar(object):
     """
     Collection of types, constructors and productions
+
+    The ids of productions, types and fields are frozen at construction, and set as the `id` of the
+    interned schema objects. The grammar is compiled into integer arrays indexed by these ids:
+        type_kind: PRIMITIVE_TYPE or COMPOSITE_TYPE of each type
+        type_prod_ptr, type_prod_ids: productions of type i are type_prod_ids[type_prod_ptr[i]:type_prod_ptr[i + 1]]
+        prod_type_ids: head type of each production
+        prod_field_ptr, prod_field_ids: fields of production i are prod_field_ids[prod_field_ptr[i]:prod_field_ptr[i + 1]]
+        field_type_ids: type of each field
+        field_cardinality: index in CARDINALITIES of the cardinality of each field
     """
     def __init__(self, productions):
+        # the grammar is built from the equivalents of the productions in its own namespace, named
+        # by a digest of their structure, see `SchemaObject`
+        digest = hashlib.md5('\n'.join(sorted(repr(prod._key) for prod in productions)).encode('utf-8'))
+        self.namespace = SchemaNamespace.get(digest.hexdigest())
+
+        self._build([prod.in_namespace(self.namespace) for prod in productions])
+        self._set_ids()
+
+    def _build(self, productions):
         # productions are indexed by their head types
         self._productions = OrderedDict()
         self._constructor_production_map = dict()
+        self._type_name_map = dict()
         for prod in productions:
             if prod.type not in self._productions:
                 self._productions[prod.type] = list()
             self._productions[prod.type].append(prod)
             self._constructor_production_map[prod.constructor.name] = prod
+            self._type_name_map[prod.type.name] = prod.type
 
         self.root_type = productions[0].type
         # number of constructors
         self.size = sum(len(head) for head in self._productions.values())
 
+        self._compile()
+
+    def _compile(self):
+        # productions are sorted once, their ids follow this order
+        for cached in ('_types', '_fields'):
+            self.__dict__.pop(cached, None)
+        self._sorted_productions = sorted(chain.from_iterable(self._productions.values()), key=lambda x: repr(x))
+
         # get entities to their ids map
         self.prod2id = {prod: i for i, prod in enumerate(self.productions)}
         self.type2id = {type: i for i, type in enumerate(self.types)}
@@ -32,18 +70,60 @@ class ASDLGrammar(object):
         self.id2type = {i: type for i, type in enumerate(self.types)}
         self.id2field = {i: field for i, field in enumerate(self.fields)}
 
+        self.type_kind = np.array([COMPOSITE_TYPE if isinstance(t, ASDLCompositeType) else PRIMITIVE_TYPE
+                                   for t in self.types], dtype=np.int8)
+        type_prods = [[self.prod2id[prod] for prod in self._productions.get(t, [])] for t in self.types]
+        self.type_prod_ptr = np.cumsum([0] + [len(prod_ids) for prod_ids in type_prods], dtype=np.int64)
+        self.type_prod_ids = np.array(list(chain.from_iterable(type_prods)), dtype=np.int64)
+
+        self.prod_type_ids = np.array([self.type2id[prod.type] for prod in self.productions], dtype=np.int64)
+        prod_fields = [[self.field2id[field] for field in prod.fields] for prod in self.productions]
+        self.prod_field_ptr = np.cumsum([0] + [len(field_ids) for field_ids in prod_fields], dtype=np.int64)
+        self.prod_field_ids = np.array(list(chain.from_iterable(prod_fields)), dtype=np.int64)
+
+        self.field_type_ids = np.array([self.type2id[field.type] for field in self.fields], dtype=np.int64)
+        self.field_cardinality = np.array([CARDINALITIES.index(field.cardinality) for field in self.fields],
+                                          dtype=np.int8)
+
+        # plain lists of the arrays read in per-node type checks, faster than indexing numpy arrays by scalars
+        self._type_is_composite = (self.type_kind == COMPOSITE_TYPE).tolist()
+        self._primitive_types = [t for t in self.types if isinstance(t, ASDLPrimitiveType)]
+        self._composite_types = [t for t in self.types if isinstance(t, ASDLCompositeType)]
+
+    def _set_ids(self):
+        # ids are also attributes of the interned schema objects, read in place of the maps
+        for objects in (self.productions, self.types, self.fields):
+            for i, obj in enumerate(objects):
+                obj.id = i
+
+    def __setstate__(self, state):
+        # the grammar is rebuilt in its namespace, which also compiles grammars pickled before they
+        # were compiled and interns schema objects pickled before interning, e.g. in saved models
+        self.__init__(list(chain.from_iterable(state['_productions'].values())))
+
+    def resolve(self, obj):
+        """
+        the object of the grammar equivalent to the schema object `obj`, e.g. of data pickled before
+        interning, which is unpickled without a grammar, see `SchemaObject`
+        """
+        if obj.namespace is self.namespace:
+            return obj
+
+        return self.namespace.objects[obj._key]
+
     def __len__(self):
         return self.size
 
     @property
     def productions(self):
-        return sorted(chain.from_iterable(self._productions.values()), key=lambda x: repr(x))
+        return self._sorted_productions
 
     def __getitem__(self, datum):
+        # types are looked up by name, e.g. types of other grammars
         if isinstance(datum, str):
-            return self._productions[ASDLType(datum)]
+            return self._productions[self._type_name_map[datum]]
         elif isinstance(datum, ASDLType):
-            return self._productions[datum]
+            return self._productions[self._type_name_map[datum.name]]
 
     def get_prod_by_ctr_name(self, name):
         return self._constructor_production_map[name]
@@ -73,17 +153,62 @@ class ASDLGrammar(object):
 
     @property
     def primitive_types(self):
-        return filter(lambda x: isinstance(x, ASDLPrimitiveType), self.types)
+        return self._primitive_types
 
     @property
     def composite_types(self):
-        return filter(lambda x: isinstance(x, ASDLCompositeType), self.types)
+        return self._composite_types
 
     def is_composite_type(self, asdl_type):
-        return asdl_type in self.composite_types
+        type_id = self.type2id.get(asdl_type)
+
+        return type_id is not None and self._type_is_composite[type_id]
 
     def is_primitive_type(self, asdl_type):
-        return asdl_type in self.primitive_types
+        type_id = self.type2id.get(asdl_type)
+
+        return type_id is not None and not self._type_is_composite[type_id]
+
+    def get_type_productions(self, type_id):
+        """ids of the productions of the type of `type_id`"""
+        return self.type_prod_ids[self.type_prod_ptr[type_id]: self.type_prod_ptr[type_id + 1]]
+
+    def get_production_fields(self, prod_id):
+        """ids of the fields of the production of `prod_id`, in order"""
+        return self.prod_field_ids[self.prod_field_ptr[prod_id]: self.prod_field_ptr[prod_id + 1]]
+
+    def to_compiled(self):
+        """The compiled grammar as a dict of names and integer arrays, which can be pickled and
+        turned back into the grammar by `from_compiled` without parsing the ASDL text"""
+        return dict(type_names=[t.name for t in self.types],
+                    type_kind=self.type_kind,
+                    field_names=[field.name for field in self.fields],
+                    field_type_ids=self.field_type_ids,
+                    field_cardinality=self.field_cardinality,
+                    constructor_names=[prod.constructor.name for prod in self.productions],
+                    prod_type_ids=self.prod_type_ids,
+                    prod_field_ptr=self.prod_field_ptr,
+                    prod_field_ids=self.prod_field_ids,
+                    # ids of the productions in the order of the ASDL text, which defines the root type
+                    prod_order=np.array([self.prod2id[prod] for prod in chain.from_iterable(self._productions.values())],
+                                        dtype=np.int64))
+
+    @staticmethod
+    def from_compiled(compiled):
+        types = [ASDLCompositeType(name) if kind == COMPOSITE_TYPE else ASDLPrimitiveType(name)
+                 for name, kind in zip(compiled['type_names'], compiled['type_kind'])]
+        fields = [Field(name, types[type_id], CARDINALITIES[cardinality])
+                  for name, type_id, cardinality in zip(compiled['field_names'], compiled['field_type_ids'],
+                                                        compiled['field_cardinality'])]
+
+        field_ptr, field_ids = compiled['prod_field_ptr'], compiled['prod_field_ids']
+        productions = []
+        for prod_id in compiled['prod_order']:
+            prod_fields = [fields[field_id] for field_id in field_ids[field_ptr[prod_id]: field_ptr[prod_id + 1]]]
+            constructor = ASDLConstructor(compiled['constructor_names'][prod_id], prod_fields)
+            productions.append(ASDLProduction(types[compiled['prod_type_ids'][prod_id]], constructor))
+
+        return ASDLGrammar(productions)
 
     @staticmethod
     def from_text(text):
@@ -159,41 +284,169 @@ class ASDLGrammar(object):
         return grammar
 
 
-class ASDLProduction(object):
-    def __init__(self, type, constructor):
-        self.type = type
-        self.constructor = constructor
+class SchemaNamespace(object):
+    """
+    Intern table of the schema objects of a grammar, see `SchemaObject`
 
-    @property
-    def fields(self):
-        return self.constructor.fields
+    A namespace is named by a digest of the structure of its grammar, so that schema objects are
+    unpickled into the namespace of their grammar, whether the grammar is loaded before or after
+    them. Namespaces are freed with the last grammar and schema object using them.
+    """
+    # live namespaces by their names
+    _namespaces = weakref.WeakValueDictionary()
 
-    def __getitem__(self, field_name):
-        return self.constructor[field_name]
+    def __init__(self, name):
+        self.name = name
+        self.objects = dict()
+        # the flyweight `ApplyRuleAction`s of the productions, freed along with the namespace
+        self.apply_rule_actions = dict()
 
-    def __hash__(self):
-        h = hash(self.type) ^ hash(self.constructor)
+    @staticmethod
+    def get(name):
+        namespace = SchemaNamespace._namespaces.get(name)
+        if namespace is None:
+            namespace = SchemaNamespace._namespaces[name] = SchemaNamespace(name)
+
+        return namespace
+
+    def __reduce__(self):
+        return SchemaNamespace.get, (self.name,)
+
+    def __repr__(self):
+        return 'SchemaNamespace(%s)' % self.name
+
+
+class SchemaObject(object):
+    """
+    Base of the types, fields, constructors and productions of ASDL grammars
+
+    Schema objects of a grammar are interned flyweights: constructing an object with the same arguments
+    in the same `namespace` returns the existing object, so they are compared by identity and hashed by
+    a hash computed once. Each grammar has its own namespace, and `id` is the id of the object in it.
+    Objects of different grammars are different, even if they have the same structure.
 
-        return h
+    Objects constructed without a namespace, e.g. when parsing the text of a grammar or by callers
+    building a type by name, are plain objects without id. They compare equal to the objects of the
+    same structure of any grammar, e.g. `ASDLCompositeType('expr') in grammar.type2id` for every grammar
+    with an `expr` type, and their ids are looked up in the maps of a grammar.
+
+    Objects unpickled from files saved before namespaces are such objects without a namespace. The
+    trees and action infos of data loaded with a grammar are resolved to its objects, see
+    `ASDLGrammar.resolve` and `Dataset.from_bin_file`.
+    """
+    __slots__ = ('id', 'namespace', '_key', '_hash')
+    # names of the constructor arguments, which are also the attributes of the object
+    _arg_names = ()
+
+    def __new__(cls, *args, **kwargs):
+        # no arguments when unpickling objects saved before interning, see `__setstate__`
+        if not args and not kwargs:
+            return object.__new__(cls)
+
+        namespace = kwargs.pop('namespace', None)
+        args = cls._normalize_args(*args, **kwargs)
+        if namespace is not None:
+            # attributes are objects of the same namespace
+            args = tuple(arg.in_namespace(namespace) if isinstance(arg, SchemaObject)
+                         else [item.in_namespace(namespace) for item in arg] if isinstance(arg, list)
+                         else arg
+                         for arg in args)
+
+        key = cls._intern_key(args)
+        obj = namespace.objects.get(key) if namespace is not None else None
+        if obj is None:
+            obj = object.__new__(cls)
+            for name, value in zip(cls._arg_names, args):
+                setattr(obj, name, value)
+            obj.id = None
+            obj.namespace = namespace
+            obj._key = key
+            obj._hash = hash(key)
+            if namespace is not None:
+                namespace.objects[key] = obj
+
+        return obj
+
+    @classmethod
+    def _normalize_args(cls, *args):
+        return args
+
+    @classmethod
+    def _intern_key(cls, args):
+        """the structure of the object, regardless of namespaces, which is the same in all processes"""
+        return (cls.__name__,) + tuple(arg._key if isinstance(arg, SchemaObject)
+                              else tuple(item._key for item in arg) if isinstance(arg, list)
+                              else arg
+                              for arg in args)
+
+    def in_namespace(self, namespace):
+        """the equivalent object interned in `namespace`"""
+        if self.namespace is namespace:
+            return self
+
+        return self.__class__(*[getattr(self, name) for name in self._arg_names], namespace=namespace)
+
+    def __hash__(self):
+        return self._hash
 
     def __eq__(self, other):
-        return isinstance(other, ASDLProduction) and \
-               self.type == other.type and \
-               self.constructor == other.constructor
+        if self is other:
+            return True
+        if not isinstance(other, SchemaObject):
+            # e.g. realized fields, which compare as their fields
+            return NotImplemented
+
+        # interned objects are the same object, objects of different grammars are different
+        if self.namespace is not None and other.namespace is not None:
+            return False
+
+        return self._key == other._key
 
     def __ne__(self, other):
-        return not self.__eq__(other)
+        eq = self.__eq__(other)
+
+        return eq if eq is NotImplemented else not eq
+
+    def __reduce__(self):
+        args = tuple(getattr(self, name) for name in self._arg_names)
+        if self.namespace is None:
+            return self.__class__, args
+
+        return functools.partial(self.__class__, namespace=self.namespace), args
+
+    def __setstate__(self, state):
+        # `__dict__` of an object pickled before interning, which is unpickled without a namespace
+        for name, value in state.items():
+            setattr(self, name, value)
+
+        self.id = None
+        self.namespace = None
+        self._key = self._intern_key(tuple(getattr(self, name) for name in self._arg_names))
+        self._hash = hash(self._key)
+
+
+class ASDLProduction(SchemaObject):
+    __slots__ = ('type', 'constructor')
+    _arg_names = ('type', 'constructor')
+
+    @property
+    def fields(self):
+        return self.constructor.fields
+
+    def __getitem__(self, field_name):
+        return self.constructor[field_name]
 
     def __repr__(self):
         return '%s -> %s' % (self.type.__repr__(plain=True), self.constructor.__repr__(plain=True))
 
 
-class ASDLConstructor(object):
-    def __init__(self, name, fields=None):
-        self.name = name
-        self.fields = []
-        if fields:
-            self.fields = list(fields)
+class ASDLConstructor(SchemaObject):
+    __slots__ = ('name', 'fields')
+    _arg_names = ('name', 'fields')
+
+    @classmethod
+    def _normalize_args(cls, name, fields=None):
+        return name, list(fields) if fields else []
 
     def __getitem__(self, field_name):
         for field in self.fields:
@@ -201,21 +454,6 @@ class ASDLConstructor(object):
 
         raise KeyError
 
-    def __hash__(self):
-        h = hash(self.name)
-        for field in self.fields:
-            h ^= hash(field)
-
-        return h
-
-    def __eq__(self, other):
-        return isinstance(other, ASDLConstructor) and \
-               self.name == other.name and \
-               self.fields == other.fields
-
-    def __ne__(self, other):
-        return not self.__eq__(other)
-
     def __repr__(self, plain=False):
         plain_repr = '%s(%s)' % (self.name,
                                  ', '.join(f.__repr__(plain=True) for f in self.fields))
@@ -223,28 +461,14 @@ class ASDLConstructor(object):
         else: return 'Constructor(%s)' % plain_repr
 
 
-class Field(object):
-    def __init__(self, name, type, cardinality):
-        self.name = name
-        self.type = type
+class Field(SchemaObject):
+    __slots__ = ('name', 'type', 'cardinality')
+    _arg_names = ('name', 'type', 'cardinality')
 
+    @classmethod
+    def _normalize_args(cls, name, type, cardinality):
         assert cardinality in ['single', 'optional', 'multiple']
-        self.cardinality = cardinality
-
-    def __hash__(self):
-        h = hash(self.name) ^ hash(self.type)
-        h ^= hash(self.cardinality)
-
-        return h
-
-    def __eq__(self, other):
-        return isinstance(other, Field) and \
-               self.name == other.name and \
-               self.type == other.type and \
-               self.cardinality == other.cardinality
-
-    def __ne__(self, other):
-        return not self.__eq__(other)
+        return name, type, cardinality
 
     def __repr__(self, plain=False):
         plain_repr = '%s%s %s' % (self.type.__repr__(plain=True),
@@ -258,18 +482,9 @@ class Field(object):
         return '' if cardinality == 'single' else '?' if cardinality == 'optional' else '*'
 
 
-class ASDLType(object):
-    def __init__(self, type_name):
-        self.name = type_name
-
-    def __hash__(self):
-        return hash(self.name)
-
-    def __eq__(self, other):
-        return isinstance(other, ASDLType) and self.name == other.name
-
-    def __ne__(self, other):
-        return not self.__eq__(other)
+class ASDLType(SchemaObject):
+    __slots__ = ('name',)
+    _arg_names = ('name',)
 
     def __repr__(self, plain=False):
         plain_repr = self.name
@@ -278,11 +493,11 @@ class ASDLType(object):
 
 
 class ASDLCompositeType(ASDLType):
-    pass
+    __slots__ = ()
 
 
 class ASDLPrimitiveType(ASDLType):
-    pass
+    __slots__ = ()
 
 
 if __name__ == '__main__':
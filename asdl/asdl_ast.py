@@ -6,9 +6,12 @@ except:
     from io import StringIO
 
 from .asdl import *
+from .utils import SlottedObject
 
 
-class AbstractSyntaxTree(object):
+class AbstractSyntaxTree(SlottedObject):
+    __slots__ = ('production', 'fields', 'parent_field', 'created_time')
+
     def __init__(self, production, realized_fields=None):
         self.production = production
 
@@ -98,6 +101,17 @@ class AbstractSyntaxTree(object):
         if is_root:
             return sb.getvalue()
 
+    def resolve_schema(self, grammar):
+        """replace the productions and fields of the tree by those of `grammar`, see `ASDLGrammar.resolve`"""
+        nodes = [self]
+        while nodes:
+            node = nodes.pop()
+            node.production = grammar.resolve(node.production)
+            for field in node.fields:
+                field.field = grammar.resolve(field.field)
+                if isinstance(field.type, ASDLCompositeType):
+                    nodes.extend(field.as_value_list)
+
     def __hash__(self):
         code = hash(self.production)
         for field in self.fields:
@@ -141,19 +155,18 @@ class AbstractSyntaxTree(object):
         return node_num
 
 
-class RealizedField(Field):
-    """wrapper of field realized with values"""
-    def __init__(self, field, value=None, parent=None):
-        super(RealizedField, self).__init__(field.name, field.type, field.cardinality)
+class RealizedField(SlottedObject):
+    """wrapper of field realized with values, the name, type and cardinality are those of `field`"""
+    __slots__ = ('field', 'value', 'parent_node', '_not_single_cardinality_finished')
 
+    def __init__(self, field, value=None, parent=None):
         # record its parent AST node
         self.parent_node = None
 
-        # FIXME: hack, return the field as a property
         self.field = field
 
         # initialize value to correct type
-        if self.cardinality == 'multiple':
+        if field.cardinality == 'multiple':
             self.value = []
             if value is not None:
                 for child_node in value:
@@ -167,6 +180,27 @@ class RealizedField(Field):
         # when card in [optional, multiple]
         self._not_single_cardinality_finished = False
 
+    @property
+    def name(self):
+        return self.field.name
+
+    @property
+    def type(self):
+        return self.field.type
+
+    @property
+    def cardinality(self):
+        return self.field.cardinality
+
+    @property
+    def id(self):
+        return self.field.id
+
+    def __setstate__(self, state):
+        # realized fields pickled before they had slots also store the name, type and cardinality
+        super(RealizedField, self).__setstate__({name: value for name, value in state.items()
+                                                 if name not in ('name', 'type', 'cardinality')})
+
     def add_value(self, value):
         if isinstance(value, AbstractSyntaxTree):
             value.parent_field = self
@@ -198,9 +232,18 @@ class RealizedField(Field):
         # assert self.cardinality in ('optional', 'multiple')
         self._not_single_cardinality_finished = True
 
+    def __hash__(self):
+        # as the field, as when realized fields were fields
+        return hash(self.field)
+
     def __eq__(self, other):
-        if super(RealizedField, self).__eq__(other):
-            if type(other) == Field: return True  # FIXME: hack, Field and RealizedField can compare!
-            if self.value == other.value: return True
-            else: return False
-        else: return False
+        if isinstance(other, RealizedField):
+            return self.field == other.field and self.value == other.value
+        # FIXME: hack, Field and RealizedField can compare!
+        return isinstance(other, Field) and self.field == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self, plain=False):
+        return self.field.__repr__(plain)
@@ -0,0 +1,261 @@
+# coding=utf-8
+import numpy as np
+
+from .asdl import *
+from .asdl_ast import AbstractSyntaxTree, RealizedField
+from .transition_system import ApplyRuleAction, GenTokenAction, ReduceAction
+
+
+class FlatAST(object):
+    """
+    Flat encoding of an `AbstractSyntaxTree` in integer arrays
+
+        prod_ids: (node_num,) production ids of the nodes in preorder, the root is node 0
+        value_ptr: (field_num + 1,) the values of the i-th realized field, counting the fields of the
+            nodes in preorder, are values[value_ptr[i]: value_ptr[i + 1]] (CSR format)
+        values: the preorder index of the child node, for composite fields, or the index of the
+            primitive value in `tokens`, for primitive fields
+        tokens: tuple of the primitive values, in order of first appearance
+
+    The encoding of a tree is unique, so trees are hashed and compared by the bytes of the arrays.
+    `from_actions` encodes the tree rebuilt by the actions, which may differ from the tree that
+    generated them, so its results should only be compared with those of `from_ast` on rebuilt
+    trees (see `from_actions`). It keeps the structure of trees only, not the `created_time` of nodes or the finished marks of
+    fields used in decoding. The arrays may be views, e.g. of memory-mapped arrays of many trees.
+    """
+    __slots__ = ('prod_ids', 'value_ptr', 'values', 'tokens', '_hash')
+
+    def __init__(self, prod_ids, value_ptr, values, tokens):
+        self.prod_ids = np.asarray(prod_ids, dtype=np.int32)
+        self.value_ptr = np.asarray(value_ptr, dtype=np.int32)
+        self.values = np.asarray(values, dtype=np.int32)
+        self.tokens = tuple(tokens)
+        self._hash = None
+
+    @staticmethod
+    def from_ast(asdl_ast):
+        prod_ids = []
+        value_ptr = [0]
+        values = []
+        tokens = []
+        token_ids = dict()
+
+        # (node, position in `values` of the reference to the node)
+        stack = [(asdl_ast, None)]
+        while stack:
+            node, value_pos = stack.pop()
+            if value_pos is not None:
+                values[value_pos] = len(prod_ids)
+            prod_ids.append(node.production.id)
+
+            children = []
+            for field in node.fields:
+                if isinstance(field.type, ASDLCompositeType):
+                    for child in field.as_value_list:
+                        children.append((child, len(values)))
+                        values.append(-1)
+                else:
+                    for value in field.as_value_list:
+                        values.append(FlatAST._token_id(value, tokens, token_ids))
+                value_ptr.append(len(values))
+
+            stack.extend(reversed(children))
+
+        return FlatAST(prod_ids, value_ptr, values, tokens)
+
+    @staticmethod
+    def from_actions(actions, grammar):
+        """encode the tree built by `actions`, as built by `Hypothesis.apply_action`
+
+        This is the tree rebuilt by the actions, not necessarily the tree they were generated from.
+        A singleton field whose value is Python `None` has no value in `from_ast`, but its action is
+        `GenToken[None]`, which rebuilds the field with the string token 'None'. Hence the result
+        equals `from_ast` of the rebuilt tree, and differs from `from_ast` of the original tree
+        in that case.
+        """
+        prod_ids = []
+        # realized fields, counting the fields of the nodes in preorder, and their values,
+        # i.e. child node indices or primitive values
+        fields = []
+        field_values = []
+        # indices of the realized fields to fill, the frontier field is on the top
+        stack = []
+        value_buffer = []
+
+        for t, action in enumerate(actions):
+            if t > 0 and not stack:
+                raise ValueError('Invalid action [%s] after the tree is complete' % action)
+            field = fields[stack[-1]] if stack else None
+
+            if isinstance(action, ApplyRuleAction):
+                if field is not None:
+                    if not isinstance(field.type, ASDLCompositeType):
+                        raise ValueError('Invalid action [%s] on field [%s]' % (action, field))
+                    field_values[stack[-1]].append(len(prod_ids))
+                    # a single or optional field is finished once filled
+                    if field.cardinality in ('single', 'optional'):
+                        stack.pop()
+
+                prod_ids.append(action.production.id)
+                first_field = len(fields)
+                fields.extend(action.production.fields)
+                field_values.extend([] for _ in action.production.fields)
+                # the first field of the node is on the top
+                stack.extend(range(len(fields) - 1, first_field - 1, -1))
+            elif isinstance(action, ReduceAction):
+                if field is None or field.cardinality not in ('optional', 'multiple'):
+                    raise ValueError('Reduce action can only be applied on field with multiple cardinality')
+                stack.pop()
+            elif isinstance(action, GenTokenAction):
+                if field is None or isinstance(field.type, ASDLCompositeType):
+                    raise ValueError('Invalid action [%s] on field [%s]' % (action, field))
+
+                # only field of type string requires termination signal </primitive>
+                end_primitive = False
+                if field.type.name == 'string':
+                    if action.is_stop_signal():
+                        field_values[stack[-1]].append(' '.join(value_buffer))
+                        value_buffer = []
+                        end_primitive = True
+                    else:
+                        value_buffer.append(action.token)
+                else:
+                    field_values[stack[-1]].append(action.token)
+                    end_primitive = True
+
+                if end_primitive and field.cardinality in ('single', 'optional'):
+                    stack.pop()
+            else:
+                raise ValueError('Invalid action [%s]' % action)
+
+        value_ptr = [0]
+        values = []
+        tokens = []
+        token_ids = dict()
+        for field, field_value in zip(fields, field_values):
+            if isinstance(field.type, ASDLCompositeType):
+                values.extend(field_value)
+            else:
+                for value in field_value:
+                    values.append(FlatAST._token_id(value, tokens, token_ids))
+            value_ptr.append(len(values))
+
+        return FlatAST(prod_ids, value_ptr, values, tokens)
+
+    @staticmethod
+    def _token_id(value, tokens, token_ids):
+        # e.g. 1 and True are different tokens
+        key = (value.__class__, value)
+        token_id = token_ids.get(key)
+        if token_id is None:
+            token_id = token_ids[key] = len(tokens)
+            tokens.append(value)
+
+        return token_id
+
+    def to_ast(self, grammar):
+        nodes = [AbstractSyntaxTree(grammar.id2prod[prod_id]) for prod_id in self.prod_ids.tolist()]
+        value_ptr = self.value_ptr.tolist()
+        values = self.values.tolist()
+
+        i = 0
+        for node in nodes:
+            for field in node.fields:
+                if isinstance(field.type, ASDLCompositeType):
+                    for value in values[value_ptr[i]: value_ptr[i + 1]]:
+                        field.add_value(nodes[value])
+                else:
+                    for value in values[value_ptr[i]: value_ptr[i + 1]]:
+                        field.add_value(self.tokens[value])
+                i += 1
+
+        return nodes[0]
+
+    def to_actions(self, transition_system):
+        """the actions of `TransitionSystem.get_actions` of the tree"""
+        grammar = transition_system.grammar
+        productions = [grammar.id2prod[prod_id] for prod_id in self.prod_ids.tolist()]
+        # the realized fields in preorder, those of node i are fields field_ptr[i] to field_ptr[i + 1] - 1
+        fields = []
+        field_ptr = [0]
+        for production in productions:
+            fields.extend(production.fields)
+            field_ptr.append(len(fields))
+        value_ptr = self.value_ptr.tolist()
+        values = self.values.tolist()
+
+        actions = [ApplyRuleAction(productions[0])]
+        # [current field, end of the fields of the node, index of the next child in the current field]
+        stack = [[0, field_ptr[1], 0]]
+        while stack:
+            frame = stack[-1]
+            i, end, child_idx = frame
+            if i == end:
+                stack.pop()
+                continue
+
+            field = fields[i]
+            field_values = values[value_ptr[i]: value_ptr[i + 1]]
+            if isinstance(field.type, ASDLCompositeType):
+                if child_idx < len(field_values):
+                    frame[2] += 1
+                    child = field_values[child_idx]
+                    actions.append(ApplyRuleAction(productions[child]))
+                    stack.append([field_ptr[child], field_ptr[child + 1], 0])
+                    continue
+
+                # if an optional field is filled, then do not need Reduce action
+                if field.cardinality == 'multiple' or field.cardinality == 'optional' and not field_values:
+                    actions.append(ReduceAction())
+            else:
+                if field.cardinality == 'multiple':
+                    value = [self.tokens[value] for value in field_values]
+                else:
+                    value = self.tokens[field_values[0]] if field_values else None
+                field_actions = transition_system.get_primitive_field_actions(RealizedField(field, value))
+
+                # if an optional field is filled, then do not need Reduce action
+                if field.cardinality == 'multiple' or field.cardinality == 'optional' and not field_actions:
+                    field_actions.append(ReduceAction())
+                actions.extend(field_actions)
+
+            frame[0] += 1
+            frame[2] = 0
+
+        return actions
+
+    @property
+    def size(self):
+        """number of nodes and primitive values, as `AbstractSyntaxTree.size`"""
+        return len(self.values) + 1
+
+    @property
+    def nbytes(self):
+        return self.prod_ids.nbytes + self.value_ptr.nbytes + self.values.nbytes
+
+    def __len__(self):
+        return len(self.prod_ids)
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash((self.prod_ids.tobytes(), self.value_ptr.tobytes(), self.values.tobytes(), self.tokens))
+
+        return self._hash
+
+    def __eq__(self, other):
+        return self is other or isinstance(other, FlatAST) and \
+            hash(self) == hash(other) and \
+            self.tokens == other.tokens and \
+            np.array_equal(self.prod_ids, other.prod_ids) and \
+            np.array_equal(self.value_ptr, other.value_ptr) and \
+            np.array_equal(self.values, other.values)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __reduce__(self):
+        # the hash of the tokens differs between processes
+        return FlatAST, (self.prod_ids, self.value_ptr, self.values, self.tokens)
+
+    def __repr__(self):
+        return 'FlatAST(%d nodes, %d values, %d tokens)' % (len(self.prod_ids), len(self.values), len(self.tokens))
@@ -5,8 +5,69 @@ from .asdl_ast import AbstractSyntaxTree
 from .transition_system import *
 
 
+def frontier_field_finished(frontier_field, action):
+    """
+    Whether applying `action` on `frontier_field` finishes the field, after checking that the action
+    is valid on it. `frontier_field` is None at the beginning of decoding, which only starts by an
+    ApplyRule action. These are the frontier transition rules shared by all hypotheses.
+    """
+    if frontier_field is None:
+        assert isinstance(action, ApplyRuleAction), 'Invalid action [%s], only ApplyRule action is valid ' \
+                                                    'at the beginning of decoding'
+
+        return False
+
+    if isinstance(action, ReduceAction):
+        assert frontier_field.cardinality in ('optional', 'multiple'), 'Reduce action can only be ' \
+                                                                       'applied on field with multiple ' \
+                                                                       'cardinality'
+
+        return True
+
+    if isinstance(frontier_field.type, ASDLCompositeType):
+        if not isinstance(action, ApplyRuleAction):
+            raise ValueError('Invalid action [%s] on field [%s]' % (action, frontier_field))
+
+        # a single or optional field is finished once filled
+        return frontier_field.cardinality in ('single', 'optional')
+
+    if not isinstance(action, GenTokenAction):
+        raise ValueError('Can only invoke GenToken or Reduce actions on primitive fields')
+
+    # only field of type string requires termination signal </primitive>
+    end_primitive = frontier_field.type.name != 'string' or action.is_stop_signal()
+
+    return end_primitive and frontier_field.cardinality in ('single', 'optional')
+
+
+def push_frontier_fields(node, stack):
+    """push the fields of `node` on a persistent frontier stack of (node, field, rest) triples, the first on the top"""
+    for field in reversed(node.fields):
+        stack = (node, field, stack)
+
+    return stack
+
+
+def apply_frontier_stack_action(stack, action, node=None):
+    """
+    Apply `action` on the frontier field on the top of a persistent frontier `stack`, which is None
+    at the beginning of decoding. `node` is the new node of an ApplyRule action, whose fields are pushed.
+    Returns the new stack and whether the frontier field is finished, which is popped.
+
+    The frontier on the top of the stack is the same as found by the depth-first search in
+    `Hypothesis.update_frontier_info`, in O(1) per action, and stacks share their common rests.
+    """
+    finished = frontier_field_finished(stack[1] if stack is not None else None, action)
+    if finished:
+        stack = stack[2]
+    if isinstance(action, ApplyRuleAction):
+        stack = push_frontier_fields(node, stack)
+
+    return stack, finished
+
+
 class Hypothesis(object):
-    def __init__(self):
+    def __init__(self, use_frontier_stack=False):
         self.tree = None
         self.actions = []
         self.score = 0.
@@ -17,61 +78,79 @@ class Hypothesis(object):
         # record the current time step
         self.t = 0
 
+        # in frontier stack mode, the unfinished fields are kept in a persistent stack with the frontier
+        # field on the top, see `apply_frontier_stack_action`, instead of searching for the frontier
+        # from the root after each action
+        self.use_frontier_stack = use_frontier_stack
+        self._frontier_stack = None
+
+    @property
+    def has_value_buffer(self):
+        """whether tokens of a string value are generated, which is not finished by </primitive> yet"""
+        return len(self._value_buffer) > 0
+
     def apply_action(self, action):
-        if self.tree is None:
-            assert isinstance(action, ApplyRuleAction), 'Invalid action [%s], only ApplyRule action is valid ' \
-                                                        'at the beginning of decoding'
-
-            self.tree = AbstractSyntaxTree(action.production)
-            self.update_frontier_info()
-        elif self.frontier_node:
-            if isinstance(self.frontier_field.type, ASDLCompositeType):
-                if isinstance(action, ApplyRuleAction):
-                    field_value = AbstractSyntaxTree(action.production)
-                    field_value.created_time = self.t
-                    self.frontier_field.add_value(field_value)
-                    self.update_frontier_info()
-                elif isinstance(action, ReduceAction):
-                    assert self.frontier_field.cardinality in ('optional', 'multiple'), 'Reduce action can only be ' \
-                                                                                        'applied on field with multiple ' \
-                                                                                        'cardinality'
-                    self.frontier_field.set_finish()
-                    self.update_frontier_info()
-                else:
-                    raise ValueError('Invalid action [%s] on field [%s]' % (action, self.frontier_field))
-            else:  # fill in a primitive field
-                if isinstance(action, GenTokenAction):
-                    # only field of type string requires termination signal </primitive>
-                    end_primitive = False
-                    if self.frontier_field.type.name == 'string':
-                        if action.is_stop_signal():
-                            self.frontier_field.add_value(' '.join(self._value_buffer))
-                            self._value_buffer = []
-
-                            end_primitive = True
-                        else:
-                            self._value_buffer.append(action.token)
+        if self.tree is None or self.frontier_node:
+            node = None
+            if isinstance(action, ApplyRuleAction):
+                node = AbstractSyntaxTree(action.production)
+                node.created_time = self.t
+
+            # the action is checked before the tree is changed
+            if self.use_frontier_stack:
+                self._frontier_stack, finished = apply_frontier_stack_action(self._frontier_stack, action, node)
+            else:
+                finished = frontier_field_finished(self.frontier_field, action)
+
+            if self.tree is None:
+                self.tree = node
+            elif node is not None:
+                self.frontier_field.add_value(node)
+            elif isinstance(action, GenTokenAction):
+                if self.frontier_field.type.name == 'string':
+                    if action.is_stop_signal():
+                        self.frontier_field.add_value(' '.join(self._value_buffer))
+                        self._value_buffer = []
                     else:
-                        self.frontier_field.add_value(action.token)
-                        end_primitive = True
-
-                    if end_primitive and self.frontier_field.cardinality in ('single', 'optional'):
-                        self.frontier_field.set_finish()
-                        self.update_frontier_info()
-
-                elif isinstance(action, ReduceAction):
-                    assert self.frontier_field.cardinality in ('optional', 'multiple'), 'Reduce action can only be ' \
-                                                                                        'applied on field with multiple ' \
-                                                                                        'cardinality'
-                    self.frontier_field.set_finish()
-                    self.update_frontier_info()
+                        self._value_buffer.append(action.token)
                 else:
-                    raise ValueError('Can only invoke GenToken or Reduce actions on primitive fields')
+                    self.frontier_field.add_value(action.token)
+
+            if finished and node is None:
+                self.frontier_field.set_finish()
+            if finished or node is not None:
+                self.update_frontier_info()
 
         self.t += 1
         self.actions.append(action)
 
+    def _rebuild_frontier_stack(self):
+        """collect the unfinished fields in the order they are visited by `update_frontier_info`"""
+        def _collect_unfinished_fields(tree_node, unfinished_fields):
+            for field in tree_node.fields:
+                if isinstance(field.type, ASDLCompositeType):
+                    for child_node in field.as_value_list:
+                        _collect_unfinished_fields(child_node, unfinished_fields)
+
+                if not field.finished:
+                    unfinished_fields.append(field)
+
+        unfinished_fields = []
+        if self.tree:
+            _collect_unfinished_fields(self.tree, unfinished_fields)
+        self._frontier_stack = None
+        for field in reversed(unfinished_fields):
+            self._frontier_stack = (field.parent_node, field, self._frontier_stack)
+
     def update_frontier_info(self):
+        if self.use_frontier_stack:
+            if self._frontier_stack is not None:
+                self.frontier_node, self.frontier_field = self._frontier_stack[:2]
+            else:
+                self.frontier_node, self.frontier_field = None, None
+
+            return
+
         def _find_frontier_node_and_field(tree_node):
             if tree_node:
                 for field in tree_node.fields:
@@ -104,7 +183,7 @@ class Hypothesis(object):
         return new_hyp
 
     def copy(self):
-        new_hyp = Hypothesis()
+        new_hyp = Hypothesis(use_frontier_stack=self.use_frontier_stack)
         if self.tree:
             new_hyp.tree = self.tree.copy()
 
@@ -113,6 +192,8 @@ class Hypothesis(object):
         new_hyp._value_buffer = list(self._value_buffer)
         new_hyp.t = self.t
 
+        if new_hyp.use_frontier_stack:
+            new_hyp._rebuild_frontier_stack()
         new_hyp.update_frontier_info()
 
         return new_hyp
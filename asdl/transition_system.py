@@ -1,19 +1,52 @@
 # coding=utf-8
+import numpy as np
 
+from .asdl import ASDLCompositeType
+from .asdl_ast import AbstractSyntaxTree
+from .utils import SlottedObject
 
-class Action(object):
-    pass
+
+class Action(SlottedObject):
+    __slots__ = ()
 
 
 class ApplyRuleAction(Action):
-    def __init__(self, production):
-        self.production = production
+    """
+    Flyweight: there is a single action per production of a grammar, which is returned by the
+    constructor and kept in the namespace of the grammar, see `SchemaNamespace`
+    """
+    __slots__ = ('production',)
+
+    def __new__(cls, production=None):
+        # no production when unpickling actions saved before they were flyweights, which
+        # are replaced by the flyweights when resolving action infos, see `ActionInfo.resolve_schema`
+        if production is None:
+            return object.__new__(cls)
+
+        if production.namespace is None:
+            # productions constructed without a grammar have no flyweight
+            action = object.__new__(cls)
+            action.production = production
+
+            return action
+
+        actions = production.namespace.apply_rule_actions
+        action = actions.get(production)
+        if action is None:
+            action = object.__new__(cls)
+            action.production = production
+            actions[production] = action
+
+        return action
+
+    def __reduce__(self):
+        return ApplyRuleAction, (self.production,)
 
     def __hash__(self):
         return hash(self.production)
 
     def __eq__(self, other):
-        return isinstance(other, ApplyRuleAction) and self.production == other.production
+        return self is other or isinstance(other, ApplyRuleAction) and self.production == other.production
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -23,6 +56,8 @@ class ApplyRuleAction(Action):
 
 
 class GenTokenAction(Action):
+    __slots__ = ('token',)
+
     def __init__(self, token):
         self.token = token
 
@@ -34,8 +69,23 @@ class GenTokenAction(Action):
 
 
 class ReduceAction(Action):
-   def __repr__(self):
-       return 'Reduce'
+    """
+    Singleton, also when unpickled
+    """
+    __slots__ = ()
+    _instance = None
+
+    def __new__(cls):
+        if ReduceAction._instance is None:
+            ReduceAction._instance = object.__new__(cls)
+
+        return ReduceAction._instance
+
+    def __reduce__(self):
+        return ReduceAction, ()
+
+    def __repr__(self):
+        return 'Reduce'
 
 
 class TransitionSystem(object):
@@ -83,6 +133,72 @@ class TransitionSystem(object):
 
         return actions
 
+    def get_action_oracle(self, asdl_ast, src_query=None):
+        """
+        generate the action sequence of `get_actions` in a single iterative traversal of the tree,
+        together with the statistics of `components.action_info.get_action_infos` at each time step
+        as integer arrays: the time step of the parent action, the ids of the frontier production
+        and field (-1 at the first time step), and the position in `src_query` of the tokens of
+        GenToken actions (-1 if not copied)
+        """
+
+        actions = []
+        parent_t = []
+        frontier_prod_ids = []
+        frontier_field_ids = []
+
+        # the subtrees, primitive fields and Reduce actions to generate, with the time step of their
+        # parent action and the ids of their frontier production and field, the next one on the top
+        stack = [(asdl_ast, -1, -1, -1)]
+        while stack:
+            item, p_t, prod_id, field_id = stack.pop()
+            if isinstance(item, AbstractSyntaxTree):
+                node_t = len(actions)
+                actions.append(ApplyRuleAction(item.production))
+                parent_t.append(p_t)
+                frontier_prod_ids.append(prod_id)
+                frontier_field_ids.append(field_id)
+
+                node_prod_id = item.production.id
+                for field in reversed(item.fields):
+                    schema_field = field.field
+                    # is a composite field
+                    if isinstance(schema_field.type, ASDLCompositeType):
+                        field_values = field.as_value_list
+                        # if an optional field is filled, then do not need Reduce action
+                        if schema_field.cardinality == 'multiple' or \
+                                schema_field.cardinality == 'optional' and not field_values:
+                            stack.append((ReduceAction(), node_t, node_prod_id, schema_field.id))
+                        for val in reversed(field_values):
+                            stack.append((val, node_t, node_prod_id, schema_field.id))
+                    else:  # is a primitive field
+                        stack.append((field, node_t, node_prod_id, schema_field.id))
+            else:
+                if isinstance(item, ReduceAction):
+                    field_actions = [item]
+                else:
+                    field_actions = self.get_primitive_field_actions(item)
+
+                    # if an optional field is filled, then do not need Reduce action
+                    if item.cardinality == 'multiple' or item.cardinality == 'optional' and not field_actions:
+                        field_actions.append(ReduceAction())
+
+                actions.extend(field_actions)
+                parent_t.extend([p_t] * len(field_actions))
+                frontier_prod_ids.extend([prod_id] * len(field_actions))
+                frontier_field_ids.extend([field_id] * len(field_actions))
+
+        src_token_ids = dict()
+        if src_query:
+            # the first occurrence of a token, as `src_query.index`
+            for i in range(len(src_query) - 1, -1, -1):
+                src_token_ids[src_query[i]] = i
+        src_token_positions = [src_token_ids.get(str(action.token), -1) if isinstance(action, GenTokenAction) else -1
+                               for action in actions]
+
+        return actions, np.array(parent_t, dtype=np.int64), np.array(frontier_prod_ids, dtype=np.int64), \
+            np.array(frontier_field_ids, dtype=np.int64), np.array(src_token_positions, dtype=np.int64)
+
     def tokenize_code(self, code, mode):
         raise NotImplementedError
 
@@ -99,7 +215,9 @@ class TransitionSystem(object):
         raise NotImplementedError
 
     def get_valid_continuation_types(self, hyp):
-        if hyp.tree:
+        # check the time step rather than `hyp.tree`, so that hypotheses which do not
+        # build their trees during decoding are also supported
+        if hyp.t > 0:
             if self.grammar.is_composite_type(hyp.frontier_field.type):
                 if hyp.frontier_field.cardinality == 'single':
                     return ApplyRuleAction,
@@ -109,7 +227,7 @@ class TransitionSystem(object):
                 if hyp.frontier_field.cardinality == 'single':
                     return GenTokenAction,
                 elif hyp.frontier_field.cardinality == 'optional':
-                    if hyp._value_buffer:
+                    if hyp.has_value_buffer:
                         return GenTokenAction,
                     else:
                         return GenTokenAction, ReduceAction
@@ -119,7 +237,7 @@ class TransitionSystem(object):
             return ApplyRuleAction,
 
     def get_valid_continuating_productions(self, hyp):
-        if hyp.tree:
+        if hyp.t > 0:
             if self.grammar.is_composite_type(hyp.frontier_field.type):
                 return self.grammar[hyp.frontier_field.type]
             else:
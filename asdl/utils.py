@@ -7,3 +7,31 @@ def remove_comment(text):
     text = '\n'.join(filter(lambda x: x, text.split('\n')))
 
     return text
+
+
+class SlottedObject(object):
+    """
+    Base of classes with `__slots__`, for objects created in bulk such as AST nodes and actions
+
+    Objects are pickled with the dict of their attributes as their state, which is also the state of
+    objects pickled when the classes had no slots, so such pickles can still be loaded.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def _slot_names(cls):
+        if '_cached_slot_names' not in cls.__dict__:
+            cls._cached_slot_names = tuple(name for klass in cls.__mro__ for name in klass.__dict__.get('__slots__', ())
+                                           if name not in ('__dict__', '__weakref__'))
+
+        return cls._cached_slot_names
+
+    def __getstate__(self):
+        state = {name: getattr(self, name) for name in self._slot_names() if hasattr(self, name)}
+        state.update(getattr(self, '__dict__', ()))
+
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
@@ -0,0 +1,238 @@
+# coding=utf-8
+"""
+Throughput benchmark of building training batches.
+
+Reports the batches/sec of building the index tensors of training batches with
+
+- `BaselineBatch`, a copy of the original `Batch.init_index_tensors`, which loops over every
+  (time step, example) pair in Python, and of the frontier ids that the decoder looked up at
+  each time step,
+- `Batch` computing the index arrays of the target actions while building each batch
+  (as in the first epoch without `Dataset.tensorize`),
+- `Batch` with the arrays precomputed by `Dataset.tensorize`.
+
+It also runs the training iterations of `exp.py --mode train` (`Parser.score`, backward and an
+optimizer step) with the last two. The current decoder cannot run on a `BaselineBatch`, so the
+training iteration is only compared with the path without `Dataset.tensorize`, not with the
+original per-(time step, example) loop.
+
+    python -m benchmarks.batching --load_model saved_models/conala/model.bin --dataset data/conala/train.gold.full.bin
+"""
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+from asdl.transition_system import ApplyRuleAction, ReduceAction
+from common.registerable import Registrable
+from components.dataset import Batch, Dataset
+from model.parser import Parser
+
+
+def init_arg_parser():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--cuda', action='store_true', default=False, help='Use gpu')
+    arg_parser.add_argument('--parser', type=str, default='default_parser', help='name of parser class to load')
+    arg_parser.add_argument('--load_model', type=str, required=True, help='Model to train')
+    arg_parser.add_argument('--dataset', type=str, default='data/conala/train.gold.full.bin', help='Training examples')
+    arg_parser.add_argument('--batch_size', type=int, default=10, help='Batch size')
+    arg_parser.add_argument('--max_batch_num', type=int, default=200, help='Number of batches to run')
+    arg_parser.add_argument('--num_threads', type=int, default=None, help='Number of CPU threads used by torch')
+
+    return arg_parser
+
+
+class BaselineBatch(object):
+    """the index tensors of the original `Batch`, built by looping over every (time step, example) pair"""
+
+    def __init__(self, examples, grammar, vocab, copy=True, cuda=False):
+        self.examples = examples
+        self.max_action_num = max(len(e.tgt_actions) for e in self.examples)
+
+        self.src_sents = [e.src_sent for e in self.examples]
+        self.src_sents_len = [len(e.src_sent) for e in self.examples]
+
+        self.grammar = grammar
+        self.vocab = vocab
+        self.copy = copy
+        self.cuda = cuda
+
+        self.init_index_tensors()
+
+    def __len__(self):
+        return len(self.examples)
+
+    def get_frontier_field_idx(self, t):
+        ids = []
+        for e in self.examples:
+            if t < len(e.tgt_actions):
+                ids.append(self.grammar.field2id[e.tgt_actions[t].frontier_field])
+            else:
+                ids.append(0)
+
+        return Variable(torch.cuda.LongTensor(ids)) if self.cuda else Variable(torch.LongTensor(ids))
+
+    def get_frontier_prod_idx(self, t):
+        ids = []
+        for e in self.examples:
+            if t < len(e.tgt_actions):
+                ids.append(self.grammar.prod2id[e.tgt_actions[t].frontier_prod])
+            else:
+                ids.append(0)
+
+        return Variable(torch.cuda.LongTensor(ids)) if self.cuda else Variable(torch.LongTensor(ids))
+
+    def get_frontier_field_type_idx(self, t):
+        ids = []
+        for e in self.examples:
+            if t < len(e.tgt_actions):
+                ids.append(self.grammar.type2id[e.tgt_actions[t].frontier_field.type])
+            else:
+                ids.append(0)
+
+        return Variable(torch.cuda.LongTensor(ids)) if self.cuda else Variable(torch.LongTensor(ids))
+
+    def init_index_tensors(self):
+        self.apply_rule_idx_matrix = []
+        self.apply_rule_mask = []
+        self.primitive_idx_matrix = []
+        self.gen_token_mask = []
+        self.primitive_copy_mask = []
+        self.primitive_copy_token_idx_mask = np.zeros((self.max_action_num, len(self), max(self.src_sents_len)), dtype='float32')
+
+        for t in range(self.max_action_num):
+            app_rule_idx_row = []
+            app_rule_mask_row = []
+            token_row = []
+            gen_token_mask_row = []
+            copy_mask_row = []
+
+            for e_id, e in enumerate(self.examples):
+                app_rule_idx = app_rule_mask = token_idx = gen_token_mask = copy_mask = 0
+                if t < len(e.tgt_actions):
+                    action = e.tgt_actions[t].action
+                    action_info = e.tgt_actions[t]
+
+                    if isinstance(action, ApplyRuleAction):
+                        app_rule_idx = self.grammar.prod2id[action.production]
+                        app_rule_mask = 1
+                    elif isinstance(action, ReduceAction):
+                        app_rule_idx = len(self.grammar)
+                        app_rule_mask = 1
+                    else:
+                        src_sent = self.src_sents[e_id]
+                        token = str(action.token)
+                        token_idx = self.vocab.primitive[action.token]
+
+                        token_can_copy = False
+
+                        if self.copy and token in src_sent:
+                            token_pos_list = [idx for idx, _token in enumerate(src_sent) if _token == token]
+                            self.primitive_copy_token_idx_mask[t, e_id, token_pos_list] = 1.
+                            copy_mask = 1
+                            token_can_copy = True
+
+                        if token_can_copy is False or token_idx != self.vocab.primitive.unk_id:
+                            gen_token_mask = 1
+
+                        if token_can_copy:
+                            assert action_info.copy_from_src
+                            assert action_info.src_token_position in token_pos_list
+
+                app_rule_idx_row.append(app_rule_idx)
+                app_rule_mask_row.append(app_rule_mask)
+
+                token_row.append(token_idx)
+                gen_token_mask_row.append(gen_token_mask)
+                copy_mask_row.append(copy_mask)
+
+            self.apply_rule_idx_matrix.append(app_rule_idx_row)
+            self.apply_rule_mask.append(app_rule_mask_row)
+
+            self.primitive_idx_matrix.append(token_row)
+            self.gen_token_mask.append(gen_token_mask_row)
+
+            self.primitive_copy_mask.append(copy_mask_row)
+
+        T = torch.cuda if self.cuda else torch
+        self.apply_rule_idx_matrix = Variable(T.LongTensor(self.apply_rule_idx_matrix))
+        self.apply_rule_mask = Variable(T.FloatTensor(self.apply_rule_mask))
+        self.primitive_idx_matrix = Variable(T.LongTensor(self.primitive_idx_matrix))
+        self.gen_token_mask = Variable(T.FloatTensor(self.gen_token_mask))
+        self.primitive_copy_mask = Variable(T.FloatTensor(self.primitive_copy_mask))
+        self.primitive_copy_token_idx_mask = Variable(torch.from_numpy(self.primitive_copy_token_idx_mask))
+        if self.cuda: self.primitive_copy_token_idx_mask = self.primitive_copy_token_idx_mask.cuda()
+
+
+def time_baseline_batches(parser, batches):
+    begin = time.time()
+    for batch_examples in batches:
+        batch = BaselineBatch(batch_examples, parser.grammar, parser.vocab, copy=parser.args.no_copy is False,
+                              cuda=parser.args.cuda)
+        # the original decoder looked up the frontier ids of every time step
+        for t in range(1, batch.max_action_num):
+            batch.get_frontier_prod_idx(t)
+            batch.get_frontier_field_idx(t)
+            batch.get_frontier_field_type_idx(t)
+
+    return len(batches) / (time.time() - begin)
+
+
+def time_batches(parser, batches):
+    begin = time.time()
+    for batch_examples in batches:
+        Batch(batch_examples, parser.grammar, parser.vocab, copy=parser.args.no_copy is False, cuda=parser.args.cuda)
+
+    return len(batches) / (time.time() - begin)
+
+
+def time_train_iters(parser, optimizer, batches):
+    begin = time.time()
+    for batch_examples in batches:
+        optimizer.zero_grad()
+        loss = -parser.score(batch_examples)[0]
+        torch.mean(loss).backward()
+        optimizer.step()
+
+    return len(batches) / (time.time() - begin)
+
+
+if __name__ == '__main__':
+    args = init_arg_parser().parse_args()
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    parser = Registrable.by_name(args.parser).load(model_path=args.load_model, cuda=args.cuda)
+    dataset = Dataset.from_bin_file(args.dataset, parser.grammar)
+    parser.train()
+    optimizer = torch.optim.Adam(parser.parameters(), lr=0.)
+
+    batches = [batch_examples for batch_examples in dataset.batch_iter(batch_size=args.batch_size, shuffle=False)
+               if all(len(e.tgt_actions) <= parser.args.decode_max_time_step for e in batch_examples)]
+    batches = batches[:args.max_batch_num]
+    print('%d batches of %d examples' % (len(batches), args.batch_size))
+
+    baseline_build = time_baseline_batches(parser, batches)
+    dataset.clear_tensors()
+    per_batch_build = time_batches(parser, batches)
+    dataset.clear_tensors()
+    per_batch_train = time_train_iters(parser, optimizer, batches)
+
+    begin = time.time()
+    dataset.tensorize(parser.grammar, parser.vocab)
+    print('tensorized %d examples in %.2fs' % (len(dataset), time.time() - begin))
+
+    precomputed_build = time_batches(parser, batches)
+    precomputed_train = time_train_iters(parser, optimizer, batches)
+
+    print('Batch construction: %.1f batches/sec baseline loop, %.1f batches/sec per batch (%.2fx), '
+          '%.1f batches/sec precomputed (%.2fx)' % (
+              baseline_build, per_batch_build, per_batch_build / baseline_build,
+              precomputed_build, precomputed_build / baseline_build))
+    # the baseline loop cannot feed the current decoder, see the module docstring
+    print('training iteration: %.2f batches/sec per batch, %.2f batches/sec precomputed (%.2fx)' % (
+        per_batch_train, precomputed_train, precomputed_train / per_batch_train))
@@ -0,0 +1,92 @@
+# coding=utf-8
+"""
+Scaling benchmark of data-parallel CPU training (`exp.py --mode train --num_processes`).
+
+Runs training iterations (`Parser.score`, backward, gradient all-reduce and an optimizer
+step) on the batches of one shuffled epoch sharded over 1, 2, 4 and 8 local processes,
+and reports the training examples/sec and the speedup over a single process.
+
+    python -m benchmarks.data_parallel --load_model saved_models/conala/model.bin \
+        --dataset data/conala/train.gold.full.bin
+"""
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import time
+
+import torch
+import torch.distributed
+import torch.multiprocessing
+
+from common.registerable import Registrable
+from components.dataset import Dataset
+from model import nn_utils
+from model.parser import Parser
+
+
+def init_arg_parser():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--parser', type=str, default='default_parser', help='name of parser class to load')
+    arg_parser.add_argument('--load_model', type=str, required=True, help='Model to train')
+    arg_parser.add_argument('--dataset', type=str, default='data/conala/train.gold.full.bin', help='Training examples')
+    arg_parser.add_argument('--batch_size', type=int, default=10, help='Batch size of each process')
+    arg_parser.add_argument('--num_processes', type=int, nargs='+', default=[1, 2, 4, 8],
+                            help='Numbers of processes to run')
+    arg_parser.add_argument('--max_batch_num', type=int, default=200,
+                            help='Maximum number of training iterations of each process')
+    arg_parser.add_argument('--num_threads_per_process', type=int, default=None,
+                            help='Number of CPU threads used by torch in each process, by default the CPU cores '
+                                 'are divided evenly between the processes')
+    arg_parser.add_argument('--dist_init_method', default='tcp://127.0.0.1:29500', type=str,
+                            help='URL to set up the process group')
+
+    return arg_parser
+
+
+def run_process(rank, args, num_processes, result_queue):
+    torch.distributed.init_process_group('gloo', init_method=args.dist_init_method,
+                                         rank=rank, world_size=num_processes)
+    torch.set_num_threads(args.num_threads_per_process or max(1, multiprocessing.cpu_count() // num_processes))
+
+    parser = Registrable.by_name(args.parser).load(model_path=args.load_model)
+    parser.train()
+    optimizer = torch.optim.Adam(parser.parameters(), lr=0.)
+
+    examples = [e for e in Dataset.from_bin_file(args.dataset, parser.grammar).examples
+                if len(e.tgt_actions) <= parser.args.decode_max_time_step]
+    batches = list(Dataset(examples).batch_iter(args.batch_size, shuffle=True, seed=0,
+                                                num_shards=num_processes, shard_id=rank))[:args.max_batch_num]
+    batches = [parser.to_batch(batch_examples) for batch_examples in batches]
+
+    torch.distributed.barrier()
+    begin = time.time()
+    for batch in batches:
+        optimizer.zero_grad()
+        loss = -parser.score(batch)[0]
+        torch.mean(loss).backward()
+        nn_utils.all_reduce_gradients(parser.parameters(), num_processes)
+        optimizer.step()
+    torch.distributed.barrier()
+    elapsed = time.time() - begin
+
+    if rank == 0:
+        result_queue.put((sum(len(batch) for batch in batches) * num_processes, elapsed))
+    torch.distributed.destroy_process_group()
+
+
+if __name__ == '__main__':
+    args = init_arg_parser().parse_args()
+
+    ctx = torch.multiprocessing.get_context('spawn')
+    base_examples_per_sec = None
+    print('%10s %12s %10s' % ('processes', 'examples/s', 'speedup'))
+    for num_processes in args.num_processes:
+        result_queue = ctx.SimpleQueue()
+        torch.multiprocessing.spawn(run_process, args=(args, num_processes, result_queue), nprocs=num_processes)
+        example_num, elapsed = result_queue.get()
+
+        examples_per_sec = example_num / elapsed
+        if base_examples_per_sec is None:
+            base_examples_per_sec = examples_per_sec
+        print('%10d %12.1f %9.2fx' % (num_processes, examples_per_sec, examples_per_sec / base_examples_per_sec))
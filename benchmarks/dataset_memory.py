@@ -0,0 +1,124 @@
+# coding=utf-8
+"""
+Memory benchmark of loaded datasets.
+
+Loads a pickled dataset (`Dataset.from_bin_file`) in a fresh process with the `__slots__` AST
+node, realized field, action and action info classes, with their flyweight `ApplyRuleAction`s
+and `ReduceAction`, and with dict-backed stand-ins of the classes as they were before, and
+reports the resident size of the loaded examples and the load time. Datasets pickled before
+either version can be loaded in both modes. Reads the resident size in /proc (Linux).
+
+    python -m benchmarks.dataset_memory --dataset data/conala/train.all_100000.bin
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import pickle
+import subprocess
+import sys
+import time
+
+from components.dataset import Dataset
+
+MODES = ['dict', 'slots']
+
+
+def init_arg_parser():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--dataset', type=str, default='data/conala/train.all_100000.bin',
+                            help='Pickled examples to load')
+    arg_parser.add_argument('--modes', type=str, nargs='+', default=MODES, choices=MODES,
+                            help='Representations to compare')
+    arg_parser.add_argument('--worker', type=str, default=None, help='Run a single mode in this process (internal)')
+
+    return arg_parser
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        resident_pages = int(f.read().split()[1])
+
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / 1024. / 1024.
+
+
+class DictAbstractSyntaxTree(object):
+    pass
+
+
+class DictRealizedField(object):
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # realized fields re-stored the name, type and cardinality of their field
+        self.name, self.type, self.cardinality = self.field.name, self.field.type, self.field.cardinality
+
+
+class DictApplyRuleAction(object):
+    def __init__(self, production=None):
+        self.production = production
+
+
+class DictGenTokenAction(object):
+    pass
+
+
+class DictReduceAction(object):
+    pass
+
+
+class DictActionInfo(object):
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # an action object per action
+        if isinstance(self.action, DictApplyRuleAction):
+            self.action = DictApplyRuleAction(self.action.production)
+        elif isinstance(self.action, DictReduceAction):
+            self.action = DictReduceAction()
+
+
+DICT_CLASSES = {
+    ('asdl.asdl_ast', 'AbstractSyntaxTree'): DictAbstractSyntaxTree,
+    ('asdl.asdl_ast', 'RealizedField'): DictRealizedField,
+    ('asdl.transition_system', 'ApplyRuleAction'): DictApplyRuleAction,
+    ('asdl.transition_system', 'GenTokenAction'): DictGenTokenAction,
+    ('asdl.transition_system', 'ReduceAction'): DictReduceAction,
+    ('components.action_info', 'ActionInfo'): DictActionInfo,
+}
+
+
+class DictUnpickler(pickle.Unpickler):
+    """loads the AST nodes, realized fields, actions and action infos as plain dict-backed objects"""
+    def find_class(self, module, name):
+        return DICT_CLASSES.get((module, name)) or pickle.Unpickler.find_class(self, module, name)
+
+
+def run_worker(args):
+    gc.collect()
+    base_rss = rss_mb()
+
+    begin = time.time()
+    if args.worker == 'dict':
+        with open(args.dataset, 'rb') as f:
+            examples = DictUnpickler(f).load()
+    else:
+        examples = Dataset.from_bin_file(args.dataset).examples
+    elapsed = time.time() - begin
+
+    gc.collect()
+    print(json.dumps(dict(example_num=len(examples), rss=rss_mb() - base_rss, load_time=elapsed)))
+
+
+if __name__ == '__main__':
+    args = init_arg_parser().parse_args()
+    if args.worker:
+        run_worker(args)
+        sys.exit(0)
+
+    print('%-8s %10s %14s %14s' % ('mode', 'examples', 'resident (MB)', 'load time (s)'))
+    for mode in args.modes:
+        output = subprocess.check_output([sys.executable, '-m', 'benchmarks.dataset_memory',
+                                          '--dataset', args.dataset, '--worker', mode])
+        result = json.loads(output.decode('utf-8').strip().split('\n')[-1])
+        print('%-8s %10d %14.1f %14.2f' % (mode, result['example_num'], result['rss'], result['load_time']))
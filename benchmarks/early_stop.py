@@ -0,0 +1,83 @@
+# coding=utf-8
+"""
+Benchmark of score-bound early stopping and adaptive beam in beam search.
+
+Decodes a dataset with the plain beam search and with each early stopping / beam margin
+setting, including the lossy early stopping heuristic, and reports the decoding latency,
+the corpus BLEU of the top predictions and the number of utterances whose top prediction changed.
+
+    python -m benchmarks.early_stop --load_model saved_models/conala/model.bin --dev_file data/conala/dev.bin \
+        --beam_size 15 --early_stop_k 1 5 --early_stop_heuristic_k 1 --beam_margins 5 10
+"""
+from __future__ import print_function
+
+import argparse
+import copy
+import time
+
+import evaluation
+from common.registerable import Registrable
+from components.dataset import Dataset
+from model.parser import Parser
+from datasets.conala import evaluator as conala_evaluator
+
+
+def init_arg_parser():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--cuda', action='store_true', default=False, help='Use gpu')
+    arg_parser.add_argument('--parser', type=str, default='default_parser', help='name of parser class to load')
+    arg_parser.add_argument('--evaluator', type=str, default='conala_evaluator', help='name of evaluator class to use')
+    arg_parser.add_argument('--load_model', type=str, required=True, help='Model to decode with')
+    arg_parser.add_argument('--dev_file', type=str, default='data/conala/dev.bin', help='Path to the dev set')
+    arg_parser.add_argument('--beam_size', default=15, type=int, help='Beam size for beam search')
+    arg_parser.add_argument('--decode_batch_size', default=16, type=int,
+                            help='Number of utterances decoded together in one batched beam search')
+    arg_parser.add_argument('--early_stop_k', nargs='*', type=int, default=[1],
+                            help='Values of `--decode_early_stop_k` to benchmark')
+    arg_parser.add_argument('--early_stop_heuristic_k', nargs='*', type=int, default=[1],
+                            help='Values of `--decode_early_stop_k` to benchmark with `--decode_early_stop_heuristic`')
+    arg_parser.add_argument('--beam_margins', nargs='*', type=float, default=[5., 10.],
+                            help='Values of `--decode_beam_margin` to benchmark')
+
+    return arg_parser
+
+
+def run(parser, evaluator, examples, args):
+    begin = time.time()
+    decode_results = evaluation.decode(examples, parser, args)
+    elapsed = time.time() - begin
+
+    top_codes = [hyps[0].code if hyps else None for hyps in decode_results]
+    bleu = evaluator.evaluate_dataset(examples, decode_results, fast_mode=True, args=args)
+
+    return elapsed, bleu, top_codes
+
+
+if __name__ == '__main__':
+    args = init_arg_parser().parse_args()
+    args.save_decode_to = None
+
+    parser = Registrable.by_name(args.parser).load(model_path=args.load_model, cuda=args.cuda)
+    dev_set = Dataset.from_bin_file(args.dev_file, parser.grammar)
+    parser.eval()
+    evaluator = Registrable.by_name(args.evaluator)(parser.transition_system, args=args)
+
+    settings = [(0, False, None)] + [(k, False, None) for k in args.early_stop_k] + \
+               [(k, True, None) for k in args.early_stop_heuristic_k] + \
+               [(0, False, margin) for margin in args.beam_margins]
+    base_elapsed = base_top_codes = None
+    for early_stop_k, early_stop_heuristic, beam_margin in settings:
+        run_args = copy.copy(args)
+        run_args.decode_early_stop_k = early_stop_k
+        run_args.decode_early_stop_heuristic = early_stop_heuristic
+        run_args.decode_beam_margin = beam_margin
+
+        elapsed, bleu, top_codes = run(parser, evaluator, dev_set.examples, run_args)
+        if base_elapsed is None:
+            base_elapsed, base_top_codes = elapsed, top_codes
+        changed_num = sum(code != base_code for code, base_code in zip(top_codes, base_top_codes))
+
+        print('early_stop_k=%d, early_stop_heuristic=%s, beam_margin=%s: %.2fms/utterance (%.1f%% less), BLEU=%.4f, '
+              '%d top predictions changed' % (early_stop_k, early_stop_heuristic, beam_margin,
+                                              elapsed / len(dev_set) * 1000,
+                                              (1. - elapsed / base_elapsed) * 100, bleu, changed_num))
@@ -0,0 +1,93 @@
+# coding=utf-8
+"""
+Micro-benchmark of `asdl.flat_ast.FlatAST`.
+
+Encodes the target trees of a binarized CoNaLa dataset as flat arrays, checks that they convert
+back to the same trees and action sequences, and reports the time of hashing, comparing and
+sizing the trees, of computing their actions and of building new trees from `AbstractSyntaxTree`s
+and from `FlatAST`s, the time of encoding the trees, and the pickled size of both.
+
+    python -m benchmarks.flat_ast --dataset data/conala/train.gold.full.bin
+"""
+from __future__ import print_function
+
+import argparse
+import pickle
+import time
+
+from asdl.asdl import ASDLGrammar
+from asdl.flat_ast import FlatAST
+from asdl.hypothesis import Hypothesis
+from asdl.transition_system import TransitionSystem
+from components.dataset import Dataset
+
+
+def init_arg_parser():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--dataset', type=str, default='data/conala/train.gold.full.bin',
+                            help='Binarized dataset whose target trees are encoded')
+    arg_parser.add_argument('--asdl_file', type=str, default='asdl/lang/py3/py3_asdl.simplified.txt',
+                            help='Grammar of the target trees')
+    arg_parser.add_argument('--lang', type=str, default='python3', help='Language of the transition system')
+    arg_parser.add_argument('--repeat', type=int, default=3, help='Number of runs, the fastest one is reported')
+
+    return arg_parser
+
+
+def time_func(func, repeat=3):
+    elapsed = []
+    for _ in range(repeat):
+        begin = time.time()
+        func()
+        elapsed.append(time.time() - begin)
+
+    return min(elapsed)
+
+
+if __name__ == '__main__':
+    args = init_arg_parser().parse_args()
+
+    grammar = ASDLGrammar.from_text(open(args.asdl_file).read())
+    transition_system = TransitionSystem.get_class_by_lang(args.lang)(grammar)
+    trees = [e.tgt_ast for e in Dataset.from_bin_file(args.dataset, grammar)]
+    flat_trees = [FlatAST.from_ast(tree) for tree in trees]
+    print('%d trees, %d nodes' % (len(trees), sum(len(flat_tree) for flat_tree in flat_trees)))
+
+    for tree, flat_tree in zip(trees, flat_trees):
+        assert flat_tree.to_ast(grammar) == tree and flat_tree.size == tree.size
+        actions = transition_system.get_actions(tree)
+        assert [repr(a) for a in flat_tree.to_actions(transition_system)] == [repr(a) for a in actions]
+        # the actions of a singleton field with value None rebuild it with the token 'None'
+        hyp = Hypothesis(use_frontier_stack=True)
+        for action in actions:
+            hyp.apply_action(action)
+        assert FlatAST.from_actions(actions, grammar) == FlatAST.from_ast(hyp.tree)
+
+    # equal but distinct copies, hashes are not cached
+    copies = [tree.copy() for tree in trees]
+    flat_copies = [pickle.loads(pickle.dumps(flat_tree)) for flat_tree in flat_trees]
+    action_seqs = [transition_system.get_actions(tree) for tree in trees]
+
+    print('%-24s %12s %12s' % ('', 'AST (s)', 'FlatAST (s)'))
+    for name, func, flat_func in [
+        ('hash', lambda: [hash(tree) for tree in trees],
+         lambda: [hash(FlatAST(f.prod_ids, f.value_ptr, f.values, f.tokens)) for f in flat_trees]),
+        ('hash + dedup', lambda: len(set(trees + copies)), lambda: len(set(flat_trees + flat_copies))),
+        ('equality', lambda: [a == b for a, b in zip(trees, copies)],
+         lambda: [a == b for a, b in zip(flat_trees, flat_copies)]),
+        ('size', lambda: [tree.size for tree in trees], lambda: [flat_tree.size for flat_tree in flat_trees]),
+        ('actions', lambda: [transition_system.get_actions(tree) for tree in trees],
+         lambda: [flat_tree.to_actions(transition_system) for flat_tree in flat_trees]),
+    ]:
+        print('%-24s %12.3f %12.3f' % (name, time_func(func, args.repeat), time_func(flat_func, args.repeat)))
+
+    print('%-24s %12.3f %12.3f' % ('new tree (copy / to_ast)',
+                                   time_func(lambda: [tree.copy() for tree in trees], args.repeat),
+                                   time_func(lambda: [flat_tree.to_ast(grammar) for flat_tree in flat_trees],
+                                             args.repeat)))
+    print('encode from the tree / actions: %.3fs / %.3fs' % (
+        time_func(lambda: [FlatAST.from_ast(tree) for tree in trees], args.repeat),
+        time_func(lambda: [FlatAST.from_actions(actions, grammar) for actions in action_seqs], args.repeat)))
+    print('pickled size: %.1fKB (AST), %.1fKB (FlatAST), array size: %.1fKB' % (
+        len(pickle.dumps(trees)) / 1024., len(pickle.dumps(flat_trees)) / 1024.,
+        sum(flat_tree.nbytes for flat_tree in flat_trees) / 1024.))
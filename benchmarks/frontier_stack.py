@@ -0,0 +1,82 @@
+# coding=utf-8
+"""
+Micro-benchmark of frontier tracking in `asdl.hypothesis.Hypothesis`.
+
+Replays the gold action sequences of a binarized CoNaLa dataset with the default
+depth-first frontier search and with the frontier stack mode, checks that both
+modes give the same frontier at every time step, and reports the time of each mode.
+
+    python -m benchmarks.frontier_stack --dataset data/conala/train.gold.full.bin
+"""
+from __future__ import print_function
+
+import argparse
+import time
+
+from asdl.hypothesis import Hypothesis
+from components.dataset import Dataset
+
+
+def init_arg_parser():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--dataset', type=str, default='data/conala/train.gold.full.bin',
+                            help='Binarized dataset whose action sequences are replayed')
+    arg_parser.add_argument('--repeat', type=int, default=3, help='Number of runs, the fastest one is reported')
+    arg_parser.add_argument('--clone', action='store_true', default=False,
+                            help='Apply actions with `clone_and_apply_action` as in beam search, '
+                                 'instead of in place as in preprocessing')
+
+    return arg_parser
+
+
+def replay(action_seqs, use_frontier_stack, clone=False):
+    """replay the action sequences, return the frontiers at each time step"""
+    all_frontiers = []
+    for actions in action_seqs:
+        hyp = Hypothesis(use_frontier_stack=use_frontier_stack)
+        frontiers = []
+        for action in actions:
+            if clone:
+                hyp = hyp.clone_and_apply_action(action)
+            else:
+                hyp.apply_action(action)
+
+            if hyp.frontier_node:
+                frontiers.append((hyp.frontier_node.created_time, hyp.frontier_field.field))
+            else:
+                frontiers.append(None)
+
+        assert hyp.completed
+        all_frontiers.append(frontiers)
+
+    return all_frontiers
+
+
+def time_replay(action_seqs, use_frontier_stack, clone=False, repeat=3):
+    elapsed = []
+    for _ in range(repeat):
+        begin = time.time()
+        replay(action_seqs, use_frontier_stack, clone=clone)
+        elapsed.append(time.time() - begin)
+
+    return min(elapsed)
+
+
+if __name__ == '__main__':
+    args = init_arg_parser().parse_args()
+
+    dataset = Dataset.from_bin_file(args.dataset)
+    action_seqs = [[action_info.action for action_info in e.tgt_actions] for e in dataset]
+    action_num = sum(len(actions) for actions in action_seqs)
+    print('%d action sequences, %d actions, max length %d' % (len(action_seqs), action_num,
+                                                             max(len(actions) for actions in action_seqs)))
+
+    assert replay(action_seqs, False, clone=args.clone) == replay(action_seqs, True, clone=args.clone), \
+        'frontier stack mode yields a different frontier sequence'
+
+    dfs_time = time_replay(action_seqs, False, clone=args.clone, repeat=args.repeat)
+    stack_time = time_replay(action_seqs, True, clone=args.clone, repeat=args.repeat)
+
+    print('depth-first search: %.3fs (%.2fus/action)' % (dfs_time, dfs_time / action_num * 1e6))
+    print('frontier stack: %.3fs (%.2fus/action)' % (stack_time, stack_time / action_num * 1e6))
+    print('speedup: %.2fx' % (dfs_time / stack_time))
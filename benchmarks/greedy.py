@@ -0,0 +1,70 @@
+# coding=utf-8
+"""
+Latency benchmark of greedy decoding.
+
+Decodes each utterance of a dataset one at a time with `Parser.parse(beam_size=1)` and
+with `Parser.greedy_parse`, checks that both give the same hypothesis, and reports the
+mean and percentile latencies of each decoder.
+
+    python -m benchmarks.greedy --load_model saved_models/conala/model.bin --dataset data/conala/dev.bin
+"""
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from common.registerable import Registrable
+from components.dataset import Dataset
+from model.parser import Parser
+
+
+def init_arg_parser():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--cuda', action='store_true', default=False, help='Use gpu')
+    arg_parser.add_argument('--parser', type=str, default='default_parser', help='name of parser class to load')
+    arg_parser.add_argument('--load_model', type=str, required=True, help='Model to decode with')
+    arg_parser.add_argument('--dataset', type=str, default='data/conala/dev.bin', help='Utterances to decode')
+    arg_parser.add_argument('--num_threads', type=int, default=None, help='Number of CPU threads used by torch')
+
+    return arg_parser
+
+
+def time_decoder(decode_func, examples):
+    latencies = []
+    results = []
+    for example in examples:
+        begin = time.time()
+        hyps = decode_func(example.src_sent)
+        latencies.append(time.time() - begin)
+        results.append([([repr(action) for action in hyp.actions], hyp.score) for hyp in hyps])
+
+    return np.array(latencies) * 1000, results
+
+
+if __name__ == '__main__':
+    args = init_arg_parser().parse_args()
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    parser = Registrable.by_name(args.parser).load(model_path=args.load_model, cuda=args.cuda)
+    dataset = Dataset.from_bin_file(args.dataset, parser.grammar)
+    parser.eval()
+
+    with torch.no_grad():
+        # warm up
+        for example in dataset.examples[:10]:
+            parser.greedy_parse(example.src_sent)
+
+        beam_latencies, beam_results = time_decoder(lambda src_sent: parser.parse(src_sent, beam_size=1),
+                                                    dataset.examples)
+        greedy_latencies, greedy_results = time_decoder(parser.greedy_parse, dataset.examples)
+
+    mismatch_num = sum(beam_result != greedy_result for beam_result, greedy_result in zip(beam_results, greedy_results))
+    print('%d utterances, %d results differ' % (len(dataset), mismatch_num))
+    for name, latencies in [('parse(beam_size=1)', beam_latencies), ('greedy_parse', greedy_latencies)]:
+        print('%s: mean %.2fms, p50 %.2fms, p99 %.2fms' % (name, latencies.mean(),
+                                                          np.percentile(latencies, 50), np.percentile(latencies, 99)))
+    print('speedup: %.2fx' % (beam_latencies.mean() / greedy_latencies.mean()))
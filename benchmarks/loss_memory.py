@@ -0,0 +1,105 @@
+# coding=utf-8
+"""
+Memory benchmark of the training loss.
+
+Runs training iterations (`Parser.score`, backward and an optimizer step) at several batch
+sizes with the default loss, with `--lean_loss` and with `--lean_loss --packed_decoder`,
+each in a fresh process, and reports the peak RSS of the process and the throughput.
+
+    python -m benchmarks.loss_memory --load_model saved_models/conala/model.bin --dataset data/conala/train.gold.full.bin
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+
+from common.registerable import Registrable
+from components.dataset import Dataset
+from model.parser import Parser
+
+
+MODES = {
+    'default': dict(lean_loss=False, packed_decoder=False),
+    'lean': dict(lean_loss=True, packed_decoder=False),
+    'lean+packed': dict(lean_loss=True, packed_decoder=True),
+}
+
+
+def init_arg_parser():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--parser', type=str, default='default_parser', help='name of parser class to load')
+    arg_parser.add_argument('--load_model', type=str, required=True, help='Model to train')
+    arg_parser.add_argument('--dataset', type=str, default='data/conala/train.gold.full.bin', help='Training examples')
+    arg_parser.add_argument('--batch_sizes', type=int, nargs='+', default=[64, 128, 256], help='Batch sizes to run')
+    arg_parser.add_argument('--modes', type=str, nargs='+', default=sorted(MODES), choices=sorted(MODES),
+                            help='Loss computations to compare')
+    arg_parser.add_argument('--batch_num', type=int, default=5, help='Number of training iterations per run')
+    arg_parser.add_argument('--num_threads', type=int, default=None, help='Number of CPU threads used by torch')
+    arg_parser.add_argument('--worker', type=str, default=None, help='Run a single mode in this process (internal)')
+    arg_parser.add_argument('--worker_batch_size', type=int, default=None, help=argparse.SUPPRESS)
+
+    return arg_parser
+
+
+def peak_rss_mb():
+    # `ru_maxrss` is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def run_worker(args):
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    parser = Registrable.by_name(args.parser).load(model_path=args.load_model)
+    for key, value in MODES[args.worker].items():
+        setattr(parser.args, key, value)
+    parser.train()
+    optimizer = torch.optim.Adam(parser.parameters(), lr=0.)
+
+    examples = [e for e in Dataset.from_bin_file(args.dataset, parser.grammar).examples
+                if len(e.tgt_actions) <= parser.args.decode_max_time_step]
+    batch_size = args.worker_batch_size
+    # cycle over the dataset if it is smaller than the batches
+    examples = [examples[i % len(examples)] for i in range(batch_size * args.batch_num)]
+    batches = [sorted(examples[i: i + batch_size], key=lambda e: -len(e.src_sent))
+               for i in range(0, len(examples), batch_size)]
+
+    load_rss = peak_rss_mb()
+    begin = time.time()
+    for batch_examples in batches:
+        optimizer.zero_grad()
+        loss = -parser.score(batch_examples)[0]
+        torch.mean(loss).backward()
+        optimizer.step()
+    elapsed = time.time() - begin
+
+    print(json.dumps(dict(load_rss=load_rss, peak_rss=peak_rss_mb(),
+                          examples_per_sec=len(examples) / elapsed)))
+
+
+if __name__ == '__main__':
+    args = init_arg_parser().parse_args()
+    if args.worker:
+        run_worker(args)
+        sys.exit(0)
+
+    worker_args = ['--parser', args.parser, '--load_model', args.load_model, '--dataset', args.dataset,
+                   '--batch_num', str(args.batch_num)]
+    if args.num_threads:
+        worker_args += ['--num_threads', str(args.num_threads)]
+
+    print('%-12s %10s %14s %14s %12s' % ('mode', 'batch size', 'peak RSS (MB)', 'train (MB)', 'examples/s'))
+    for batch_size in args.batch_sizes:
+        for mode in args.modes:
+            output = subprocess.check_output([sys.executable, '-m', 'benchmarks.loss_memory'] + worker_args +
+                                             ['--worker', mode, '--worker_batch_size', str(batch_size)])
+            result = json.loads(output.decode('utf-8').strip().split('\n')[-1])
+            print('%-12s %10d %14.1f %14.1f %12.1f' % (mode, batch_size, result['peak_rss'],
+                                                        result['peak_rss'] - result['load_rss'],
+                                                        result['examples_per_sec']))
@@ -0,0 +1,89 @@
+# coding=utf-8
+"""
+Benchmark of dynamic INT8 quantization for CPU inference.
+
+Decodes each utterance of the dev set one at a time with the FP32 model and with the
+model loaded with `--quantize int8`, and reports the p50/p99 parse latency, the corpus
+BLEU and exact match of each, and how many top predictions differ between them.
+
+    python -m benchmarks.quantize --load_model saved_models/conala/model.bin --dev_file data/conala/dev.bin
+
+Quantization needs a newer torch than the pinned pytorch 1.1.0, see `nn_utils.quantize_supported`.
+"""
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from common.registerable import Registrable
+from components.dataset import Dataset
+from model import nn_utils
+from model.parser import Parser
+from datasets.conala import evaluator as conala_evaluator
+
+
+def init_arg_parser():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--parser', type=str, default='default_parser', help='name of parser class to load')
+    arg_parser.add_argument('--evaluator', type=str, default='conala_evaluator', help='name of evaluator class to use')
+    arg_parser.add_argument('--load_model', type=str, required=True, help='Model to decode with')
+    arg_parser.add_argument('--dev_file', type=str, default='data/conala/dev.bin', help='Path to the dev set')
+    arg_parser.add_argument('--beam_size', default=15, type=int, help='Beam size for beam search')
+    arg_parser.add_argument('--num_threads', type=int, default=None, help='Number of CPU threads used by torch')
+
+    return arg_parser
+
+
+def decode(parser, examples, beam_size):
+    latencies = []
+    decode_results = []
+    for example in examples:
+        begin = time.time()
+        hyps = parser.parse(example.src_sent, beam_size=beam_size)
+        latencies.append(time.time() - begin)
+
+        decoded_hyps = []
+        for hyp in hyps:
+            try:
+                hyp.code = parser.transition_system.ast_to_surface_code(hyp.tree)
+                decoded_hyps.append(hyp)
+            except:
+                pass
+        decode_results.append(decoded_hyps)
+
+    return np.array(latencies) * 1000, decode_results
+
+
+if __name__ == '__main__':
+    args = init_arg_parser().parse_args()
+    args.save_decode_to = None
+    # fail before decoding with the FP32 model
+    nn_utils.check_quantize_supported('int8')
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    dev_set = Dataset.from_bin_file(args.dev_file)
+    parser_cls = Registrable.by_name(args.parser)
+
+    top_codes = dict()
+    for quantize in [None, 'int8']:
+        parser = parser_cls.load(model_path=args.load_model, cuda=False, quantize=quantize)
+        parser.eval()
+        evaluator = Registrable.by_name(args.evaluator)(parser.transition_system, args=args)
+
+        with torch.no_grad():
+            latencies, decode_results = decode(parser, dev_set.examples, args.beam_size)
+        top_codes[quantize] = [hyps[0].code if hyps else None for hyps in decode_results]
+        eval_results = evaluator.evaluate_dataset(dev_set.examples, decode_results, args=args)
+
+        print('%s: p50 %.2fms, p99 %.2fms, corpus BLEU %.4f, exact match %.4f' % (quantize or 'fp32',
+                                                                                np.percentile(latencies, 50),
+                                                                                np.percentile(latencies, 99),
+                                                                                eval_results['corpus_bleu'],
+                                                                                eval_results['exact_match']))
+
+    changed_num = sum(code != fp32_code for code, fp32_code in zip(top_codes['int8'], top_codes[None]))
+    print('%d of %d top predictions differ from the fp32 model' % (changed_num, len(dev_set)))
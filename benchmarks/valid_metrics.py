@@ -0,0 +1,103 @@
+# coding=utf-8
+"""
+Correlation of the fast validation metrics with the full dev metric.
+
+Evaluates a series of checkpoints (e.g. saved with `--save_all_models`) with each
+`--valid_metric` of `exp.py --mode train` and on random dev subsets, and reports the time of
+each validation, the Pearson and Spearman correlation of each proxy with the full metric
+(beam search on the whole dev set), and the full score of the checkpoint each proxy selects.
+
+    python -m benchmarks.valid_metrics --dev_file data/conala/dev.bin \
+        --models saved_models/conala/model.iter*.bin --subset_sizes 100 200
+"""
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+
+import evaluation
+from common.registerable import Registrable
+from components.dataset import Dataset
+from model.parser import Parser
+from datasets.conala import evaluator as conala_evaluator
+
+
+def init_arg_parser():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--cuda', action='store_true', default=False, help='Use gpu')
+    arg_parser.add_argument('--seed', default=0, type=int, help='Random seed of the dev subsets')
+    arg_parser.add_argument('--parser', type=str, default='default_parser', help='name of parser class to load')
+    arg_parser.add_argument('--evaluator', type=str, default='conala_evaluator', help='name of evaluator class to use')
+    arg_parser.add_argument('--models', type=str, nargs='+', required=True, help='Checkpoints to validate')
+    arg_parser.add_argument('--dev_file', type=str, default='data/conala/dev.bin', help='Path to the dev set')
+    arg_parser.add_argument('--beam_size', default=15, type=int, help='Beam size for beam search')
+    arg_parser.add_argument('--batch_size', default=10, type=int, help='Batch size of the log-likelihood')
+    arg_parser.add_argument('--decode_batch_size', default=16, type=int,
+                            help='Number of utterances decoded together in one batched beam search')
+    arg_parser.add_argument('--decode_max_time_step', default=100, type=int, help='Maximum number of time steps')
+    arg_parser.add_argument('--subset_sizes', nargs='*', type=int, default=[200],
+                            help='Sizes of the random dev subsets validated with the full metric')
+
+    return arg_parser
+
+
+def rank(values):
+    # tied values get their average rank
+    values = np.asarray(values)
+    return np.array([np.mean(np.flatnonzero(np.sort(values) == value)) for value in values])
+
+
+def correlations(proxy_scores, full_scores):
+    if len(full_scores) < 2:
+        return float('nan'), float('nan')
+
+    # nan if the scores of either metric are all the same
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pearson = np.corrcoef(proxy_scores, full_scores)[0, 1]
+        spearman = np.corrcoef(rank(proxy_scores), rank(full_scores))[0, 1]
+
+    return pearson, spearman
+
+
+if __name__ == '__main__':
+    args = init_arg_parser().parse_args()
+    args.save_decode_to = None
+    args.eval_top_pred_only = False
+    args.decode_early_stop_k = 0
+    args.decode_early_stop_heuristic = False
+    args.decode_beam_margin = None
+
+    dev_set = Dataset.from_bin_file(args.dev_file)
+    proxies = [('full', 'acc', dev_set.examples), ('greedy', 'greedy', dev_set.examples),
+               ('dev_ll', 'dev_ll', dev_set.examples)]
+    for subset_size in args.subset_sizes:
+        example_ids = np.random.RandomState(args.seed).choice(len(dev_set), min(subset_size, len(dev_set)),
+                                                              replace=False)
+        proxies.append(('subset%d' % subset_size, 'acc', [dev_set.examples[i] for i in sorted(example_ids)]))
+
+    scores = {name: [] for name, _, _ in proxies}
+    times = {name: 0. for name, _, _ in proxies}
+    for model_path in args.models:
+        parser = Registrable.by_name(args.parser).load(model_path=model_path, cuda=args.cuda)
+        parser.eval()
+        for e in dev_set.examples:
+            e.resolve_schema(parser.grammar)
+        evaluator = Registrable.by_name(args.evaluator)(parser.transition_system, args=args)
+
+        for name, valid_metric, examples in proxies:
+            begin = time.time()
+            _, dev_score = evaluation.validate(examples, parser, evaluator, args, valid_metric=valid_metric)
+            times[name] += time.time() - begin
+            scores[name].append(dev_score)
+
+        print('%s: %s' % (model_path, ', '.join('%s=%.4f' % (name, scores[name][-1]) for name, _, _ in proxies)))
+
+    full_scores = scores['full']
+    print('%-12s %14s %10s %10s %16s' % ('metric', 'time/model (s)', 'pearson', 'spearman', 'selected full'))
+    for name, _, _ in proxies:
+        pearson, spearman = correlations(scores[name], full_scores)
+        selected_full = full_scores[int(np.argmax(scores[name]))]
+        print('%-12s %14.1f %10.3f %10.3f %16.4f' % (name, times[name] / len(args.models), pearson, spearman,
+                                                     selected_full))
@@ -1,5 +1,9 @@
 # coding=utf-8
 import argparse
+import resource
+import threading
+import time
+from collections import OrderedDict
 
 
 class cached_property(object):
@@ -21,6 +25,112 @@ class cached_property(object):
         return value
 
 
+class LRUCache(object):
+    """ A bounded mapping that evicts the least recently used entry when full,
+        and counts hits, misses and evictions. It is thread-safe, e.g. shared
+        by the request threads of the server.
+        """
+
+    def __init__(self, capacity):
+        assert capacity > 0
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hit_num = 0
+        self.miss_num = 0
+        self.eviction_num = 0
+
+    def get(self, key):
+        """return the cached value, or None if `key` is not cached"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hit_num += 1
+
+                return self._entries[key]
+
+            self.miss_num += 1
+
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self._entries.pop(key)
+            elif len(self._entries) >= self.capacity:
+                self._entries.popitem(last=False)
+                self.eviction_num += 1
+
+            self._entries[key] = value
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return dict(size=len(self), capacity=self.capacity,
+                        hits=self.hit_num, misses=self.miss_num, evictions=self.eviction_num)
+
+
+class PhaseTimer(object):
+    """ Accumulates the wall-clock time of the consecutive phases of a loop, e.g.
+
+            timer.switch('backward')
+            loss.backward()
+            timer.switch('optimizer step')
+            optimizer.step()
+            timer.stop()
+
+        With `cuda`, the GPU is synchronized at the phase boundaries so that
+        the times are not attributed to the phase that waits for the kernels.
+        """
+
+    def __init__(self, enabled=True, cuda=False):
+        self.enabled = enabled
+        self.cuda = cuda
+        self.times = OrderedDict()
+
+        self.phase = None
+        self.phase_begin = None
+
+    def _now(self):
+        if self.cuda:
+            import torch
+            torch.cuda.synchronize()
+
+        return time.time()
+
+    def switch(self, phase):
+        """end the current phase, and begin `phase` if it is not None"""
+        if not self.enabled:
+            return
+
+        now = self._now()
+        if self.phase is not None:
+            self.add(self.phase, now - self.phase_begin)
+
+        self.phase = phase
+        self.phase_begin = now
+
+    def stop(self):
+        self.switch(None)
+
+    def add(self, phase, seconds):
+        self.times[phase] = self.times.get(phase, 0.) + seconds
+
+
+def peak_memory_mb(cuda=False):
+    """peak GPU memory allocated by torch with `cuda`, otherwise the peak resident set size of the process"""
+    if cuda:
+        import torch
+        return torch.cuda.max_memory_allocated() / 1024. ** 2
+
+    # `ru_maxrss` is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
 def init_arg_parser():
     arg_parser = argparse.ArgumentParser()
 
@@ -85,6 +195,34 @@ def init_arg_parser():
     arg_parser.add_argument('--pretrain', type=str, help='path to the pretrained model file')
 
     arg_parser.add_argument('--batch_size', default=10, type=int, help='Batch size')
+    arg_parser.add_argument('--bucket_batches', default=False, action='store_true',
+                            help='Batch together training examples of similar target action and source lengths')
+    arg_parser.add_argument('--bucket_pool_batches', default=100, type=int,
+                            help='With --bucket_batches, sort the shuffled examples by length within pools of this '
+                                 'many batches')
+    arg_parser.add_argument('--prefetch_batches', default=2, type=int,
+                            help='Number of training batches built ahead in a background thread, 0 to build them '
+                                 'in the training loop')
+    arg_parser.add_argument('--max_batch_tokens', default=None, type=int,
+                            help='Maximum number of padded target actions (longest action sequence x batch size) '
+                                 'in a training batch, in addition to --batch_size')
+    arg_parser.add_argument('--packed_decoder', default=False, action='store_true',
+                            help='When computing the training loss, only run the decoder on the examples whose '
+                                 'action sequences are not finished at each time step (not used with --sup_attention)')
+    arg_parser.add_argument('--lean_loss', default=False, action='store_true',
+                            help='Compute the training loss from the readout logits and the index lists of copy '
+                                 'targets, without the probability tensors over the grammar and the vocabulary')
+    arg_parser.add_argument('--num_processes', default=1, type=int,
+                            help='Number of local processes of data-parallel training on CPU, each trains on a shard '
+                                 'of the batches of an epoch, so the effective batch size is batch_size * num_processes')
+    arg_parser.add_argument('--num_threads_per_process', default=None, type=int,
+                            help='Number of CPU threads used by torch in each data-parallel training process, '
+                                 'by default the CPU cores are divided evenly between the processes')
+    arg_parser.add_argument('--dist_init_method', default='tcp://127.0.0.1:29500', type=str,
+                            help='URL to set up the process group of data-parallel training')
+    arg_parser.add_argument('--dist_timeout', default=24 * 60, type=int,
+                            help='Timeout in minutes of the collective operations of data-parallel training, the '
+                                 'other processes wait for the first one in them while it validates the model')
     arg_parser.add_argument('--dropout', default=0., type=float, help='Dropout rate')
     arg_parser.add_argument('--word_dropout', default=0., type=float, help='Word dropout rate')
     arg_parser.add_argument('--decoder_word_dropout', default=0.3, type=float, help='Word dropout rate on decoder')
@@ -96,10 +234,21 @@ def init_arg_parser():
     arg_parser.add_argument('--negative_sample_type', default='best', type=str, choices=['best', 'sample', 'all'])
 
     # training schedule details
-    arg_parser.add_argument('--valid_metric', default='acc', choices=['acc'],
-                            help='Metric used for validation')
+    arg_parser.add_argument('--valid_metric', default='acc', choices=['acc', 'greedy', 'dev_ll'],
+                            help='Metric used for validation: the default metric of the evaluator with beam search '
+                                 '(acc) or greedy decoding (greedy), or the teacher-forced log-likelihood (dev_ll)')
+    arg_parser.add_argument('--valid_subset_size', default=None, type=int,
+                            help='Validate on a fixed random subset of this many dev examples')
     arg_parser.add_argument('--valid_every_epoch', default=1, type=int, help='Perform validation every x epoch')
+    arg_parser.add_argument('--async_validation', default=False, action='store_true',
+                            help='Validate snapshots of the model in a separate process while training continues, '
+                                 'patience and learning rate decay react to the results when they arrive')
+    arg_parser.add_argument('--valid_num_threads', default=None, type=int,
+                            help='Number of CPU threads used by torch in the asynchronous validation process')
     arg_parser.add_argument('--log_every', default=10, type=int, help='Log training statistics every n iterations')
+    arg_parser.add_argument('--metrics_file', default=None, type=str,
+                            help='Append the training throughput, time breakdown and peak memory of each logging '
+                                 'interval and epoch to this file as JSON lines')
 
     arg_parser.add_argument('--save_to', default='model', type=str, help='Save trained model to')
     arg_parser.add_argument('--save_all_models', default=False, action='store_true', help='Save all intermediate checkpoints')
@@ -124,8 +273,21 @@ def init_arg_parser():
     #### decoding/validation/testing ####
     arg_parser.add_argument('--load_model', default=None, type=str, help='Load a pre-trained model')
     arg_parser.add_argument('--beam_size', default=5, type=int, help='Beam size for beam search')
+    arg_parser.add_argument('--decode_batch_size', default=16, type=int,
+                            help='Number of utterances decoded together in one batched beam search')
     arg_parser.add_argument('--decode_max_time_step', default=100, type=int, help='Maximum number of time steps used '
                                                                                   'in decoding and sampling')
+    arg_parser.add_argument('--decode_early_stop_k', default=0, type=int,
+                            help='Stop the beam search of an utterance once no live hypothesis could beat its k-th best '
+                                 'completed hypothesis, the top k results are unchanged. 0 to disable')
+    arg_parser.add_argument('--decode_early_stop_heuristic', default=False, action='store_true',
+                            help='With --decode_early_stop_k, stop once no live hypothesis has a higher length-normalized '
+                                 'score so far than the k-th best completed hypothesis. Lossy: the top k results may change')
+    arg_parser.add_argument('--decode_beam_margin', default=None, type=float,
+                            help='Prune live hypotheses whose scores are lower than the best one by more than this margin')
+    arg_parser.add_argument('--quantize', choices=['int8'], default=None,
+                            help='Load models with dynamically quantized LSTM and linear layers for CPU inference, '
+                                 'needs a newer torch than pytorch 1.1.0')
     arg_parser.add_argument('--sample_size', default=5, type=int, help='Sample size')
     arg_parser.add_argument('--test_file', type=str, help='Path to the test file')
     arg_parser.add_argument('--save_decode_to', default=None, type=str, help='Save decoding results to file')
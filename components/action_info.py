@@ -1,10 +1,14 @@
 # coding=utf-8
 from asdl.hypothesis import Hypothesis
 from asdl.transition_system import ApplyRuleAction, GenTokenAction
+from asdl.utils import SlottedObject
 
 
-class ActionInfo(object):
+class ActionInfo(SlottedObject):
     """sufficient statistics for making a prediction of an action at a time step"""
+    # the statistics recorded when decoding with `debug`, e.g. `action_prob`, are kept in `__dict__`
+    __slots__ = ('t', 'parent_t', 'action', 'frontier_prod', 'frontier_field', 'copy_from_src',
+                 'src_token_position', '__dict__')
 
     def __init__(self, action=None):
         self.t = 0
@@ -17,6 +21,15 @@ class ActionInfo(object):
         self.copy_from_src = False
         self.src_token_position = -1
 
+    def resolve_schema(self, grammar):
+        """replace the production, frontier production and field by those of `grammar`, see `ASDLGrammar.resolve`"""
+        if isinstance(self.action, ApplyRuleAction):
+            # also the flyweight action, for action infos pickled before them
+            self.action = ApplyRuleAction(grammar.resolve(self.action.production))
+        if self.frontier_prod is not None:
+            self.frontier_prod = grammar.resolve(self.frontier_prod)
+            self.frontier_field = grammar.resolve(self.frontier_field)
+
     def __repr__(self, verbose=False):
         repr_str = '%s (t=%d, p_t=%d, frontier_field=%s)' % (repr(self.action),
                                                          self.t,
@@ -41,7 +54,7 @@ class ActionInfo(object):
 
 def get_action_infos(src_query, tgt_actions, force_copy=False):
     action_infos = []
-    hyp = Hypothesis()
+    hyp = Hypothesis(use_frontier_stack=True)
     for t, action in enumerate(tgt_actions):
         action_info = ActionInfo(action)
         action_info.t = t
@@ -62,3 +75,34 @@ def get_action_infos(src_query, tgt_actions, force_copy=False):
         action_infos.append(action_info)
 
     return action_infos
+
+
+def get_action_infos_from_ast(src_query, tgt_ast, transition_system, force_copy=False):
+    """the actions of `tgt_ast` and their action infos as `get_action_infos`, without replaying the actions"""
+    grammar = transition_system.grammar
+    tgt_actions, parent_t, frontier_prod_ids, frontier_field_ids, src_token_positions = \
+        transition_system.get_action_oracle(tgt_ast, src_query)
+
+    action_infos = []
+    for t, (action, p_t, prod_id, field_id, tok_src_idx) in enumerate(zip(tgt_actions,
+                                                                           parent_t.tolist(),
+                                                                           frontier_prod_ids.tolist(),
+                                                                           frontier_field_ids.tolist(),
+                                                                           src_token_positions.tolist())):
+        action_info = ActionInfo(action)
+        action_info.t = t
+        if t > 0:
+            action_info.parent_t = p_t
+            action_info.frontier_prod = grammar.id2prod[prod_id]
+            action_info.frontier_field = grammar.id2field[field_id]
+
+        if isinstance(action, GenTokenAction):
+            if tok_src_idx >= 0:
+                action_info.copy_from_src = True
+                action_info.src_token_position = tok_src_idx
+            elif force_copy:
+                raise ValueError('cannot copy primitive token %s from source' % action.token)
+
+        action_infos.append(action_info)
+
+    return tgt_actions, action_infos
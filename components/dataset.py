@@ -1,8 +1,11 @@
 # coding=utf-8
 from collections import OrderedDict
+import threading
+import time
 
 import torch
 import numpy as np
+from six.moves import queue
 try:
     import cPickle as pickle
 except:
@@ -29,23 +32,99 @@ class Dataset(object):
         return [e.tgt_code for e in self.examples]
 
     @staticmethod
-    def from_bin_file(file_path):
+    def from_bin_file(file_path, grammar=None):
+        """
+        Load pickled examples. With `grammar`, their trees and action infos are resolved to the schema
+        objects of the grammar, which datasets pickled before interning need to get the ids of their
+        productions and fields, see `ASDLGrammar.resolve`
+        """
         examples = pickle.load(open(file_path, 'rb'))
+        if grammar is not None:
+            for e in examples:
+                e.resolve_schema(grammar)
+
         return Dataset(examples)
 
-    def batch_iter(self, batch_size, shuffle=False):
+    def tensorize(self, grammar, vocab):
+        """compute the index arrays of the target actions once, they are reused by every `Batch` of the examples"""
+        for e in self.examples:
+            e.tensors = ExampleTensors(e, grammar, vocab)
+
+    def clear_tensors(self):
+        for e in self.examples:
+            e.tensors = None
+
+    def batch_iter(self, batch_size, shuffle=False, bucket=False, bucket_pool=100, max_tokens=None, seed=None,
+                   num_shards=1, shard_id=0):
+        """Iterate over batches of examples, each batch is sorted by descending source length
+
+        Args:
+            batch_size: maximum number of examples in a batch
+            shuffle: shuffle the examples, and the order of the batches if `bucket`
+            bucket: batch together examples of similar target action and source lengths to reduce padding.
+                With `shuffle`, examples are sorted by length within pools of `bucket_pool * batch_size`
+                consecutive examples of the shuffled order, so that batches are made of different
+                examples for different seeds
+            max_tokens: if set, the padded number of target actions of a batch
+                (longest action sequence times batch size) does not exceed `max_tokens`
+            seed: seed of the shuffle, the global NumPy random state is used if None
+            num_shards, shard_id: iterate over every `num_shards`-th batch starting from `shard_id`, for
+                data-parallel training. All shards have the same number of batches (the last
+                `len(batches) % num_shards` batches are dropped), they need the same `seed` to be disjoint
+        """
+        rng = np.random if seed is None else np.random.RandomState(seed)
+
         index_arr = np.arange(len(self.examples))
         if shuffle:
-            np.random.shuffle(index_arr)
-
-        batch_num = int(np.ceil(len(self.examples) / float(batch_size)))
-        for batch_id in range(batch_num):
-            batch_ids = index_arr[batch_size * batch_id: batch_size * (batch_id + 1)]
+            rng.shuffle(index_arr)
+
+        action_lens = np.array([len(e.tgt_actions) if e.tgt_actions else 0 for e in self.examples], dtype='int64')
+        pools = [index_arr]
+        if bucket:
+            src_lens = np.array([len(e.src_sent) for e in self.examples], dtype='int64')
+            pool_size = batch_size * bucket_pool if shuffle else len(index_arr)
+            pools = [index_arr[i: i + pool_size] for i in range(0, len(index_arr), pool_size)]
+            # the sort is stable, examples of the same lengths stay shuffled
+            pools = [pool[np.lexsort((src_lens[pool], action_lens[pool]))] for pool in pools]
+
+        batches = []
+        for pool in pools:
+            # batches do not span pools, whose examples are sorted separately
+            batch_ids = []
+            batch_max_action_len = 0
+            for i in pool:
+                max_action_len = max(batch_max_action_len, action_lens[i])
+                if batch_ids and (len(batch_ids) == batch_size or
+                                  max_tokens and max_action_len * (len(batch_ids) + 1) > max_tokens):
+                    batches.append(batch_ids)
+                    batch_ids = []
+                    max_action_len = action_lens[i]
+
+                batch_ids.append(i)
+                batch_max_action_len = max_action_len
+
+            if batch_ids:
+                batches.append(batch_ids)
+
+        if bucket and shuffle:
+            rng.shuffle(batches)
+
+        if num_shards > 1:
+            batches = batches[shard_id: len(batches) - len(batches) % num_shards: num_shards]
+
+        for batch_ids in batches:
             batch_examples = [self.examples[i] for i in batch_ids]
             batch_examples.sort(key=lambda e: -len(e.src_sent))
 
             yield batch_examples
 
+    @staticmethod
+    def get_padding_stats(batch_examples):
+        """number of target actions of the examples, and number of decoding steps including the padding"""
+        action_lens = [len(e.tgt_actions) for e in batch_examples]
+
+        return sum(action_lens), max(action_lens) * len(action_lens) if action_lens else 0
+
     def __len__(self):
         return len(self.examples)
 
@@ -63,6 +142,107 @@ class Example(object):
         self.idx = idx
         self.meta = meta
 
+    def resolve_schema(self, grammar):
+        """replace the schema objects of the target tree and actions by those of `grammar`"""
+        if self.tgt_ast is not None:
+            self.tgt_ast.resolve_schema(grammar)
+        for action_info in self.tgt_actions or []:
+            action_info.resolve_schema(grammar)
+
+    def __getstate__(self):
+        # index arrays are tied to a grammar and a vocabulary, do not pickle them
+        state = dict(self.__dict__)
+        state.pop('tensors', None)
+
+        return state
+
+
+class ExampleTensors(object):
+    """Index arrays of the target action sequence of an example, computed once and
+    padded into the tensors of a `Batch` with NumPy
+
+    Attributes:
+        action_type: (tgt_action_len,) `APPLY_RULE`, `REDUCE` or `GEN_TOKEN`
+        rule_idx: (tgt_action_len,) id of the production, `len(grammar)` for Reduce actions, 0 otherwise
+        token_idx: (tgt_action_len,) primitive vocabulary id of the GenToken actions, 0 otherwise
+        frontier_prod_idx, frontier_field_idx, frontier_field_type_idx: (tgt_action_len,) ids of the
+            frontier production, field and field type, 0 for the first action
+        parent_t: (tgt_action_len,) time step of the parent action
+        copy_ptr, copy_pos: source positions that the token of action t can be copied from are
+            `copy_pos[copy_ptr[t]: copy_ptr[t + 1]]` (CSR format)
+        copy_marked: whether the action infos of the tokens found in the source are marked as copied
+            from there, which `Batch` checks when copying is enabled
+    """
+
+    APPLY_RULE = 0
+    REDUCE = 1
+    GEN_TOKEN = 2
+
+    def __init__(self, example, grammar, vocab):
+        self.grammar = grammar
+        self.vocab = vocab
+        src_sent = example.src_sent
+
+        # one row of (action_type, rule_idx, token_idx, frontier_prod_idx, frontier_field_idx,
+        # frontier_field_type_idx, parent_t) per action
+        rows = []
+        copy_ptr = [0]
+        copy_pos = []
+        copy_marked = True
+
+        for action_info in example.tgt_actions:
+            action = action_info.action
+            rule_idx = token_idx = 0
+
+            if isinstance(action, ApplyRuleAction):
+                action_type = ExampleTensors.APPLY_RULE
+                rule_idx = action.production.id
+            elif isinstance(action, ReduceAction):
+                action_type = ExampleTensors.REDUCE
+                rule_idx = len(grammar)
+            else:
+                action_type = ExampleTensors.GEN_TOKEN
+                token_idx = vocab.primitive[action.token]
+
+                token = str(action.token)
+                if token in src_sent:
+                    token_pos_list = [idx for idx, _token in enumerate(src_sent) if _token == token]
+                    copy_pos.extend(token_pos_list)
+                    if not action_info.copy_from_src or action_info.src_token_position not in token_pos_list:
+                        copy_marked = False
+
+            copy_ptr.append(len(copy_pos))
+
+            if action_info.frontier_prod:
+                rows.append((action_type, rule_idx, token_idx,
+                             action_info.frontier_prod.id,
+                             action_info.frontier_field.id,
+                             action_info.frontier_field.type.id,
+                             action_info.parent_t))
+            else:
+                rows.append((action_type, rule_idx, token_idx, 0, 0, 0, 0))
+
+        columns = np.array(rows, dtype='int64').reshape(-1, 7).T
+        self.action_type, self.rule_idx, self.token_idx, \
+            self.frontier_prod_idx, self.frontier_field_idx, self.frontier_field_type_idx, \
+            self.parent_t = columns
+        self.copy_ptr = np.array(copy_ptr, dtype='int64')
+        self.copy_pos = np.array(copy_pos, dtype='int64')
+        self.copy_marked = copy_marked
+
+    def __len__(self):
+        return len(self.action_type)
+
+
+def get_example_tensors(example, grammar, vocab):
+    """index arrays of the example computed by `Dataset.tensorize` or by a previous `Batch`,
+    recompute them if they belong to another grammar or vocabulary"""
+    e_tensors = getattr(example, 'tensors', None)
+    if e_tensors is None or e_tensors.grammar is not grammar or e_tensors.vocab is not vocab:
+        e_tensors = example.tensors = ExampleTensors(example, grammar, vocab)
+
+    return e_tensors
+
 
 class Batch(object):
     def __init__(self, examples, grammar, vocab, copy=True, cuda=False):
@@ -83,123 +263,113 @@ class Batch(object):
         return len(self.examples)
 
     def get_frontier_field_idx(self, t):
-        ids = []
-        for e in self.examples:
-            if t < len(e.tgt_actions):
-                ids.append(self.grammar.field2id[e.tgt_actions[t].frontier_field])
-                # assert self.grammar.id2field[ids[-1]] == e.tgt_actions[t].frontier_field
-            else:
-                ids.append(0)
-
-        return Variable(torch.cuda.LongTensor(ids)) if self.cuda else Variable(torch.LongTensor(ids))
+        return self.frontier_field_idx_matrix[t]
 
     def get_frontier_prod_idx(self, t):
-        ids = []
-        for e in self.examples:
-            if t < len(e.tgt_actions):
-                ids.append(self.grammar.prod2id[e.tgt_actions[t].frontier_prod])
-                # assert self.grammar.id2prod[ids[-1]] == e.tgt_actions[t].frontier_prod
-            else:
-                ids.append(0)
-
-        return Variable(torch.cuda.LongTensor(ids)) if self.cuda else Variable(torch.LongTensor(ids))
+        return self.frontier_prod_idx_matrix[t]
 
     def get_frontier_field_type_idx(self, t):
-        ids = []
-        for e in self.examples:
-            if t < len(e.tgt_actions):
-                ids.append(self.grammar.type2id[e.tgt_actions[t].frontier_field.type])
-                # assert self.grammar.id2type[ids[-1]] == e.tgt_actions[t].frontier_field.type
-            else:
-                ids.append(0)
-
-        return Variable(torch.cuda.LongTensor(ids)) if self.cuda else Variable(torch.LongTensor(ids))
+        return self.frontier_field_type_idx_matrix[t]
 
     def init_index_tensors(self):
-        self.apply_rule_idx_matrix = []
-        self.apply_rule_mask = []
-        self.primitive_idx_matrix = []
-        self.gen_token_mask = []
-        self.primitive_copy_mask = []
-        self.primitive_copy_token_idx_mask = np.zeros((self.max_action_num, len(self), max(self.src_sents_len)), dtype='float32')
-
-        for t in range(self.max_action_num):
-            app_rule_idx_row = []
-            app_rule_mask_row = []
-            token_row = []
-            gen_token_mask_row = []
-            copy_mask_row = []
-
-            for e_id, e in enumerate(self.examples):
-                app_rule_idx = app_rule_mask = token_idx = gen_token_mask = copy_mask = 0
-                if t < len(e.tgt_actions):
-                    action = e.tgt_actions[t].action
-                    action_info = e.tgt_actions[t]
-
-                    if isinstance(action, ApplyRuleAction):
-                        app_rule_idx = self.grammar.prod2id[action.production]
-                        # assert self.grammar.id2prod[app_rule_idx] == action.production
-                        app_rule_mask = 1
-                    elif isinstance(action, ReduceAction):
-                        app_rule_idx = len(self.grammar)
-                        app_rule_mask = 1
-                    else:
-                        src_sent = self.src_sents[e_id]
-                        token = str(action.token)
-                        token_idx = self.vocab.primitive[action.token]
-
-                        token_can_copy = False
-
-                        if self.copy and token in src_sent:
-                            token_pos_list = [idx for idx, _token in enumerate(src_sent) if _token == token]
-                            self.primitive_copy_token_idx_mask[t, e_id, token_pos_list] = 1.
-                            copy_mask = 1
-                            token_can_copy = True
-
-                        if token_can_copy is False or token_idx != self.vocab.primitive.unk_id:
-                            # if the token is not copied, we can only generate this token from the vocabulary,
-                            # even if it is a <unk>.
-                            # otherwise, we can still generate it from the vocabulary
-                            gen_token_mask = 1
-
-                        if token_can_copy:
-                            assert action_info.copy_from_src
-                            assert action_info.src_token_position in token_pos_list
-
-                        # # cannot copy, only generation
-                        # # could be unk!
-                        # if not action_info.copy_from_src:
-                        #     gen_token_mask = 1
-                        # else:  # copy
-                        #     copy_mask = 1
-                        #     copy_pos = action_info.src_token_position
-                        #     if token_idx != self.vocab.primitive.unk_id:
-                        #         # both copy and generate from vocabulary
-                        #         gen_token_mask = 1
-
-                app_rule_idx_row.append(app_rule_idx)
-                app_rule_mask_row.append(app_rule_mask)
-
-                token_row.append(token_idx)
-                gen_token_mask_row.append(gen_token_mask)
-                copy_mask_row.append(copy_mask)
-
-            self.apply_rule_idx_matrix.append(app_rule_idx_row)
-            self.apply_rule_mask.append(app_rule_mask_row)
-
-            self.primitive_idx_matrix.append(token_row)
-            self.gen_token_mask.append(gen_token_mask_row)
-
-            self.primitive_copy_mask.append(copy_mask_row)
-
-        T = torch.cuda if self.cuda else torch
-        self.apply_rule_idx_matrix = Variable(T.LongTensor(self.apply_rule_idx_matrix))
-        self.apply_rule_mask = Variable(T.FloatTensor(self.apply_rule_mask))
-        self.primitive_idx_matrix = Variable(T.LongTensor(self.primitive_idx_matrix))
-        self.gen_token_mask = Variable(T.FloatTensor(self.gen_token_mask))
-        self.primitive_copy_mask = Variable(T.FloatTensor(self.primitive_copy_mask))
-        self.primitive_copy_token_idx_mask = Variable(torch.from_numpy(self.primitive_copy_token_idx_mask))
-        if self.cuda: self.primitive_copy_token_idx_mask = self.primitive_copy_token_idx_mask.cuda()
+        example_tensors = [get_example_tensors(e, self.grammar, self.vocab) for e in self.examples]
+
+        T, B = self.max_action_num, len(self)
+
+        def _pad(name):
+            # (tgt_action_len, batch_size)
+            matrix = np.zeros((T, B), dtype='int64')
+            for e_id, e_tensors in enumerate(example_tensors):
+                matrix[:len(e_tensors), e_id] = getattr(e_tensors, name)
+
+            return matrix
+
+        action_type = _pad('action_type')
+        action_lens = np.array([len(e_tensors) for e_tensors in example_tensors])
+        # (tgt_action_len, batch_size), 1 for the actions, 0 for the padding
+        action_mask = np.arange(T)[:, None] < action_lens[None, :]
+
+        apply_rule_mask = action_mask & (action_type != ExampleTensors.GEN_TOKEN)
+        gen_token = action_mask & (action_type == ExampleTensors.GEN_TOKEN)
+        rule_idx = _pad('rule_idx')
+        token_idx = _pad('token_idx')
+
+        # source positions that the target tokens can be copied from, as index lists: the token of action
+        # `copy_t_ids[i]` of example `copy_example_ids[i]` can be copied from source position `copy_pos[i]`
+        if self.copy:
+            assert all(e_tensors.copy_marked for e_tensors in example_tensors)
+            copy_t_ids = np.concatenate([np.repeat(np.arange(len(e_tensors)), np.diff(e_tensors.copy_ptr))
+                                         for e_tensors in example_tensors])
+            copy_example_ids = np.concatenate([np.full(len(e_tensors.copy_pos), e_id, dtype='int64')
+                                               for e_id, e_tensors in enumerate(example_tensors)])
+            copy_pos = np.concatenate([e_tensors.copy_pos for e_tensors in example_tensors])
+        else:
+            copy_t_ids = copy_example_ids = copy_pos = np.zeros(0, dtype='int64')
+
+        copy_mask = np.zeros((T, B), dtype=bool)
+        copy_mask[copy_t_ids, copy_example_ids] = True
+
+        # if the token is not copied, we can only generate this token from the vocabulary,
+        # even if it is a <unk>. otherwise, we can still generate it from the vocabulary
+        gen_token_mask = gen_token & (~copy_mask | (token_idx != self.vocab.primitive.unk_id))
+
+        def _long(matrix):
+            tensor = torch.from_numpy(matrix)
+            return Variable(tensor.cuda() if self.cuda else tensor)
+
+        def _float(matrix):
+            tensor = torch.from_numpy(matrix.astype('float32', copy=False))
+            return Variable(tensor.cuda() if self.cuda else tensor)
+
+        self.apply_rule_idx_matrix = _long(rule_idx)
+        self.apply_rule_mask = _float(apply_rule_mask)
+        self.primitive_idx_matrix = _long(token_idx)
+        self.gen_token_mask = _float(gen_token_mask)
+        self.primitive_copy_mask = _float(copy_mask)
+
+        # previous actions indexed into the concatenation of the production embeddings (including Reduce),
+        # the primitive embeddings and a zero embedding for the padding, the first row is never used
+        # (tgt_action_len, batch_size)
+        prev_action_idx = np.where(action_type == ExampleTensors.GEN_TOKEN,
+                                   token_idx + len(self.grammar) + 1, rule_idx)
+        prev_action_idx_matrix = np.full((T, B), len(self.grammar) + 1 + len(self.vocab.primitive), dtype='int64')
+        prev_action_idx_matrix[1:][action_mask[1:]] = prev_action_idx[:-1][action_mask[1:]]
+        self.prev_action_idx_matrix = _long(prev_action_idx_matrix)
+
+        # packed layout used by `Parser.decode_packed`: examples ordered by descending action sequence length,
+        # time step t decodes the first `packed_batch_sizes[t]` of them. The packed actions are ordered by time
+        # step, `packed_t_ids` and `packed_example_ids` are their positions in the (tgt_action_len, batch_size)
+        # matrices
+        packed_example_order = np.argsort(-action_lens, kind='stable')
+        self.packed_batch_sizes = [int(n) for n in action_mask.sum(axis=1)]
+        self.packed_example_order = _long(packed_example_order)
+        packed_t_ids = np.repeat(np.arange(T), self.packed_batch_sizes)
+        packed_example_ids = np.concatenate([packed_example_order[:n] for n in self.packed_batch_sizes])
+        self.packed_t_ids = _long(packed_t_ids)
+        self.packed_example_ids = _long(packed_example_ids)
+
+        # copy targets as index lists, the entries of `copy_token_flat_ids` are positions in the flattened
+        # (tgt_action_len, batch_size) matrices, those of `copy_token_packed_ids` are positions in the packed layout
+        self._copy_token_ids = (copy_t_ids, copy_example_ids, copy_pos)
+        packed_ids = np.zeros((T, B), dtype='int64')
+        packed_ids[packed_t_ids, packed_example_ids] = np.arange(len(packed_t_ids))
+        self.copy_token_flat_ids = _long(copy_t_ids * B + copy_example_ids)
+        self.copy_token_packed_ids = _long(packed_ids[copy_t_ids, copy_example_ids])
+        self.copy_token_pos = _long(copy_pos)
+
+        self.frontier_prod_idx_matrix = _long(_pad('frontier_prod_idx'))
+        self.frontier_field_idx_matrix = _long(_pad('frontier_field_idx'))
+        self.frontier_field_type_idx_matrix = _long(_pad('frontier_field_type_idx'))
+        self.parent_t_matrix = _long(_pad('parent_t'))
+
+    @cached_property
+    def primitive_copy_token_idx_mask(self):
+        # (tgt_action_len, batch_size, src_sent_len), 1 for the source positions the target tokens can be copied from
+        mask = np.zeros((self.max_action_num, len(self), max(self.src_sents_len)), dtype='float32')
+        mask[self._copy_token_ids] = 1.
+        mask = Variable(torch.from_numpy(mask))
+
+        return mask.cuda() if self.cuda else mask
 
     @property
     def primitive_mask(self):
@@ -226,3 +396,86 @@ class Batch(object):
                 aggregated_primitive_tokens.setdefault(token, []).append(token_pos)
 
 
+class BatchPrefetcher(object):
+    """Build batches in a background thread, at most `prefetch_num` batches ahead of the training loop
+
+    Batches are yielded in the order of `batches_examples`, which is read in full beforehand so that
+    the shuffle of `Dataset.batch_iter` draws its random numbers in the main thread. The thread is
+    stopped when the iteration ends, including when the training loop exits early.
+
+    Args:
+        batches_examples: iterable of lists of examples
+        build_batch: function building a batch from a list of examples
+        prefetch_num: size of the queue of built batches, build batches in the main thread if 0
+    """
+
+    _END = object()
+
+    def __init__(self, batches_examples, build_batch, prefetch_num=2):
+        self.batches_examples = list(batches_examples)
+        self.build_batch = build_batch
+        self.prefetch_num = prefetch_num
+
+        # time the training loop spent waiting for the next batch
+        self.wait_time = 0.
+
+        self._queue = None
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def _put(self, item):
+        while not self._stop_event.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def _run(self):
+        try:
+            for batch_examples in self.batches_examples:
+                if not self._put(self.build_batch(batch_examples)):
+                    return
+        except Exception as e:
+            self._put(e)
+            return
+
+        self._put(BatchPrefetcher._END)
+
+    def __iter__(self):
+        if self.prefetch_num <= 0:
+            for batch_examples in self.batches_examples:
+                begin = time.time()
+                batch = self.build_batch(batch_examples)
+                self.wait_time += time.time() - begin
+                yield batch
+
+            return
+
+        self._queue = queue.Queue(maxsize=self.prefetch_num)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+        try:
+            while True:
+                begin = time.time()
+                item = self._queue.get()
+                self.wait_time += time.time() - begin
+
+                if item is BatchPrefetcher._END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -1,13 +1,14 @@
 # coding=utf-8
 
 from asdl.asdl import *
-from asdl.hypothesis import Hypothesis
+from asdl.asdl_ast import AbstractSyntaxTree
+from asdl.hypothesis import Hypothesis, apply_frontier_stack_action
 from asdl.transition_system import *
 
 
 class DecodeHypothesis(Hypothesis):
-    def __init__(self):
-        super(DecodeHypothesis, self).__init__()
+    def __init__(self, use_frontier_stack=False):
+        super(DecodeHypothesis, self).__init__(use_frontier_stack=use_frontier_stack)
 
         self.action_infos = []
         self.code = None
@@ -21,7 +22,7 @@ class DecodeHypothesis(Hypothesis):
         return new_hyp
 
     def copy(self):
-        new_hyp = DecodeHypothesis()
+        new_hyp = DecodeHypothesis(use_frontier_stack=self.use_frontier_stack)
         if self.tree:
             new_hyp.tree = self.tree.copy()
 
@@ -32,6 +33,95 @@ class DecodeHypothesis(Hypothesis):
         new_hyp.t = self.t
         new_hyp.code = self.code
 
+        if new_hyp.use_frontier_stack:
+            new_hyp._rebuild_frontier_stack()
         new_hyp.update_frontier_info()
 
         return new_hyp
+
+
+class PersistentDecodeHypothesis(object):
+    """
+    A partial hypothesis used in beam search, stored as a log of actions.
+
+    Expanding a hypothesis never copies it: the new hypothesis only records the applied
+    action and a pointer to the hypothesis it was expanded from, so hypotheses in the beam
+    share their common prefixes. The frontier is tracked with the persistent stack of
+    pending (node, field) pairs of `apply_frontier_stack_action`, with the same transition
+    rules as `Hypothesis.apply_action`. Frontier nodes are unfilled
+    `AbstractSyntaxTree` skeletons, only their `production` and `created_time` are used.
+
+    The AST is not built during search. Call `to_decode_hypothesis()` on completed
+    hypotheses to materialize a `DecodeHypothesis` with its tree.
+    """
+    def __init__(self):
+        self.prev_hyp = None
+        self.action_info = None
+        self.score = 0.
+        self.t = 0
+
+        # linked list of pending (node, field, rest) triples, the frontier is on the top
+        self._frontier_stack = None
+        # tokens of a string value are generated, the value itself is only built by `to_decode_hypothesis()`
+        self.has_value_buffer = False
+
+    @property
+    def frontier_node(self):
+        return self._frontier_stack[0] if self._frontier_stack else None
+
+    @property
+    def frontier_field(self):
+        return self._frontier_stack[1] if self._frontier_stack else None
+
+    @property
+    def completed(self):
+        return self.t > 0 and self._frontier_stack is None
+
+    @property
+    def action_infos(self):
+        action_infos = []
+        hyp = self
+        while hyp.action_info is not None:
+            action_infos.append(hyp.action_info)
+            hyp = hyp.prev_hyp
+
+        return action_infos[::-1]
+
+    @property
+    def actions(self):
+        return [action_info.action for action_info in self.action_infos]
+
+    def clone_and_apply_action_info(self, action_info):
+        action = action_info.action
+
+        new_hyp = PersistentDecodeHypothesis()
+        new_hyp.prev_hyp = self
+        new_hyp.action_info = action_info
+        new_hyp.score = self.score
+        new_hyp.t = self.t + 1
+        new_hyp.has_value_buffer = self.has_value_buffer
+
+        # the frontier transition of `Hypothesis`, on skeleton nodes
+        node = None
+        if isinstance(action, ApplyRuleAction):
+            node = AbstractSyntaxTree(action.production)
+            node.created_time = self.t
+        frontier_field = self.frontier_field
+        new_hyp._frontier_stack, _ = apply_frontier_stack_action(self._frontier_stack, action, node)
+
+        # tokens of a string value are generated until </primitive>
+        if isinstance(action, GenTokenAction) and frontier_field.type.name == 'string':
+            new_hyp.has_value_buffer = not action.is_stop_signal()
+
+        return new_hyp
+
+    def to_decode_hypothesis(self):
+        """replay the action log to build a `DecodeHypothesis` with its AST"""
+        hyp = DecodeHypothesis(use_frontier_stack=True)
+        for action_info in self.action_infos:
+            hyp.apply_action(action_info.action)
+            hyp.action_infos.append(action_info)
+
+        hyp.score = self.score
+
+        return hyp
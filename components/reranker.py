@@ -17,7 +17,7 @@ from common.registerable import Registrable
 from common.savable import Savable
 from datasets.conala.conala_eval import tokenize_for_bleu_eval
 from datasets.conala import evaluator as conala_evaluator
-from model import utils
+from model import nn_utils, utils
 from components.dataset import Example
 
 if six.PY3:
@@ -386,7 +386,10 @@ class Reranker(Savable):
         torch.save(params, path)
 
     @classmethod
-    def load(cls, model_path, cuda=False):
+    def load(cls, model_path, cuda=False, quantize=None):
+        if quantize:
+            assert not cuda, 'quantized models only run on CPU'
+            nn_utils.check_quantize_supported(quantize)
         print("loading reranker...")
         params = torch.load(model_path, map_location=lambda storage, loc: storage)
         feature_names = params['feature_names']
@@ -394,7 +397,7 @@ class Reranker(Savable):
         for feat_name in feature_names:
             feat_cls = Registrable.registered_components[feat_name]
             if issubclass(feat_cls, Savable):
-                feat_inst = feat_cls.load(model_path + '.%s' % feat_name, cuda=cuda)
+                feat_inst = feat_cls.load(model_path + '.%s' % feat_name, cuda=cuda, quantize=quantize)
                 feat_inst.eval()
             else:
                 feat_inst = feat_cls()
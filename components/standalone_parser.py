@@ -1,10 +1,12 @@
 from __future__ import print_function
 
+import copy
 import sys
 
 import six
 
 from common.registerable import Registrable
+from common.utils import LRUCache
 from components.reranker import GridSearchReranker
 from components.dataset import Example
 from model.parser import Parser
@@ -23,33 +25,49 @@ class StandaloneParser(object):
     purposes
     """
 
-    def __init__(self, parser_name, model_path, example_processor_name, beam_size=5, reranker_path=None, cuda=False):
+    def __init__(self, parser_name, model_path, example_processor_name, beam_size=5, reranker_path=None, cuda=False,
+                 early_stop_k=0, early_stop_heuristic=False, beam_margin=None, cache_size=1024, quantize=None):
         print('load parser from [%s]' % model_path, file=sys.stderr)
 
-        self.parser = parser = Registrable.by_name(parser_name).load(model_path, cuda=cuda).eval()
+        self.parser = parser = Registrable.by_name(parser_name).load(model_path, cuda=cuda, quantize=quantize).eval()
         self.reranker = None
         if reranker_path:
-            self.reranker = GridSearchReranker.load(reranker_path)
+            self.reranker = GridSearchReranker.load(reranker_path, quantize=quantize)
         self.example_processor = Registrable.by_name(example_processor_name)(parser.transition_system)
         self.beam_size = beam_size
+        self.early_stop_k = early_stop_k
+        self.early_stop_heuristic = early_stop_heuristic
+        self.beam_margin = beam_margin
+
+        # canonicalized utterances with the same tokens decode to the same hypotheses, since slot values
+        # only live in the slot map. Valid hypotheses are cached before decanonicalization, keyed by
+        # the canonical tokens, the beam size and the model and decoding options
+        self.model_id = (parser_name, model_path, reranker_path, quantize, early_stop_k, early_stop_heuristic,
+                         beam_margin)
+        self.cache = LRUCache(cache_size) if cache_size else None
+
+    @property
+    def cache_stats(self):
+        return self.cache.stats if self.cache is not None else None
 
     def parse(self, utterance, debug=False):
         utterance = utterance.strip()
         processed_utterance_tokens, utterance_meta = self.example_processor.pre_process_utterance(utterance)
         print(processed_utterance_tokens)
         print(utterance_meta)
-        examples = [Example(idx=None,
-                          src_sent=processed_utterance_tokens,
-                          tgt_code=None,
-                          tgt_actions=None,
-                          tgt_ast=None)]
-        hypotheses = self.parser.parse(processed_utterance_tokens, beam_size=self.beam_size, debug=debug)
 
-        if self.reranker:
-            hypotheses = self.decode_tree_to_code(hypotheses)
-            hypotheses = self.reranker.rerank_hypotheses(examples, [hypotheses])[0]
+        valid_hypotheses = None
+        if self.cache is not None:
+            cache_key = (tuple(processed_utterance_tokens), self.beam_size, debug, self.model_id)
+            valid_hypotheses = self.cache.get(cache_key)
 
-        valid_hypotheses = list(filter(lambda hyp: self.parser.transition_system.is_valid_hypothesis(hyp), hypotheses))
+        if valid_hypotheses is None:
+            valid_hypotheses = self.decode(processed_utterance_tokens, debug=debug)
+            if self.cache is not None:
+                self.cache.put(cache_key, valid_hypotheses)
+
+        # post-processing sets the decanonicalized code of hypotheses, work on copies to keep cached ones intact
+        valid_hypotheses = [copy.copy(hyp) for hyp in valid_hypotheses]
         for hyp in valid_hypotheses:
             self.example_processor.post_process_hypothesis(hyp, utterance_meta)
 
@@ -63,6 +81,29 @@ class StandaloneParser(object):
 
         return valid_hypotheses
 
+    def decode(self, processed_utterance_tokens, debug=False):
+        """decode and rerank a canonicalized utterance, return valid hypotheses before decanonicalization"""
+        examples = [Example(idx=None,
+                          src_sent=processed_utterance_tokens,
+                          tgt_code=None,
+                          tgt_actions=None,
+                          tgt_ast=None)]
+        if self.beam_size == 1:
+            # greedy decoding gives the same result with lower latency
+            hypotheses = self.parser.greedy_parse(processed_utterance_tokens, debug=debug)
+        else:
+            hypotheses = self.parser.parse(processed_utterance_tokens, beam_size=self.beam_size, debug=debug,
+                                           early_stop_k=self.early_stop_k, early_stop_heuristic=self.early_stop_heuristic,
+                                           beam_margin=self.beam_margin)
+
+        if self.reranker:
+            hypotheses = self.decode_tree_to_code(hypotheses)
+            hypotheses = self.reranker.rerank_hypotheses(examples, [hypotheses])[0]
+
+        valid_hypotheses = list(filter(lambda hyp: self.parser.transition_system.is_valid_hypothesis(hyp), hypotheses))
+
+        return valid_hypotheses
+
     def decode_tree_to_code(self, hyps):
         decoded_hyps = []
         for hyp_id, hyp in enumerate(hyps):
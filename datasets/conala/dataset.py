@@ -9,7 +9,7 @@ import numpy as np
 from asdl.hypothesis import *
 from asdl.lang.py3.py3_transition_system import python_ast_to_asdl_ast, asdl_ast_to_python_ast, Python3TransitionSystem
 from asdl.transition_system import *
-from components.action_info import get_action_infos
+from components.action_info import get_action_infos_from_ast
 from components.dataset import Example
 from components.vocab import Vocab, VocabEntry
 from datasets.conala.evaluator import ConalaEvaluator
@@ -116,10 +116,11 @@ def preprocess_dataset(file_path, transition_system, name='train', firstk=None):
             python_ast = ast.parse(example_dict['canonical_snippet'])
             canonical_code = astor.to_source(python_ast).strip()
             tgt_ast = python_ast_to_asdl_ast(python_ast, transition_system.grammar)
-            tgt_actions = transition_system.get_actions(tgt_ast)
+            tgt_actions, tgt_action_infos = get_action_infos_from_ast(example_dict['intent_tokens'], tgt_ast,
+                                                                      transition_system)
 
             # sanity check
-            hyp = Hypothesis()
+            hyp = Hypothesis(use_frontier_stack=True)
             for t, action in enumerate(tgt_actions):
                 assert action.__class__ in transition_system.get_valid_continuation_types(hyp)
                 if isinstance(action, ApplyRuleAction):
@@ -131,7 +132,7 @@ def preprocess_dataset(file_path, transition_system, name='train', firstk=None):
                 #     f_t = hyp.frontier_field.field.__repr__(plain=True)
                 #
                 # # print('\t[%d] %s, frontier field: %s, parent: %d' % (t, action, f_t, p_t))
-                hyp = hyp.clone_and_apply_action(action)
+                hyp.apply_action(action)
 
             assert hyp.frontier_node is None and hyp.frontier_field is None
             hyp.code = code_from_hyp = astor.to_source(asdl_ast_to_python_ast(hyp.tree, transition_system.grammar)).strip()
@@ -143,8 +144,6 @@ def preprocess_dataset(file_path, transition_system, name='train', firstk=None):
             assert compare_ast(ast.parse(example_json['snippet']), ast.parse(decanonicalized_code_from_hyp))
             assert transition_system.compare_ast(transition_system.surface_code_to_ast(decanonicalized_code_from_hyp),
                                                  transition_system.surface_code_to_ast(example_json['snippet']))
-
-            tgt_action_infos = get_action_infos(example_dict['intent_tokens'], tgt_actions)
         except (AssertionError, SyntaxError, ValueError, OverflowError) as e:
             skipped_list.append(example_json['question_id'])
             continue
@@ -3,10 +3,15 @@ from __future__ import print_function
 
 import sys
 import traceback
+
+import torch
 from tqdm import tqdm
 
+from components.dataset import Dataset
+
 
-def decode(examples, model, args, verbose=False, **kwargs):
+def decode(examples, model, args, verbose=False, greedy=False, **kwargs):
+    """Decode `examples` with beam search, or with `Parser.greedy_parse` if `greedy`"""
     ## TODO: create decoder for each dataset
 
     if verbose:
@@ -17,41 +22,55 @@ def decode(examples, model, args, verbose=False, **kwargs):
 
     decode_results = []
     count = 0
-    for example in tqdm(examples, desc='Decoding', file=sys.stdout, total=len(examples)):
-        hyps = model.parse(example.src_sent, context=None, beam_size=args.beam_size)
-        decoded_hyps = []
-        for hyp_id, hyp in enumerate(hyps):
-            got_code = False
-            try:
-                hyp.code = model.transition_system.ast_to_surface_code(hyp.tree)
-                got_code = True
-                decoded_hyps.append(hyp)
-            except:
-                if verbose:
-                    print("Exception in converting tree to code:", file=sys.stdout)
-                    print('-' * 60, file=sys.stdout)
-                    print('Example: %s\nIntent: %s\nTarget Code:\n%s\nHypothesis[%d]:\n%s' % (example.idx,
-                                                                                             ' '.join(example.src_sent),
-                                                                                             example.tgt_code,
-                                                                                             hyp_id,
-                                                                                             hyp.tree.to_string()), file=sys.stdout)
-                    if got_code:
-                        print()
-                        print(hyp.code)
-                    traceback.print_exc(file=sys.stdout)
-                    print('-' * 60, file=sys.stdout)
-
-        count += 1
-
-        decode_results.append(decoded_hyps)
+    decode_batch_size = args.decode_batch_size
+    with tqdm(desc='Decoding', file=sys.stdout, total=len(examples)) as pbar:
+        for batch_start in range(0, len(examples), decode_batch_size):
+            batch_examples = examples[batch_start: batch_start + decode_batch_size]
+            if greedy:
+                batch_hyps = [model.greedy_parse(e.src_sent, context=None) for e in batch_examples]
+            else:
+                batch_hyps = model.parse_batch([e.src_sent for e in batch_examples], context=None, beam_size=args.beam_size,
+                                               early_stop_k=args.decode_early_stop_k,
+                                               early_stop_heuristic=args.decode_early_stop_heuristic,
+                                               beam_margin=args.decode_beam_margin)
+
+            for example, hyps in zip(batch_examples, batch_hyps):
+                decoded_hyps = []
+                for hyp_id, hyp in enumerate(hyps):
+                    got_code = False
+                    try:
+                        hyp.code = model.transition_system.ast_to_surface_code(hyp.tree)
+                        got_code = True
+                        decoded_hyps.append(hyp)
+                    except:
+                        if verbose:
+                            print("Exception in converting tree to code:", file=sys.stdout)
+                            print('-' * 60, file=sys.stdout)
+                            print('Example: %s\nIntent: %s\nTarget Code:\n%s\nHypothesis[%d]:\n%s' % (example.idx,
+                                                                                                     ' '.join(example.src_sent),
+                                                                                                     example.tgt_code,
+                                                                                                     hyp_id,
+                                                                                                     hyp.tree.to_string()), file=sys.stdout)
+                            if got_code:
+                                print()
+                                print(hyp.code)
+                            traceback.print_exc(file=sys.stdout)
+                            print('-' * 60, file=sys.stdout)
+
+                count += 1
+
+                decode_results.append(decoded_hyps)
+
+            pbar.update(len(batch_examples))
 
     if was_training: model.train()
 
     return decode_results
 
 
-def evaluate(examples, parser, evaluator, args, verbose=False, return_decode_result=False, eval_top_pred_only=False):
-    decode_results = decode(examples, parser, args, verbose=verbose)
+def evaluate(examples, parser, evaluator, args, verbose=False, return_decode_result=False, eval_top_pred_only=False,
+             greedy=False):
+    decode_results = decode(examples, parser, args, verbose=verbose, greedy=greedy)
 
     eval_result = evaluator.evaluate_dataset(examples, decode_results, fast_mode=eval_top_pred_only, args=args)
 
@@ -59,3 +78,44 @@ def evaluate(examples, parser, evaluator, args, verbose=False, return_decode_res
         return eval_result, decode_results
     else:
         return eval_result
+
+
+def compute_log_likelihood(examples, model, args):
+    """Teacher-forced log-likelihood of the target ASTs of `examples`, computed with batched `Parser.score`.
+    Examples with more than `decode_max_time_step` actions are skipped, as in training"""
+    was_training = model.training
+    model.eval()
+
+    examples = [e for e in examples if len(e.tgt_actions) <= args.decode_max_time_step]
+    log_likelihood = 0.
+    action_num = 0
+    with torch.no_grad():
+        for batch_examples in Dataset(examples).batch_iter(batch_size=args.batch_size, shuffle=False):
+            log_likelihood += torch.sum(model.score(batch_examples)[0]).item()
+            action_num += sum(len(e.tgt_actions) for e in batch_examples)
+
+    if was_training: model.train()
+
+    return dict(dev_ll=log_likelihood / max(len(examples), 1),
+                dev_ll_per_action=log_likelihood / max(action_num, 1))
+
+
+def validate(examples, parser, evaluator, args, valid_metric='acc'):
+    """Evaluate `parser` on the dev examples with a model selection metric, return the evaluation results
+    and the dev score (higher is better)
+
+    Args:
+        valid_metric: `acc` for the default metric of `evaluator` with beam search, `greedy` for the default
+            metric with greedy decoding, and `dev_ll` for the teacher-forced log-likelihood per example
+    """
+    if valid_metric == 'dev_ll':
+        eval_results = compute_log_likelihood(examples, parser, args)
+
+        return eval_results, eval_results['dev_ll']
+
+    eval_results = evaluate(examples, parser, evaluator, args, verbose=False, eval_top_pred_only=args.eval_top_pred_only,
+                            greedy=valid_metric == 'greedy')
+    # evaluators return only the score of the default metric in fast mode
+    dev_score = eval_results[evaluator.default_metric] if isinstance(eval_results, dict) else eval_results
+
+    return eval_results, dev_score
@@ -1,19 +1,26 @@
 # coding=utf-8
 from __future__ import print_function
 
+import datetime
+import json
+import multiprocessing
+import os
 import time
+import traceback
+from collections import OrderedDict
 
 import astor
 import six.moves.cPickle as pickle
 from six.moves import input
+from six.moves import queue
 from six.moves import xrange as range
 from torch.autograd import Variable
 
 import evaluation
 from asdl.asdl import ASDLGrammar
 from asdl.transition_system import TransitionSystem
-from common.utils import update_args, init_arg_parser
-from components.dataset import Dataset
+from common.utils import update_args, init_arg_parser, PhaseTimer, peak_memory_mb
+from components.dataset import Dataset, BatchPrefetcher
 from components.reranker import *
 from components.standalone_parser import StandaloneParser
 from model import nn_utils
@@ -43,18 +50,18 @@ def init_config():
 def train(args):
     """Maximum Likelihood Estimation"""
 
+    grammar = ASDLGrammar.from_text(open(args.asdl_file).read())
+    transition_system = Registrable.by_name(args.transition_system)(grammar)
+
     # load in train/dev set
-    train_set = Dataset.from_bin_file(args.train_file)
+    train_set = Dataset.from_bin_file(args.train_file, grammar)
 
     if args.dev_file:
-        dev_set = Dataset.from_bin_file(args.dev_file)
+        dev_set = load_valid_set(args, grammar)
     else: dev_set = Dataset(examples=[])
 
     vocab = pickle.load(open(args.vocab, 'rb'))
 
-    grammar = ASDLGrammar.from_text(open(args.asdl_file).read())
-    transition_system = Registrable.by_name(args.transition_system)(grammar)
-
     parser_cls = Registrable.by_name(args.parser)  # TODO: add arg
     if args.pretrain:
         print('Finetune with: ', args.pretrain, file=sys.stderr)
@@ -66,6 +73,8 @@ def train(args):
     evaluator = Registrable.by_name(args.evaluator)(transition_system, args=args)
     if args.cuda: model.cuda()
 
+    train_set.tensorize(model.grammar, model.vocab)
+
     optimizer_cls = eval('torch.optim.%s' % args.optimizer)  # FIXME: this is evil!
     optimizer = optimizer_cls(model.parameters(), lr=args.lr)
 
@@ -83,23 +92,61 @@ def train(args):
             glove_embedding = GloveHelper(args.glove_embed_path)
             glove_embedding.load_to(model.src_embed, vocab.source)
 
+    # data-parallel training in the processes of `train_distributed`, only rank 0 validates and saves the model
+    distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+    world_size = torch.distributed.get_world_size() if distributed else 1
+    rank = torch.distributed.get_rank() if distributed else 0
+    if distributed:
+        nn_utils.broadcast_parameters(model.parameters())
+
     print('begin training, %d training examples, %d dev examples' % (len(train_set), len(dev_set)), file=sys.stderr)
     print('vocab: %s' % repr(vocab), file=sys.stderr)
 
+    valid_metric_name = {'acc': evaluator.default_metric,
+                         'greedy': 'greedy ' + evaluator.default_metric,
+                         'dev_ll': 'log-likelihood'}[args.valid_metric]
+    # validate in a separate process while training continues
+    async_validator = AsyncValidator(args) if args.async_validation and args.dev_file and rank == 0 else None
+
+    # wall-clock time of the phases of the training iterations, and the throughput since the last log and epoch
+    timer = PhaseTimer(cuda=args.cuda)
+    model.phase_timer = timer
+    report_meter, epoch_meter = ThroughputMeter(timer, cuda=args.cuda), ThroughputMeter(timer, cuda=args.cuda)
+    metrics_file = open(args.metrics_file, 'a') if args.metrics_file and rank == 0 else None
+
     epoch = train_iter = 0
     report_loss = report_examples = report_sup_att_loss = 0.
     history_dev_scores = []
     num_trial = patience = 0
+    # epoch of the last restore of the best model, the snapshots taken until then are of the abandoned trajectory
+    restore_epoch = 0
     while True:
         epoch += 1
         epoch_begin = time.time()
-
-        for batch_examples in train_set.batch_iter(batch_size=args.batch_size, shuffle=True):
-            batch_examples = [e for e in batch_examples if len(e.tgt_actions) <= args.decode_max_time_step]
+        timer.switch('batch construction')
+
+        epoch_action_num = epoch_padded_action_num = 0
+        # batches are built in a background thread, `prefetch_batches` batches ahead
+        batch_prefetcher = BatchPrefetcher(
+            train_set.batch_iter(batch_size=args.batch_size, shuffle=True,
+                                 bucket=args.bucket_batches, bucket_pool=args.bucket_pool_batches,
+                                 max_tokens=args.max_batch_tokens,
+                                 seed=args.seed + epoch if args.bucket_batches or distributed else None,
+                                 num_shards=world_size, shard_id=rank),
+            lambda _examples: model.to_batch([e for e in _examples if len(e.tgt_actions) <= args.decode_max_time_step]),
+            prefetch_num=args.prefetch_batches)
+
+        for batch in batch_prefetcher:
+            batch_examples = batch.examples
+            action_num, padded_action_num = Dataset.get_padding_stats(batch_examples)
+            epoch_action_num += action_num
+            epoch_padded_action_num += padded_action_num
+            report_meter.update(len(batch_examples), action_num)
+            epoch_meter.update(len(batch_examples), action_num)
             train_iter += 1
             optimizer.zero_grad()
 
-            ret_val = model.score(batch_examples)
+            ret_val = model.score(batch)
             loss = -ret_val[0]
 
             # print(loss.data)
@@ -117,8 +164,14 @@ def train(args):
 
                     loss += sup_att_loss
 
+            timer.switch('backward')
             loss.backward()
 
+            if distributed:
+                timer.switch('all-reduce')
+                nn_utils.all_reduce_gradients(model.parameters(), world_size)
+
+            timer.switch('optimizer step')
             # clip gradient
             if args.clip_grad > 0.:
                 grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip_grad)
@@ -126,41 +179,76 @@ def train(args):
             optimizer.step()
 
             if train_iter % args.log_every == 0:
+                metrics = report_meter.report()
                 log_str = '[Iter %d] encoder loss=%.5f' % (train_iter, report_loss / report_examples)
                 if args.sup_attention:
                     log_str += ' supervised attention loss=%.5f' % (report_sup_att_loss / report_examples)
                     report_sup_att_loss = 0.
+                log_str += ', %.1f examples/s, %.1f actions/s' % (metrics['examples_per_sec'], metrics['actions_per_sec'])
 
                 print(log_str, file=sys.stderr)
+                write_metrics(metrics_file, event='iter', epoch=epoch, iter=train_iter,
+                              loss=report_loss / report_examples, **metrics)
                 report_loss = report_examples = 0.
 
-        print('[Epoch %d] epoch elapsed %ds' % (epoch, time.time() - epoch_begin), file=sys.stderr)
-
-        if args.save_all_models:
+            # the time until the next batch is ready
+            timer.switch('batch construction')
+
+        timer.stop()
+        epoch_time = time.time() - epoch_begin
+        padding_waste = 1. - epoch_action_num / max(epoch_padded_action_num, 1)
+        print('[Epoch %d] epoch elapsed %.1fs (waiting for data %.1fs, compute %.1fs), padding waste %.2f%%' % (
+            epoch, epoch_time, batch_prefetcher.wait_time, epoch_time - batch_prefetcher.wait_time,
+            100. * padding_waste), file=sys.stderr)
+        epoch_metrics = epoch_meter.report()
+        print('[Epoch %d] %.1f examples/s, %.1f actions/s, peak memory %.1fMB, time breakdown: %s' % (
+            epoch, epoch_metrics['examples_per_sec'], epoch_metrics['actions_per_sec'],
+            epoch_metrics['peak_memory_mb'], format_time_breakdown(epoch_metrics['time_breakdown'])), file=sys.stderr)
+
+        if args.save_all_models and rank == 0:
             model_file = args.save_to + '.iter%d.bin' % train_iter
             print('save model to [%s]' % model_file, file=sys.stderr)
             model.save(model_file)
 
         # perform validation
-        is_better = False
-        if args.dev_file:
+        # list of (validated epoch, dev score) of the validations finished in this epoch
+        valid_results = []
+        valid_begin = time.time()
+        if rank == 0 and args.dev_file:
             if epoch % args.valid_every_epoch == 0:
-                print('[Epoch %d] begin validation' % epoch, file=sys.stderr)
-                eval_start = time.time()
-                eval_results = evaluation.evaluate(dev_set.examples, model, evaluator, args,
-                                                   verbose=False, eval_top_pred_only=args.eval_top_pred_only)
-                dev_score = eval_results[evaluator.default_metric]
-
-                print('[Epoch %d] evaluate details: %s, dev %s: %.5f (took %ds)' % (
-                                    epoch, eval_results,
-                                    evaluator.default_metric,
-                                    dev_score,
-                                    time.time() - eval_start), file=sys.stderr)
-
-                is_better = history_dev_scores == [] or dev_score > max(history_dev_scores)
-                history_dev_scores.append(dev_score)
-        else:
-            is_better = True
+                if async_validator:
+                    print('[Epoch %d] submit the model for validation' % epoch, file=sys.stderr)
+                    async_validator.submit(epoch, model, optimizer)
+                else:
+                    print('[Epoch %d] begin validation' % epoch, file=sys.stderr)
+                    eval_start = time.time()
+                    eval_results, dev_score = evaluation.validate(dev_set.examples, model, evaluator, args,
+                                                                  valid_metric=args.valid_metric)
+
+                    print('[Epoch %d] evaluate details: %s, dev %s: %.5f (took %ds)' % (
+                                        epoch, eval_results,
+                                        valid_metric_name,
+                                        dev_score,
+                                        time.time() - eval_start), file=sys.stderr)
+                    valid_results.append((epoch, dev_score))
+            elif not async_validator:
+                valid_results.append((epoch, None))
+
+            if async_validator:
+                # react to the validations that finished during this epoch, wait for all of them at the last epoch
+                for valid_epoch, (eval_results, dev_score), valid_time in async_validator.get_results(block=epoch == args.max_epoch):
+                    print('[Epoch %d] validation of epoch %d: evaluate details: %s, dev %s: %.5f (took %ds)' % (
+                                        epoch, valid_epoch, eval_results,
+                                        valid_metric_name,
+                                        dev_score,
+                                        valid_time), file=sys.stderr)
+                    valid_results.append((valid_epoch, dev_score))
+        elif rank == 0:
+            valid_results.append((epoch, None))
+
+        epoch_metrics['time_breakdown']['validation'] = time.time() - valid_begin
+        write_metrics(metrics_file, event='epoch', epoch=epoch, iter=train_iter, padding_waste=padding_waste,
+                      **epoch_metrics)
 
         if args.decay_lr_every_epoch and epoch > args.lr_decay_after_epoch:
             lr = optimizer.param_groups[0]['lr'] * args.lr_decay
@@ -170,62 +258,289 @@ def train(args):
             for param_group in optimizer.param_groups:
                 param_group['lr'] = lr
 
-        if is_better:
-            patience = 0
-            model_file = args.save_to + '.bin'
-            print('save the current model ..', file=sys.stderr)
-            print('save model to [%s]' % model_file, file=sys.stderr)
-            model.save(model_file)
-            # also save the optimizers' state
-            torch.save(optimizer.state_dict(), args.save_to + '.optim.bin')
-        elif patience < args.patience and epoch >= args.lr_decay_after_epoch:
-            patience += 1
-            print('hit patience %d' % patience, file=sys.stderr)
+        for valid_epoch, dev_score in valid_results:
+            if valid_epoch <= restore_epoch:
+                # a snapshot of the trajectory abandoned by the last restore
+                print('[Epoch %d] drop the validation of epoch %d, taken before restoring the best model' % (
+                    epoch, valid_epoch), file=sys.stderr)
+                async_validator.discard(valid_epoch)
+                continue
+
+            if not args.dev_file:
+                is_better = True
+            elif dev_score is None:
+                is_better = False
+            else:
+                is_better = history_dev_scores == [] or dev_score > max(history_dev_scores)
+                history_dev_scores.append(dev_score)
+
+            if is_better:
+                patience = 0
+                model_file = args.save_to + '.bin'
+                print('save the current model ..', file=sys.stderr)
+                print('save model to [%s]' % model_file, file=sys.stderr)
+                if async_validator:
+                    # the validated snapshot, not the current model
+                    async_validator.keep(valid_epoch, args.save_to)
+                else:
+                    model.save(model_file)
+                    # also save the optimizers' state
+                    torch.save(optimizer.state_dict(), args.save_to + '.optim.bin')
+            else:
+                if async_validator:
+                    async_validator.discard(valid_epoch)
+                if patience < args.patience and valid_epoch >= args.lr_decay_after_epoch:
+                    patience += 1
+                    print('hit patience %d' % patience, file=sys.stderr)
 
         if epoch == args.max_epoch:
             print('reached max epoch, stop!', file=sys.stderr)
+            if async_validator: async_validator.close()
             exit(0)
 
+        stop = restored = False
         if patience >= args.patience and epoch >= args.lr_decay_after_epoch:
             num_trial += 1
             print('hit #%d trial' % num_trial, file=sys.stderr)
             if num_trial == args.max_num_trial:
                 print('early stop!', file=sys.stderr)
-                exit(0)
+                stop = True
+            else:
+                # decay lr, and restore from previously best checkpoint
+                lr = optimizer.param_groups[0]['lr'] * args.lr_decay
+                print('load previously best model and decay learning rate to %f' % lr, file=sys.stderr)
+                model, optimizer = restore_best_model(args, model, optimizer, lr)
+                restored = True
+                restore_epoch = epoch
+
+                # reset patience
+                patience = 0
+
+        if distributed:
+            # the other processes follow the decisions of rank 0
+            decisions = torch.tensor([stop, restored, optimizer.param_groups[0]['lr']], dtype=torch.float64)
+            torch.distributed.broadcast(decisions, 0)
+            stop, restored, lr = bool(decisions[0]), bool(decisions[1]), decisions[2].item()
+            if rank != 0 and restored:
+                model, optimizer = restore_best_model(args, model, optimizer, lr)
+            for param_group in optimizer.param_groups:
+                param_group['lr'] = lr
 
-            # decay lr, and restore from previously best checkpoint
-            lr = optimizer.param_groups[0]['lr'] * args.lr_decay
-            print('load previously best model and decay learning rate to %f' % lr, file=sys.stderr)
+        if stop:
+            if async_validator: async_validator.close()
+            exit(0)
 
-            # load model
-            params = torch.load(args.save_to + '.bin', map_location=lambda storage, loc: storage)
-            model.load_state_dict(params['state_dict'])
-            if args.cuda: model = model.cuda()
 
-            # load optimizers
-            if args.reset_optimizer:
-                print('reset optimizer', file=sys.stderr)
-                optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+class ThroughputMeter(object):
+    """Count the training examples and target actions, and report the throughput and the time breakdown
+    of the phases of `timer` since the last report"""
+
+    def __init__(self, timer, cuda=False):
+        self.timer = timer
+        self.cuda = cuda
+        self.example_num = self.action_num = 0
+        self.last_times = dict(timer.times)
+
+    def update(self, example_num, action_num):
+        self.example_num += example_num
+        self.action_num += action_num
+
+    def report(self):
+        time_breakdown = OrderedDict((phase, seconds - self.last_times.get(phase, 0.))
+                                     for phase, seconds in self.timer.times.items())
+        elapsed = max(sum(time_breakdown.values()), 1e-6)
+        metrics = OrderedDict(examples=self.example_num, actions=self.action_num, elapsed=elapsed,
+                              examples_per_sec=self.example_num / elapsed,
+                              actions_per_sec=self.action_num / elapsed,
+                              time_breakdown=time_breakdown,
+                              peak_memory_mb=peak_memory_mb(self.cuda))
+
+        self.example_num = self.action_num = 0
+        self.last_times = dict(self.timer.times)
+
+        return metrics
+
+
+def format_time_breakdown(time_breakdown):
+    total_time = max(sum(time_breakdown.values()), 1e-6)
+
+    return ', '.join('%s %.1fs (%.1f%%)' % (phase, seconds, 100. * seconds / total_time)
+                     for phase, seconds in time_breakdown.items())
+
+
+def write_metrics(metrics_file, **metrics):
+    """Append `metrics` to the JSON lines file of `--metrics_file`, if any"""
+    if metrics_file:
+        metrics_file.write(json.dumps(metrics) + '\n')
+        metrics_file.flush()
+
+
+def restore_best_model(args, model, optimizer, lr):
+    """Load the best model saved to `save_to` and the state of its optimizer, and set the learning rate to `lr`"""
+    # load model
+    params = torch.load(args.save_to + '.bin', map_location=lambda storage, loc: storage)
+    model.load_state_dict(params['state_dict'])
+    if args.cuda: model = model.cuda()
+
+    # load optimizers
+    if args.reset_optimizer:
+        print('reset optimizer', file=sys.stderr)
+        optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    else:
+        print('restore parameters of the optimizers', file=sys.stderr)
+        optimizer.load_state_dict(torch.load(args.save_to + '.optim.bin'))
+
+    # set new lr
+    for param_group in optimizer.param_groups:
+        param_group['lr'] = lr
+
+    return model, optimizer
+
+
+def train_distributed(args):
+    """Data-parallel training in `num_processes` local processes, which train on disjoint shards of the
+    batches of each epoch and average their gradients with gloo"""
+    torch.multiprocessing.spawn(train_process, args=(args,), nprocs=args.num_processes)
+
+
+def train_process(rank, args):
+    torch.distributed.init_process_group('gloo', init_method=args.dist_init_method,
+                                         rank=rank, world_size=args.num_processes,
+                                         timeout=datetime.timedelta(minutes=args.dist_timeout))
+    torch.set_num_threads(args.num_threads_per_process or max(1, multiprocessing.cpu_count() // args.num_processes))
+
+    # all the processes initialize the model and shuffle the batches the same way
+    torch.manual_seed(args.seed)
+    np.random.seed(int(args.seed * 13 / 7))
+
+    if rank != 0:
+        # only rank 0 logs, errors are raised by `train_distributed`
+        sys.stdout = sys.stderr = open(os.devnull, 'w')
+
+    try:
+        train(args)
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+def load_valid_set(args, grammar):
+    """Load the dev set, or a fixed random subset of `valid_subset_size` examples of it"""
+    dev_set = Dataset.from_bin_file(args.dev_file, grammar)
+    if args.valid_subset_size and args.valid_subset_size < len(dev_set):
+        # the same subset across epochs and processes
+        example_ids = np.random.RandomState(args.seed).choice(len(dev_set), args.valid_subset_size, replace=False)
+        dev_set = Dataset([dev_set.examples[i] for i in sorted(example_ids)])
+
+    return dev_set
+
+
+class AsyncValidator(object):
+    """Validate snapshots of the model in a separate process while training continues.
+
+    A snapshot of the model and the optimizer is saved to `<save_to>.valid_epoch<epoch>.bin` and
+    `.optim.bin` for each submitted epoch, and is kept as the best model or discarded once its
+    validation result has been handled. The worker validates snapshots in submission order.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.pending_epochs = []
+
+        ctx = multiprocessing.get_context('spawn')
+        self.task_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.process = ctx.Process(target=validation_worker, args=(args, self.task_queue, self.result_queue))
+        self.process.daemon = True
+        self.process.start()
+
+    def get_snapshot_files(self, epoch):
+        prefix = '%s.valid_epoch%d' % (self.args.save_to, epoch)
+
+        return prefix + '.bin', prefix + '.optim.bin'
+
+    def submit(self, epoch, model, optimizer):
+        model_file, optim_file = self.get_snapshot_files(epoch)
+        model.save(model_file)
+        torch.save(optimizer.state_dict(), optim_file)
+
+        self.task_queue.put((epoch, model_file))
+        self.pending_epochs.append(epoch)
+
+    def get_results(self, block=False):
+        """Return the (epoch, (evaluation results, dev score), validation time) of the finished
+        validations in submission order, wait for all the pending validations if `block`"""
+        results = []
+        while self.pending_epochs:
+            try:
+                epoch, valid_result, valid_time, error = self.result_queue.get(timeout=1. if block else 0.01)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError('the validation worker exited unexpectedly')
+                if block: continue
+                else: break
+
+            self.pending_epochs.remove(epoch)
+            if error:
+                print('validation of epoch %d failed:\n%s' % (epoch, error), file=sys.stderr)
+                self.discard(epoch)
             else:
-                print('restore parameters of the optimizers', file=sys.stderr)
-                optimizer.load_state_dict(torch.load(args.save_to + '.optim.bin'))
+                results.append((epoch, valid_result, valid_time))
 
-            # set new lr
-            for param_group in optimizer.param_groups:
-                param_group['lr'] = lr
+        return results
 
-            # reset patience
-            patience = 0
+    def keep(self, epoch, save_to):
+        model_file, optim_file = self.get_snapshot_files(epoch)
+        os.replace(model_file, save_to + '.bin')
+        os.replace(optim_file, save_to + '.optim.bin')
 
+    def discard(self, epoch):
+        for file_path in self.get_snapshot_files(epoch):
+            if os.path.exists(file_path):
+                os.remove(file_path)
 
-def train_rerank_feature(args):
-    train_set = Dataset.from_bin_file(args.train_file)
-    dev_set = Dataset.from_bin_file(args.dev_file)
-    vocab = pickle.load(open(args.vocab, 'rb'))
+    def close(self):
+        self.task_queue.put(None)
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.terminate()
+
+        for epoch in self.pending_epochs:
+            self.discard(epoch)
+        self.pending_epochs = []
+
+
+def validation_worker(args, task_queue, result_queue):
+    """Main loop of the process of `AsyncValidator`, evaluate the snapshots in `task_queue` on the dev set"""
+    if args.valid_num_threads:
+        torch.set_num_threads(args.valid_num_threads)
+
+    dev_set = load_valid_set(args, ASDLGrammar.from_text(open(args.asdl_file).read()))
+    parser_cls = Registrable.by_name(args.parser)
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
 
+        epoch, model_file = task
+        try:
+            eval_start = time.time()
+            model = parser_cls.load(model_path=model_file, cuda=args.cuda)
+            evaluator = Registrable.by_name(args.evaluator)(model.transition_system, args=args)
+            valid_result = evaluation.validate(dev_set.examples, model, evaluator, args, valid_metric=args.valid_metric)
+            result_queue.put((epoch, valid_result, time.time() - eval_start, None))
+        except Exception:
+            result_queue.put((epoch, None, 0., traceback.format_exc()))
+
+
+def train_rerank_feature(args):
     grammar = ASDLGrammar.from_text(open(args.asdl_file).read())
     transition_system = TransitionSystem.get_class_by_lang(args.lang)(grammar)
 
+    train_set = Dataset.from_bin_file(args.train_file, grammar)
+    dev_set = Dataset.from_bin_file(args.dev_file, grammar)
+    vocab = pickle.load(open(args.vocab, 'rb'))
+
     train_paraphrase_model = args.mode == 'train_paraphrase_identifier'
 
     def _get_feat_class():
@@ -338,6 +653,11 @@ def train_rerank_feature(args):
     print('begin training decoder, %d training examples, %d dev examples' % (len(train_set), len(dev_set)), file=sys.stderr)
     print('vocab: %s' % repr(vocab), file=sys.stderr)
 
+    # wall-clock time of the phases of the training iterations, and the throughput since the last log and epoch
+    timer = PhaseTimer(cuda=args.cuda)
+    report_meter, epoch_meter = ThroughputMeter(timer, cuda=args.cuda), ThroughputMeter(timer, cuda=args.cuda)
+    metrics_file = open(args.metrics_file, 'a') if args.metrics_file else None
+
     epoch = train_iter = 0
     report_loss = report_examples = 0.
     history_dev_scores = []
@@ -345,9 +665,17 @@ def train_rerank_feature(args):
     while True:
         epoch += 1
         epoch_begin = time.time()
+        timer.switch('batch construction')
 
-        for batch_examples in train_set.batch_iter(batch_size=args.batch_size, shuffle=True):
+        epoch_action_num = epoch_padded_action_num = 0
+        for batch_examples in train_set.batch_iter(batch_size=args.batch_size, shuffle=True,
+                                                   bucket=args.bucket_batches, bucket_pool=args.bucket_pool_batches,
+                                                   max_tokens=args.max_batch_tokens,
+                                                   seed=args.seed + epoch if args.bucket_batches else None):
             batch_examples = [e for e in batch_examples if len(e.tgt_actions) <= args.decode_max_time_step]
+            action_num, padded_action_num = Dataset.get_padding_stats(batch_examples)
+            epoch_action_num += action_num
+            epoch_padded_action_num += padded_action_num
 
             if train_paraphrase_model:
                 positive_examples_num = len(batch_examples)
@@ -368,9 +696,12 @@ def train_rerank_feature(args):
 
                 batch_examples += negative_samples
 
+            report_meter.update(len(batch_examples), action_num)
+            epoch_meter.update(len(batch_examples), action_num)
             train_iter += 1
             optimizer.zero_grad()
 
+            timer.switch('forward')
             nll = -model(batch_examples)
             if train_paraphrase_model:
                 idx_tensor = Variable(torch.LongTensor(labels).unsqueeze(-1), requires_grad=False)
@@ -385,22 +716,39 @@ def train_rerank_feature(args):
             report_examples += len(batch_examples)
             loss = torch.mean(loss)
 
+            timer.switch('backward')
             loss.backward()
 
+            timer.switch('optimizer step')
             # clip gradient
             grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip_grad)
 
             optimizer.step()
 
             if train_iter % args.log_every == 0:
-                print('[Iter %d] encoder loss=%.5f' %
+                metrics = report_meter.report()
+                print('[Iter %d] encoder loss=%.5f, %.1f examples/s, %.1f actions/s' %
                       (train_iter,
-                       report_loss / report_examples),
+                       report_loss / report_examples,
+                       metrics['examples_per_sec'], metrics['actions_per_sec']),
                       file=sys.stderr)
+                write_metrics(metrics_file, event='iter', epoch=epoch, iter=train_iter,
+                              loss=report_loss / report_examples, **metrics)
 
                 report_loss = report_examples = 0.
 
-        print('[Epoch %d] epoch elapsed %ds' % (epoch, time.time() - epoch_begin), file=sys.stderr)
+            # the time until the next batch is ready
+            timer.switch('batch construction')
+
+        timer.stop()
+        padding_waste = 1. - epoch_action_num / max(epoch_padded_action_num, 1)
+        print('[Epoch %d] epoch elapsed %ds, padding waste %.2f%%' % (
+            epoch, time.time() - epoch_begin,
+            100. * padding_waste), file=sys.stderr)
+        epoch_metrics = epoch_meter.report()
+        print('[Epoch %d] %.1f examples/s, %.1f actions/s, peak memory %.1fMB, time breakdown: %s' % (
+            epoch, epoch_metrics['examples_per_sec'], epoch_metrics['actions_per_sec'],
+            epoch_metrics['peak_memory_mb'], format_time_breakdown(epoch_metrics['time_breakdown'])), file=sys.stderr)
 
         # perform validation
         print('[Epoch %d] begin validation' % epoch, file=sys.stderr)
@@ -408,6 +756,9 @@ def train_rerank_feature(args):
         # evaluate dev_score
         dev_acc = evaluate_paraphrase_acc() if train_paraphrase_model else -evaluate_ppl()
         print('[Epoch %d] dev_score=%.5f took %ds' % (epoch, dev_acc, time.time() - eval_start), file=sys.stderr)
+        epoch_metrics['time_breakdown']['validation'] = time.time() - eval_start
+        write_metrics(metrics_file, event='epoch', epoch=epoch, iter=train_iter, padding_waste=padding_waste,
+                      **epoch_metrics)
         is_better = history_dev_scores == [] or dev_acc > max(history_dev_scores)
         history_dev_scores.append(dev_acc)
 
@@ -457,7 +808,6 @@ def train_rerank_feature(args):
 
 
 def test(args):
-    test_set = Dataset.from_bin_file(args.test_file)
     assert args.load_model
 
     print('load model from [%s]' % args.load_model, file=sys.stderr)
@@ -469,8 +819,9 @@ def test(args):
     args.lang = saved_args.lang
 
     parser_cls = Registrable.by_name(args.parser)
-    parser = parser_cls.load(model_path=args.load_model, cuda=args.cuda)
+    parser = parser_cls.load(model_path=args.load_model, cuda=args.cuda, quantize=args.quantize)
     parser.eval()
+    test_set = Dataset.from_bin_file(args.test_file, parser.grammar)
     evaluator = Registrable.by_name(args.evaluator)(transition_system, args=args)
     eval_results, decode_results = evaluation.evaluate(test_set.examples, parser, evaluator, args,
                                                        verbose=args.verbose, return_decode_result=True)
@@ -487,7 +838,11 @@ def interactive_mode(args):
                               args.load_model,
                               args.example_preprocessor,
                               beam_size=args.beam_size,
-                              cuda=args.cuda)
+                              cuda=args.cuda,
+                              early_stop_k=args.decode_early_stop_k,
+                              early_stop_heuristic=args.decode_early_stop_heuristic,
+                              beam_margin=args.decode_beam_margin,
+                              quantize=args.quantize)
 
     while True:
         utterance = input('Query:').strip()
@@ -503,10 +858,6 @@ def interactive_mode(args):
 
 
 def train_reranker_and_test(args):
-    print('load dataset [test %s], [dev %s]' % (args.test_file, args.dev_file), file=sys.stderr)
-    test_set = Dataset.from_bin_file(args.test_file)
-    dev_set = Dataset.from_bin_file(args.dev_file)
-
     features = []
     i = 0
     while i < len(args.features):
@@ -515,7 +866,7 @@ def train_reranker_and_test(args):
         print('Add feature %s' % feat_name, file=sys.stderr)
         if issubclass(feat_cls, nn.Module):
             feat_path = os.path.join('saved_models/conala/', args.features[i] + '.bin')
-            feat_inst = feat_cls.load(feat_path)
+            feat_inst = feat_cls.load(feat_path, quantize=args.quantize)
             print('Load feature %s from %s' % (feat_name, feat_path), file=sys.stderr)
         else:
             feat_inst = feat_cls()
@@ -526,6 +877,10 @@ def train_reranker_and_test(args):
     transition_system = next(feat.transition_system for feat in features if hasattr(feat, 'transition_system'))
     evaluator = Registrable.by_name(args.evaluator)(transition_system)
 
+    print('load dataset [test %s], [dev %s]' % (args.test_file, args.dev_file), file=sys.stderr)
+    test_set = Dataset.from_bin_file(args.test_file, transition_system.grammar)
+    dev_set = Dataset.from_bin_file(args.dev_file, transition_system.grammar)
+
 
     print('load dev decode results [%s]' % args.dev_decode_file, file=sys.stderr)
     dev_decode_results = pickle.load(open(args.dev_decode_file, 'rb'))
@@ -541,7 +896,7 @@ def train_reranker_and_test(args):
     print(test_eval_results, file=sys.stderr)
 
     if args.load_reranker:
-        reranker = GridSearchReranker.load(args.load_reranker)
+        reranker = GridSearchReranker.load(args.load_reranker, quantize=args.quantize)
     else:
         reranker = GridSearchReranker(features, transition_system=transition_system)
 
@@ -567,7 +922,10 @@ if __name__ == '__main__':
     args = init_config()
     print(args, file=sys.stderr)
     if args.mode == 'train':
-        train(args)
+        if args.num_processes > 1:
+            train_distributed(args)
+        else:
+            train(args)
     elif args.mode in ('train_reconstructor', 'train_paraphrase_identifier'):
         train_rerank_feature(args)
     elif args.mode == 'rerank':
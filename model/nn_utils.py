@@ -1,16 +1,62 @@
 # coding=utf-8
+import inspect
 
 import torch
+import torch.distributed
 import torch.nn.functional as F
 import torch.nn.init as init
 
 import torch.nn as nn
 from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
 import numpy as np
 
 from six.moves import xrange
 
 
+def log_softmax_gather(logits, index):
+    """
+    `F.log_softmax(logits, dim=-1)` gathered at `index` along the last dimension, computed with logsumexp
+    so that the log-probabilities of all the labels are not materialized
+
+    :param logits: (batch_size, *, label_num)
+    :param index: (batch_size, *)
+    :return: (batch_size, *)
+    """
+    return torch.gather(logits, -1, index.unsqueeze(-1)).squeeze(-1) - torch.logsumexp(logits, dim=-1)
+
+
+# recent PyTorch versions require the checkpointing variant to be explicit
+_checkpoint_kwargs = {'use_reentrant': True} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+
+
+def chunked_readout(func, query_vectors, index, chunk_size=1024):
+    """
+    Apply `func(query_vectors, index)` to chunks of `chunk_size` positions with gradient checkpointing,
+    so that the logits over all the labels are only materialized for one chunk at a time, in the
+    forward pass as well as in the backward pass, where they are recomputed
+
+    :param func: function of query vectors (chunk_size, query_vec_size) and labels (chunk_size,),
+                 returning a score of each position (chunk_size,)
+    :param query_vectors: (batch_size, *, query_vec_size)
+    :param index: (batch_size, *)
+    :return: (batch_size, *)
+    """
+    query_vectors = query_vectors.reshape(-1, query_vectors.size(-1))
+    flat_index = index.reshape(-1)
+    use_checkpoint = torch.is_grad_enabled() and query_vectors.requires_grad
+
+    outputs = []
+    for i in range(0, query_vectors.size(0), chunk_size):
+        query_chunk, index_chunk = query_vectors[i: i + chunk_size], flat_index[i: i + chunk_size]
+        if use_checkpoint:
+            outputs.append(checkpoint(func, query_chunk, index_chunk, **_checkpoint_kwargs))
+        else:
+            outputs.append(func(query_chunk, index_chunk))
+
+    return torch.cat(outputs, dim=0).view_as(index)
+
+
 def dot_prod_attention(h_t, src_encoding, src_encoding_att_linear, mask=None):
     """
     :param h_t: (batch_size, hidden_size)
@@ -144,6 +190,31 @@ def log_sum_exp(inputs, dim=None, keepdim=False):
     return outputs
 
 
+def all_reduce_gradients(params, world_size):
+    """Average the gradients of `params` over the processes of the default `torch.distributed` process group.
+    Parameters without gradient get a zero gradient, so that all processes reduce the same flat buffer"""
+    params = [p for p in params if p.requires_grad]
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+
+    flat_grads = torch.cat([p.grad.view(-1) for p in params])
+    torch.distributed.all_reduce(flat_grads)
+    flat_grads /= world_size
+
+    offset = 0
+    for p in params:
+        numel = p.numel()
+        p.grad.copy_(flat_grads[offset: offset + numel].view_as(p.grad))
+        offset += numel
+
+
+def broadcast_parameters(params, src=0):
+    """Copy `params` of process `src` to all the processes of the default `torch.distributed` process group"""
+    for p in params:
+        torch.distributed.broadcast(p.data, src)
+
+
 def uniform_init(lower, upper, params):
     for p in params:
         p.data.uniform_(lower, upper)
@@ -159,6 +230,40 @@ def identity(x):
     return x
 
 
+def quantize_supported():
+    """whether the installed torch has dynamic quantization of LSTM cells, which `quantize_model` needs"""
+    try:
+        import torch.quantization
+        import torch.nn.quantized.dynamic as nnqd
+    except ImportError:
+        # e.g. the pinned pytorch 1.1.0, which has no `torch.quantization`
+        return False
+
+    return hasattr(nnqd, 'LSTMCell')
+
+
+def check_quantize_supported(quantize):
+    """fail before loading models with `quantize` if the installed torch cannot quantize them"""
+    if quantize != 'int8':
+        raise ValueError('unsupported quantization %s' % quantize)
+    if not quantize_supported():
+        raise RuntimeError('--quantize %s needs a newer torch, whose torch.quantization.quantize_dynamic supports '
+                           'nn.LSTMCell, torch %s is installed' % (quantize, torch.__version__))
+
+
+def quantize_model(model, quantize='int8'):
+    """
+    apply dynamic quantization to the LSTM and linear layers of a model for CPU inference.
+    Quantization is done in place, since some models keep closures over their layers
+    :param quantize: the quantized data type, only `int8` is supported, see `check_quantize_supported`
+    """
+    check_quantize_supported(quantize)
+
+    torch.quantization.quantize_dynamic(model, {nn.LSTM, nn.LSTMCell, nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    return model
+
+
 class LabelSmoothing(nn.Module):
     """Implement label smoothing.
 
@@ -177,6 +282,7 @@ class LabelSmoothing(nn.Module):
             one_hot[idx] = 0.
 
         self.confidence = 1.0 - smoothing
+        self.smoothing_value = smoothing_value
         self.register_buffer('one_hot', one_hot.unsqueeze(0))
 
     def forward(self, model_prob, target):
@@ -190,6 +296,32 @@ class LabelSmoothing(nn.Module):
 
         return self.criterion(model_prob, true_dist).sum(dim=-1)
 
+    def forward_logits(self, logits, target):
+        """Same as `forward(F.log_softmax(logits, dim=-1), target)`, computed in closed form
+        without the (batch_size, *, tgt_vocab_size) log-probabilities and smoothed distributions"""
+
+        # (tgt_vocab_size,) 1 for the labels that get the smoothing value
+        smoothing_mask = torch.gt(self.one_hot[0], 0.).type_as(logits)
+
+        # (batch_size, *)
+        log_z = torch.logsumexp(logits, dim=-1)
+        tgt_log_prob = torch.gather(logits, -1, target.unsqueeze(-1)).squeeze(-1) - log_z
+        tgt_smoothed = smoothing_mask[target]
+
+        # sum of the log-probabilities of the labels that get the smoothing value, other than the target
+        smoothed_num = smoothing_mask.sum() - tgt_smoothed
+        smoothed_log_prob_sum = torch.matmul(logits, smoothing_mask) - smoothing_mask.sum() * log_z - \
+                                tgt_smoothed * tgt_log_prob
+
+        # KL(q || p) = sum_j q_j * log(q_j) - sum_j q_j * log(p_j)
+        entropy_term = smoothed_num * xlogx(self.smoothing_value) + xlogx(self.confidence)
+
+        return entropy_term - self.confidence * tgt_log_prob - self.smoothing_value * smoothed_log_prob_sum
+
+
+def xlogx(x):
+    return x * np.log(x) if x > 0. else 0.
+
 
 class FeedForward(nn.Module):
     """Feed forward neural network adapted from AllenNLP"""
@@ -126,7 +126,10 @@ class ParaphraseIdentificationModel(nn.Module, RerankingFeature, Savable):
         torch.save(params, path)
 
     @staticmethod
-    def load(model_path, cuda=False):
+    def load(model_path, cuda=False, quantize=None):
+        if quantize:
+            assert not cuda, 'quantized models only run on CPU'
+            nn_utils.check_quantize_supported(quantize)
         decoder_params = torch.load(model_path, map_location=lambda storage, loc: storage)
         decoder_params['args'].cuda = cuda
         # update saved args
@@ -138,4 +141,7 @@ class ParaphraseIdentificationModel(nn.Module, RerankingFeature, Savable):
         if cuda: model = model.cuda()
         model.eval()
 
+        if quantize:
+            nn_utils.quantize_model(model, quantize)
+
         return model
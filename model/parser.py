@@ -17,10 +17,10 @@ from torch.nn.utils.rnn import pad_packed_sequence, pack_padded_sequence
 from asdl.hypothesis import Hypothesis, GenTokenAction
 from asdl.transition_system import ApplyRuleAction, ReduceAction, Action
 from common.registerable import Registrable
-from components.decode_hypothesis import DecodeHypothesis
+from components.decode_hypothesis import PersistentDecodeHypothesis
 from components.action_info import ActionInfo
 from components.dataset import Batch
-from common.utils import update_args, init_arg_parser
+from common.utils import update_args, init_arg_parser, PhaseTimer
 from model import nn_utils
 from model.attention_util import AttentionUtil
 from model.nn_utils import LabelSmoothing
@@ -162,6 +162,9 @@ class Parser(nn.Module):
             self.new_long_tensor = torch.LongTensor
             self.new_tensor = torch.FloatTensor
 
+        # times the encode, decode and readout/loss phases of `score` in training, set by `exp.train`
+        self.phase_timer = PhaseTimer(enabled=False)
+
     def encode(self, src_sents_var, src_sents_len):
         """Encode the input natural language utterance
 
@@ -204,48 +207,100 @@ class Parser(nn.Module):
 
         return h_0, Variable(self.new_tensor(h_0.size()).zero_())
 
+    def to_batch(self, examples):
+        """Build the `Batch` of a list of examples, including the input tensors of the encoder"""
+
+        batch = Batch(examples, self.grammar, self.vocab, copy=self.args.no_copy is False, cuda=self.args.cuda)
+        # compute the cached input tensors now, e.g. in the thread of a `BatchPrefetcher`
+        batch.src_sents_var, batch.src_token_mask
+
+        return batch
+
     def score(self, examples, return_encode_state=False):
         """Given a list of examples, compute the log-likelihood of generating the target AST
 
         Args:
-            examples: a batch of examples
+            examples: a batch of examples, or a `Batch` built by `to_batch`
             return_encode_state: return encoding states of input utterances
         output: score for each training example: Variable(batch_size)
         """
 
-        batch = Batch(examples, self.grammar, self.vocab, copy=self.args.no_copy is False, cuda=self.args.cuda)
+        if isinstance(examples, Batch):
+            batch = examples
+        else:
+            batch = Batch(examples, self.grammar, self.vocab, copy=self.args.no_copy is False, cuda=self.args.cuda)
+
+        # the phases of training iterations, not e.g. of the dev log-likelihood
+        timer = self.phase_timer if self.training else PhaseTimer(enabled=False)
 
         # src_encodings: (batch_size, src_sent_len, hidden_size * 2)
         # (last_state, last_cell, dec_init_vec): (batch_size, hidden_size)
+        timer.switch('encode')
         src_encodings, (last_state, last_cell) = self.encode(batch.src_sents_var, batch.src_sents_len)
         dec_init_vec = self.init_decoder_state(last_state, last_cell)
+        timer.switch('decode')
 
         # query vectors are sufficient statistics used to compute action probabilities
         # query_vectors: (tgt_action_len, batch_size, hidden_size)
-
-        # if use supervised attention
-        if self.args.sup_attention:
-            query_vectors, att_prob = self.decode(batch, src_encodings, dec_init_vec)
+        # or (packed_action_num, hidden_size) with the packed decoder, in which case
+        # the (tgt_action_len, batch_size) dimensions below are replaced by (packed_action_num)
+
+        packed = self.args.packed_decoder and not self.args.sup_attention
+        if packed:
+            query_vectors = self.decode_packed(batch, src_encodings, dec_init_vec)
+
+            # target actions and masks of the packed actions
+            packed_ids = (batch.packed_t_ids, batch.packed_example_ids)
+            apply_rule_idx = batch.apply_rule_idx_matrix[packed_ids]
+            apply_rule_mask = batch.apply_rule_mask[packed_ids]
+            primitive_idx = batch.primitive_idx_matrix[packed_ids]
+            gen_token_mask = batch.gen_token_mask[packed_ids]
+            primitive_copy_mask = batch.primitive_copy_mask[packed_ids]
         else:
-            query_vectors = self.decode(batch, src_encodings, dec_init_vec)
-
-        # ApplyRule (i.e., ApplyConstructor) action probabilities
-        # (tgt_action_len, batch_size, grammar_size)
-        apply_rule_prob = F.softmax(self.production_readout(query_vectors), dim=-1)
+            # if use supervised attention
+            if self.args.sup_attention:
+                query_vectors, att_prob = self.decode(batch, src_encodings, dec_init_vec)
+            else:
+                query_vectors = self.decode(batch, src_encodings, dec_init_vec)
+
+            apply_rule_idx = batch.apply_rule_idx_matrix
+            apply_rule_mask = batch.apply_rule_mask
+            primitive_idx = batch.primitive_idx_matrix
+            gen_token_mask = batch.gen_token_mask
+            primitive_copy_mask = batch.primitive_copy_mask
+
+        timer.switch('readout/loss')
+        lean = self.args.lean_loss
+        if lean:
+            # log-likelihoods of the target actions computed from the readout logits of a chunk of positions
+            # at a time, without keeping the probabilities over the whole grammar and primitive vocabulary
+            # (tgt_action_len, batch_size)
+            tgt_apply_rule_log_prob = nn_utils.chunked_readout(
+                lambda q, idx: nn_utils.log_softmax_gather(self.production_readout(q), idx),
+                query_vectors, apply_rule_idx)
+            tgt_primitive_gen_from_vocab_log_prob = nn_utils.chunked_readout(
+                lambda q, idx: nn_utils.log_softmax_gather(self.tgt_token_readout(q), idx),
+                query_vectors, primitive_idx)
+            tgt_apply_rule_prob = tgt_apply_rule_log_prob.exp()
+            tgt_primitive_gen_from_vocab_prob = tgt_primitive_gen_from_vocab_log_prob.exp()
+        else:
+            # ApplyRule (i.e., ApplyConstructor) action probabilities
+            # (tgt_action_len, batch_size, grammar_size)
+            apply_rule_prob = F.softmax(self.production_readout(query_vectors), dim=-1)
 
-        # probabilities of target (gold-standard) ApplyRule actions
-        # (tgt_action_len, batch_size)
-        tgt_apply_rule_prob = torch.gather(apply_rule_prob, dim=2,
-                                           index=batch.apply_rule_idx_matrix.unsqueeze(2)).squeeze(2)
+            # probabilities of target (gold-standard) ApplyRule actions
+            # (tgt_action_len, batch_size)
+            tgt_apply_rule_prob = torch.gather(apply_rule_prob, dim=-1,
+                                               index=apply_rule_idx.unsqueeze(-1)).squeeze(-1)
 
-        #### compute generation and copying probabilities
+            #### compute generation and copying probabilities
 
-        # (tgt_action_len, batch_size, primitive_vocab_size)
-        gen_from_vocab_prob = F.softmax(self.tgt_token_readout(query_vectors), dim=-1)
+            # (tgt_action_len, batch_size, primitive_vocab_size)
+            gen_from_vocab_prob = F.softmax(self.tgt_token_readout(query_vectors), dim=-1)
 
-        # (tgt_action_len, batch_size)
-        tgt_primitive_gen_from_vocab_prob = torch.gather(gen_from_vocab_prob, dim=2,
-                                                         index=batch.primitive_idx_matrix.unsqueeze(2)).squeeze(2)
+            # (tgt_action_len, batch_size)
+            tgt_primitive_gen_from_vocab_prob = torch.gather(gen_from_vocab_prob, dim=-1,
+                                                             index=primitive_idx.unsqueeze(-1)).squeeze(-1)
 
         if self.args.no_copy:
             # mask positions in action_prob that are not used
@@ -257,15 +312,23 @@ class Parser(nn.Module):
                 #     gen_from_vocab_prob.view(-1, gen_from_vocab_prob.size(-1)).log(),
                 #     batch.primitive_idx_matrix.view(-1)).view(-1, len(batch))
 
-                tgt_primitive_gen_from_vocab_log_prob = -self.label_smoothing(
-                    gen_from_vocab_prob.log(),
-                    batch.primitive_idx_matrix)
-            else:
+                if lean:
+                    tgt_primitive_gen_from_vocab_log_prob = -nn_utils.chunked_readout(
+                        lambda q, idx: self.label_smoothing.forward_logits(self.tgt_token_readout(q), idx),
+                        query_vectors, primitive_idx)
+                else:
+                    tgt_primitive_gen_from_vocab_log_prob = -self.label_smoothing(
+                        gen_from_vocab_prob.log(),
+                        primitive_idx)
+            elif not lean:
                 tgt_primitive_gen_from_vocab_log_prob = tgt_primitive_gen_from_vocab_prob.log()
 
+            if not lean:
+                tgt_apply_rule_log_prob = tgt_apply_rule_prob.log()
+
             # (tgt_action_len, batch_size)
-            action_prob = tgt_apply_rule_prob.log() * batch.apply_rule_mask + \
-                          tgt_primitive_gen_from_vocab_log_prob * batch.gen_token_mask
+            action_prob = tgt_apply_rule_log_prob * apply_rule_mask + \
+                          tgt_primitive_gen_from_vocab_log_prob * gen_token_mask
         else:
             # binary gating probabilities between generating or copying a primitive token
             # (tgt_action_len, batch_size, 2)
@@ -273,28 +336,48 @@ class Parser(nn.Module):
 
             # pointer network copying scores over source tokens
             # (tgt_action_len, batch_size, src_sent_len)
-            primitive_copy_prob = self.src_pointer_net(src_encodings, batch.src_token_mask, query_vectors)
+            if packed:
+                primitive_copy_prob = self.src_pointer_net.packed_forward(src_encodings, batch.src_token_mask,
+                                                                          query_vectors, batch.packed_example_ids)
+            else:
+                primitive_copy_prob = self.src_pointer_net(src_encodings, batch.src_token_mask, query_vectors)
 
             # marginalize over the copy probabilities of tokens that are same
             # (tgt_action_len, batch_size)
-            tgt_primitive_copy_prob = torch.sum(primitive_copy_prob * batch.primitive_copy_token_idx_mask, dim=-1)
+            if lean:
+                # sum the probabilities at the index lists of copy targets
+                copy_token_ids = batch.copy_token_packed_ids if packed else batch.copy_token_flat_ids
+                primitive_copy_prob = primitive_copy_prob.reshape(-1, primitive_copy_prob.size(-1))
+                tgt_primitive_copy_prob = Variable(self.new_tensor(primitive_copy_prob.size(0)).zero_()).index_add(
+                    0, copy_token_ids, primitive_copy_prob[copy_token_ids, batch.copy_token_pos]
+                ).view_as(tgt_apply_rule_prob)
+            else:
+                if packed:
+                    primitive_copy_token_idx_mask = batch.primitive_copy_token_idx_mask[packed_ids]
+                else:
+                    primitive_copy_token_idx_mask = batch.primitive_copy_token_idx_mask
+                tgt_primitive_copy_prob = torch.sum(primitive_copy_prob * primitive_copy_token_idx_mask, dim=-1)
 
             # mask positions in action_prob that are not used
             # (tgt_action_len, batch_size)
-            action_mask_pad = torch.eq(batch.apply_rule_mask + batch.gen_token_mask + batch.primitive_copy_mask, 0.)
+            action_mask_pad = torch.eq(apply_rule_mask + gen_token_mask + primitive_copy_mask, 0.)
             action_mask = 1. - action_mask_pad.float()
 
             # (tgt_action_len, batch_size)
-            action_prob = tgt_apply_rule_prob * batch.apply_rule_mask + \
-                          primitive_predictor[:, :, 0] * tgt_primitive_gen_from_vocab_prob * batch.gen_token_mask + \
-                          primitive_predictor[:, :, 1] * tgt_primitive_copy_prob * batch.primitive_copy_mask
+            action_prob = tgt_apply_rule_prob * apply_rule_mask + \
+                          primitive_predictor[..., 0] * tgt_primitive_gen_from_vocab_prob * gen_token_mask + \
+                          primitive_predictor[..., 1] * tgt_primitive_copy_prob * primitive_copy_mask
 
             # avoid nan in log
             action_prob.data.masked_fill_(action_mask_pad.data, 1.e-7)
 
             action_prob = action_prob.log() * action_mask
 
-        scores = torch.sum(action_prob, dim=0)
+        if packed:
+            # sum the log-likelihoods of the packed actions of each example
+            scores = Variable(self.new_tensor(len(batch)).zero_()).index_add(0, batch.packed_example_ids, action_prob)
+        else:
+            scores = torch.sum(action_prob, dim=0)
 
         returns = [scores]
         if self.args.sup_attention:
@@ -361,13 +444,25 @@ class Parser(nn.Module):
         # (batch_size, query_len, hidden_size)
         src_encodings_att_linear = self.att_src_linear(src_encodings)
 
-        zero_action_embed = Variable(self.new_tensor(args.action_embed_size).zero_())
+        # embeddings of the previous actions of all time steps, looked up at once in the concatenation of
+        # the production, primitive and zero (padding) embeddings
+        # (tgt_action_len, batch_size, action_embed_size)
+        zero_action_embed = Variable(self.new_tensor(1, args.action_embed_size).zero_())
+        action_embed_weight = torch.cat([self.production_embed.weight, self.primitive_embed.weight,
+                                         zero_action_embed], dim=0)
+        a_tm1_embeds_all = F.embedding(batch.prev_action_idx_matrix, action_embed_weight)
 
         att_vecs = []
-        history_states = []
         att_probs = []
         att_weights = []
 
+        if args.no_parent_state is False:
+            # decoder states of all time steps, preallocated and indexed by the time step of the parent action
+            # (max_action_num, batch_size, hidden_size)
+            history_states = Variable(self.new_tensor(batch.max_action_num, batch_size, args.hidden_size).zero_())
+            history_cells = Variable(self.new_tensor(batch.max_action_num, batch_size, args.hidden_size).zero_())
+            batch_ids = Variable(self.new_long_tensor(list(range(batch_size))))
+
         for t in range(batch.max_action_num):
             # the input to the decoder LSTM is a concatenation of multiple signals
             # [
@@ -389,28 +484,10 @@ class Parser(nn.Module):
                     offset += args.action_embed_size * (not args.no_parent_production_embed)
                     offset += args.field_embed_size * (not args.no_parent_field_embed)
 
-                    x[:, offset: offset + args.type_embed_size] = self.type_embed(Variable(self.new_long_tensor(
-                        [self.grammar.type2id[self.grammar.root_type] for e in batch.examples])))
+                    x[:, offset: offset + args.type_embed_size] = self.type_embed(Variable(
+                        self.new_long_tensor(batch_size).fill_(self.grammar.root_type.id)))
             else:
-                a_tm1_embeds = []
-                for example in batch.examples:
-                    # action t - 1
-                    if t < len(example.tgt_actions):
-                        a_tm1 = example.tgt_actions[t - 1]
-                        if isinstance(a_tm1.action, ApplyRuleAction):
-                            a_tm1_embed = self.production_embed.weight[self.grammar.prod2id[a_tm1.action.production]]
-                        elif isinstance(a_tm1.action, ReduceAction):
-                            a_tm1_embed = self.production_embed.weight[len(self.grammar)]
-                        else:
-                            a_tm1_embed = self.primitive_embed.weight[self.vocab.primitive[a_tm1.action.token]]
-                    else:
-                        a_tm1_embed = zero_action_embed
-
-                    a_tm1_embeds.append(a_tm1_embed)
-
-                a_tm1_embeds = torch.stack(a_tm1_embeds)
-
-                inputs = [a_tm1_embeds]
+                inputs = [a_tm1_embeds_all[t]]
                 if args.no_input_feed is False:
                     inputs.append(att_tm1)
                 if args.no_parent_production_embed is False:
@@ -424,15 +501,11 @@ class Parser(nn.Module):
                     inputs.append(parent_field_type_embed)
 
                 # append history states
-                actions_t = [e.tgt_actions[t] if t < len(e.tgt_actions) else None for e in batch.examples]
                 if args.no_parent_state is False:
-                    parent_states = torch.stack([history_states[p_t][0][batch_id]
-                                                 for batch_id, p_t in
-                                                 enumerate(a_t.parent_t if a_t else 0 for a_t in actions_t)])
-
-                    parent_cells = torch.stack([history_states[p_t][1][batch_id]
-                                                for batch_id, p_t in
-                                                enumerate(a_t.parent_t if a_t else 0 for a_t in actions_t)])
+                    parent_ts = batch.parent_t_matrix[t]
+                    # (batch_size, hidden_size)
+                    parent_states = history_states[parent_ts, batch_ids]
+                    parent_cells = history_cells[parent_ts, batch_ids]
 
                     if args.lstm == 'parent_feed':
                         h_tm1 = (h_tm1[0], h_tm1[1], parent_states, parent_cells)
@@ -458,7 +531,9 @@ class Parser(nn.Module):
                             else: att_prob = att_prob[0]
                             att_probs.append(att_prob)
 
-            history_states.append((h_t, cell_t))
+            if args.no_parent_state is False:
+                history_states[t] = h_t
+                history_cells[t] = cell_t
             att_vecs.append(att_t)
             att_weights.append(att_weight)
 
@@ -470,80 +545,313 @@ class Parser(nn.Module):
             return att_vecs, att_probs
         else: return att_vecs
 
-    def parse(self, src_sent, context=None, beam_size=5, debug=False):
+    def decode_packed(self, batch, src_encodings, dec_init_vec):
+        """Same as `decode`, but only compute the examples whose action sequences are not finished at each
+        time step, analogous to `pack_padded_sequence`. Examples are decoded in the order of
+        `batch.packed_example_order` (descending action sequence length), so that the live examples at
+        time step t are the first `batch.packed_batch_sizes[t]` ones
+
+        Args:
+            batch: a `Batch` object storing input examples
+            src_encodings: variable of shape (batch_size, src_sent_len, hidden_size * 2), encodings of source utterances
+            dec_init_vec: a tuple of variables representing initial decoder states
+
+        Returns:
+            Query vectors of the actions ordered by time step, a variable of shape (packed_action_num, hidden_size).
+            The i-th vector belongs to action `batch.packed_t_ids[i]` of example `batch.packed_example_ids[i]`
+        """
+
+        batch_size = len(batch)
+        args = self.args
+
+        # reorder the examples by descending action sequence length
+        order = batch.packed_example_order
+        src_encodings = src_encodings[order]
+        src_token_mask = batch.src_token_mask[order]
+        dec_init_vec = (dec_init_vec[0][order], dec_init_vec[1][order])
+
+        if args.lstm == 'parent_feed':
+            h_tm1 = dec_init_vec[0], dec_init_vec[1], \
+                    Variable(self.new_tensor(batch_size, args.hidden_size).zero_()), \
+                    Variable(self.new_tensor(batch_size, args.hidden_size).zero_())
+        else:
+            h_tm1 = dec_init_vec
+
+        # (batch_size, query_len, hidden_size)
+        src_encodings_att_linear = self.att_src_linear(src_encodings)
+
+        # (tgt_action_len, batch_size, action_embed_size)
+        zero_action_embed = Variable(self.new_tensor(1, args.action_embed_size).zero_())
+        action_embed_weight = torch.cat([self.production_embed.weight, self.primitive_embed.weight,
+                                         zero_action_embed], dim=0)
+        a_tm1_embeds_all = F.embedding(batch.prev_action_idx_matrix[:, order], action_embed_weight)
+
+        # (tgt_action_len, batch_size)
+        frontier_prod_idx_matrix = batch.frontier_prod_idx_matrix[:, order]
+        frontier_field_idx_matrix = batch.frontier_field_idx_matrix[:, order]
+        frontier_field_type_idx_matrix = batch.frontier_field_type_idx_matrix[:, order]
+        parent_t_matrix = batch.parent_t_matrix[:, order]
+
+        att_vecs = []
+
+        if args.no_parent_state is False:
+            # (max_action_num, batch_size, hidden_size)
+            history_states = Variable(self.new_tensor(batch.max_action_num, batch_size, args.hidden_size).zero_())
+            history_cells = Variable(self.new_tensor(batch.max_action_num, batch_size, args.hidden_size).zero_())
+            batch_ids = Variable(self.new_long_tensor(list(range(batch_size))))
+
+        for t, live_num in enumerate(batch.packed_batch_sizes):
+            # the states of the examples that are still being decoded
+            h_tm1 = tuple(h[:live_num] for h in h_tm1)
+
+            if t == 0:
+                x = Variable(self.new_tensor(batch_size, self.decoder_lstm.input_size).zero_(), requires_grad=False)
+
+                # initialize using the root type embedding
+                if args.no_parent_field_type_embed is False:
+                    offset = args.action_embed_size  # prev_action
+                    offset += args.att_vec_size * (not args.no_input_feed)
+                    offset += args.action_embed_size * (not args.no_parent_production_embed)
+                    offset += args.field_embed_size * (not args.no_parent_field_embed)
+
+                    x[:, offset: offset + args.type_embed_size] = self.type_embed(Variable(
+                        self.new_long_tensor(batch_size).fill_(self.grammar.root_type.id)))
+            else:
+                inputs = [a_tm1_embeds_all[t, :live_num]]
+                if args.no_input_feed is False:
+                    inputs.append(att_tm1[:live_num])
+                if args.no_parent_production_embed is False:
+                    inputs.append(self.production_embed(frontier_prod_idx_matrix[t, :live_num]))
+                if args.no_parent_field_embed is False:
+                    inputs.append(self.field_embed(frontier_field_idx_matrix[t, :live_num]))
+                if args.no_parent_field_type_embed is False:
+                    inputs.append(self.type_embed(frontier_field_type_idx_matrix[t, :live_num]))
+
+                # append history states
+                if args.no_parent_state is False:
+                    parent_ts = parent_t_matrix[t, :live_num]
+                    # (live_num, hidden_size)
+                    parent_states = history_states[parent_ts, batch_ids[:live_num]]
+                    parent_cells = history_cells[parent_ts, batch_ids[:live_num]]
+
+                    if args.lstm == 'parent_feed':
+                        h_tm1 = (h_tm1[0], h_tm1[1], parent_states, parent_cells)
+                    else:
+                        inputs.append(parent_states)
+
+                x = torch.cat(inputs, dim=-1)
+
+            (h_t, cell_t), att_t = self.step(x, h_tm1, src_encodings[:live_num],
+                                             src_encodings_att_linear[:live_num],
+                                             src_token_mask=src_token_mask[:live_num])
+
+            if args.no_parent_state is False:
+                history_states[t, :live_num] = h_t
+                history_cells[t, :live_num] = cell_t
+            att_vecs.append(att_t)
+
+            h_tm1 = (h_t, cell_t)
+            att_tm1 = att_t
+
+        return torch.cat(att_vecs, dim=0)
+
+    def get_production_mask(self):
+        """Get the mask of productions that are valid continuations for each frontier type
+
+        The mask is built once from the grammar and cached. The last column (Reduce) is left
+        to zero, since the validity of Reduce depends on the cardinality of the frontier field
+        rather than its type.
+
+        Returns:
+            Variable(num_types, len(grammar) + 1), with ones for the productions of each type
+        """
+
+        if getattr(self, '_production_mask', None) is None:
+            production_mask = [[0.] * (len(self.grammar) + 1) for _ in range(len(self.grammar.types))]
+            for asdl_type in self.grammar.composite_types:
+                for production in self.grammar[asdl_type]:
+                    production_mask[asdl_type.id][production.id] = 1.
+
+            self._production_mask = Variable(self.new_tensor(production_mask))
+            self._type_production_num = [int(sum(type_mask)) for type_mask in production_mask]
+
+        return self._production_mask
+
+    def parse(self, src_sent, context=None, beam_size=5, debug=False, early_stop_k=0, early_stop_heuristic=False,
+              beam_margin=None):
         """Perform beam search to infer the target AST given a source utterance
 
         Args:
             src_sent: list of source utterance tokens
             context: other context used for prediction
             beam_size: beam size
+            early_stop_k: see `parse_batch()`
+            early_stop_heuristic: see `parse_batch()`
+            beam_margin: see `parse_batch()`
 
         Returns:
             A list of `DecodeHypothesis`, each representing an AST
         """
 
+        return self.parse_batch([src_sent], context=context, beam_size=beam_size, debug=debug,
+                                early_stop_k=early_stop_k, early_stop_heuristic=early_stop_heuristic,
+                                beam_margin=beam_margin)[0]
+
+    def parse_batch(self, src_sents, context=None, beam_size=5, debug=False, early_stop_k=0, early_stop_heuristic=False,
+                    beam_margin=None):
+        """Perform beam search for a batch of source utterances at once
+
+        All utterances are encoded in a single packed pass. The live hypotheses of all
+        utterances are kept in one flat beam, so each decoding time step is a single call
+        of `step()` over at most `len(src_sents) * beam_size` rows. Hypotheses are expanded
+        and pruned per utterance, hence the results are the same as calling `parse()` on
+        each utterance.
+
+        Args:
+            src_sents: list of source utterances, each is a list of tokens
+            context: other context used for prediction
+            beam_size: beam size
+            early_stop_k: if positive, stop searching for an utterance once no live hypothesis could
+                          beat its k-th best completed hypothesis. The top k results are the same as
+                          those of the full search, while the rest may be missing
+            early_stop_heuristic: with `early_stop_k`, compare the live hypotheses with the completed ones
+                                  by their length-normalized scores so far instead of a provable bound.
+                                  The search stops much earlier, but it is lossy: a live hypothesis whose
+                                  remaining actions are more likely on average than its previous ones could
+                                  have beaten the k-th best result
+            beam_margin: if set, prune live hypotheses whose scores are lower than the best live
+                         hypothesis of the same utterance by more than this margin
+
+        Returns:
+            A list of lists of `DecodeHypothesis`, one list for each source utterance
+        """
+
         args = self.args
         primitive_vocab = self.vocab.primitive
         T = torch.cuda if args.cuda else torch
 
-        src_sent_var = nn_utils.to_input_variable([src_sent], self.vocab.source, cuda=args.cuda, training=False)
-
-        # Variable(1, src_sent_len, hidden_size * 2)
-        src_encodings, (last_state, last_cell) = self.encode(src_sent_var, [len(src_sent)])
-        # (1, src_sent_len, hidden_size)
+        batch_size = len(src_sents)
+        src_sents_len = [len(src_sent) for src_sent in src_sents]
+
+        # the encoder requires utterances sorted by their lengths in descending order
+        sorted_example_ids = sorted(range(batch_size), key=lambda e_id: -src_sents_len[e_id])
+        restore_example_ids = [0] * batch_size
+        for sorted_pos, e_id in enumerate(sorted_example_ids):
+            restore_example_ids[e_id] = sorted_pos
+        restore_example_ids = Variable(self.new_long_tensor(restore_example_ids))
+
+        src_sents_var = nn_utils.to_input_variable([src_sents[e_id] for e_id in sorted_example_ids],
+                                                   self.vocab.source, cuda=args.cuda, training=False)
+
+        # Variable(batch_size, src_sent_len, hidden_size * 2)
+        src_encodings, (last_state, last_cell) = self.encode(src_sents_var,
+                                                             [src_sents_len[e_id] for e_id in sorted_example_ids])
+        src_encodings = src_encodings.index_select(0, restore_example_ids)
+        last_state = last_state.index_select(0, restore_example_ids)
+        last_cell = last_cell.index_select(0, restore_example_ids)
+        # (batch_size, src_sent_len, hidden_size)
         src_encodings_att_linear = self.att_src_linear(src_encodings)
+        # (batch_size, src_sent_len), padding positions are masked to one
+        src_token_mask = nn_utils.length_array_to_mask_tensor(src_sents_len, cuda=args.cuda)
 
         dec_init_vec = self.init_decoder_state(last_state, last_cell)
         if args.lstm == 'parent_feed':
             h_tm1 = dec_init_vec[0], dec_init_vec[1], \
-                    Variable(self.new_tensor(args.hidden_size).zero_()), \
-                    Variable(self.new_tensor(args.hidden_size).zero_())
+                    Variable(self.new_tensor(batch_size, args.hidden_size).zero_()), \
+                    Variable(self.new_tensor(batch_size, args.hidden_size).zero_())
         else:
             h_tm1 = dec_init_vec
 
         zero_action_embed = Variable(self.new_tensor(args.action_embed_size).zero_())
 
         with torch.no_grad():
-            hyp_scores = Variable(self.new_tensor([0.]))
+            hyp_scores = Variable(self.new_tensor([0.] * batch_size))
 
         # For computing copy probabilities, we marginalize over tokens with the same surface form
         # `aggregated_primitive_tokens` stores the position of occurrence of each source token
-        aggregated_primitive_tokens = OrderedDict()
-        for token_pos, token in enumerate(src_sent):
-            aggregated_primitive_tokens.setdefault(token, []).append(token_pos)
+        batch_aggregated_primitive_tokens = []
+        for src_sent in src_sents:
+            aggregated_primitive_tokens = OrderedDict()
+            for token_pos, token in enumerate(src_sent):
+                aggregated_primitive_tokens.setdefault(token, []).append(token_pos)
+            batch_aggregated_primitive_tokens.append(aggregated_primitive_tokens)
 
-        t = 0
-        hypotheses = [DecodeHypothesis()]
-        hyp_states = [[]]
-        completed_hypotheses = []
+        if args.no_copy is False:
+            # the marginalization is precomputed once per utterance as a sparse scatter from source positions
+            # to the primitive vocabulary (`src_token_primitive_ids`, `src_token_in_vocab_mask`), and a one-hot
+            # matrix from source positions to the slots of distinct out-of-vocabulary tokens (`src_token_unk_slot_mask`)
+            batch_src_unk_tokens = [[token for token in aggregated_primitive_tokens if token not in primitive_vocab]
+                                    for aggregated_primitive_tokens in batch_aggregated_primitive_tokens]
+            max_src_sent_len = max(src_sents_len)
+            max_unk_num = max(len(src_unk_tokens) for src_unk_tokens in batch_src_unk_tokens)
+
+            src_token_primitive_ids = [[0] * max_src_sent_len for _ in range(batch_size)]
+            src_token_in_vocab_mask = [[0.] * max_src_sent_len for _ in range(batch_size)]
+            src_token_unk_slot_mask = [[[0.] * max(max_unk_num, 1) for _ in range(max_src_sent_len)]
+                                       for _ in range(batch_size)]
+            for e_id, src_sent in enumerate(src_sents):
+                src_unk_slot_ids = {token: slot_id for slot_id, token in enumerate(batch_src_unk_tokens[e_id])}
+                for token_pos, token in enumerate(src_sent):
+                    if token in src_unk_slot_ids:
+                        src_token_unk_slot_mask[e_id][token_pos][src_unk_slot_ids[token]] = 1.
+                    else:
+                        src_token_primitive_ids[e_id][token_pos] = primitive_vocab[token]
+                        src_token_in_vocab_mask[e_id][token_pos] = 1.
+
+            # (batch_size, src_sent_len)
+            src_token_primitive_ids = Variable(self.new_long_tensor(src_token_primitive_ids))
+            src_token_in_vocab_mask = Variable(self.new_tensor(src_token_in_vocab_mask))
+            # (batch_size, src_sent_len, max_unk_num)
+            src_token_unk_slot_mask = Variable(self.new_tensor(src_token_unk_slot_mask))
+            # (batch_size)
+            src_has_unk = Variable(self.new_tensor([1. if src_unk_tokens else 0.
+                                                    for src_unk_tokens in batch_src_unk_tokens]))
 
-        while len(completed_hypotheses) < beam_size and t < args.decode_max_time_step:
+        t = 0
+        # live hypotheses of all utterances, stored in a flat list. `hyp_example_ids` records the
+        # utterance each hypothesis belongs to, and hypotheses of the same utterance are contiguous
+        hypotheses = [PersistentDecodeHypothesis() for _ in range(batch_size)]
+        hyp_example_ids = list(range(batch_size))
+        completed_hypotheses = [[] for _ in range(batch_size)]
+
+        if args.no_parent_state is False:
+            # decoder states of the live hypotheses at all time steps, preallocated for the largest beam.
+            # The first `hyp_num` rows are used, and reordered along with the beam at each time step
+            # (decode_max_time_step, batch_size * beam_size, hidden_size)
+            max_hyp_num = batch_size * beam_size
+            history_states = Variable(self.new_tensor(args.decode_max_time_step, max_hyp_num, args.hidden_size).zero_())
+            history_cells = Variable(self.new_tensor(args.decode_max_time_step, max_hyp_num, args.hidden_size).zero_())
+
+        while t < args.decode_max_time_step:
             hyp_num = len(hypotheses)
+            hyp_example_ids_var = Variable(self.new_long_tensor(hyp_example_ids))
 
             # (hyp_num, src_sent_len, hidden_size * 2)
-            exp_src_encodings = src_encodings.expand(hyp_num, src_encodings.size(1), src_encodings.size(2))
+            exp_src_encodings = src_encodings.index_select(0, hyp_example_ids_var)
             # (hyp_num, src_sent_len, hidden_size)
-            exp_src_encodings_att_linear = src_encodings_att_linear.expand(hyp_num, src_encodings_att_linear.size(1), src_encodings_att_linear.size(2))
+            exp_src_encodings_att_linear = src_encodings_att_linear.index_select(0, hyp_example_ids_var)
+            # (hyp_num, src_sent_len)
+            exp_src_token_mask = src_token_mask.index_select(0, hyp_example_ids_var)
 
             if t == 0:
                 with torch.no_grad():
-                    x = Variable(self.new_tensor(1, self.decoder_lstm.input_size).zero_())
+                    x = Variable(self.new_tensor(hyp_num, self.decoder_lstm.input_size).zero_())
                 if args.no_parent_field_type_embed is False:
                     offset = args.action_embed_size  # prev_action
                     offset += args.att_vec_size * (not args.no_input_feed)
                     offset += args.action_embed_size * (not args.no_parent_production_embed)
                     offset += args.field_embed_size * (not args.no_parent_field_embed)
 
-                    x[0, offset: offset + args.type_embed_size] = \
-                        self.type_embed.weight[self.grammar.type2id[self.grammar.root_type]]
+                    x[:, offset: offset + args.type_embed_size] = \
+                        self.type_embed.weight[self.grammar.root_type.id]
             else:
-                actions_tm1 = [hyp.actions[-1] for hyp in hypotheses]
+                actions_tm1 = [hyp.action_info.action for hyp in hypotheses]
 
                 a_tm1_embeds = []
                 for a_tm1 in actions_tm1:
                     if a_tm1:
                         if isinstance(a_tm1, ApplyRuleAction):
-                            a_tm1_embed = self.production_embed.weight[self.grammar.prod2id[a_tm1.production]]
+                            a_tm1_embed = self.production_embed.weight[a_tm1.production.id]
                         elif isinstance(a_tm1, ReduceAction):
                             a_tm1_embed = self.production_embed.weight[len(self.grammar)]
                         else:
@@ -561,27 +869,29 @@ class Parser(nn.Module):
                     # frontier production
                     frontier_prods = [hyp.frontier_node.production for hyp in hypotheses]
                     frontier_prod_embeds = self.production_embed(Variable(self.new_long_tensor(
-                        [self.grammar.prod2id[prod] for prod in frontier_prods])))
+                        [prod.id for prod in frontier_prods])))
                     inputs.append(frontier_prod_embeds)
                 if args.no_parent_field_embed is False:
                     # frontier field
                     frontier_fields = [hyp.frontier_field.field for hyp in hypotheses]
                     frontier_field_embeds = self.field_embed(Variable(self.new_long_tensor([
-                        self.grammar.field2id[field] for field in frontier_fields])))
+                        field.id for field in frontier_fields])))
 
                     inputs.append(frontier_field_embeds)
                 if args.no_parent_field_type_embed is False:
                     # frontier field type
                     frontier_field_types = [hyp.frontier_field.type for hyp in hypotheses]
                     frontier_field_type_embeds = self.type_embed(Variable(self.new_long_tensor([
-                        self.grammar.type2id[type] for type in frontier_field_types])))
+                        type.id for type in frontier_field_types])))
                     inputs.append(frontier_field_type_embeds)
 
                 # parent states
                 if args.no_parent_state is False:
-                    p_ts = [hyp.frontier_node.created_time for hyp in hypotheses]
-                    parent_states = torch.stack([hyp_states[hyp_id][p_t][0] for hyp_id, p_t in enumerate(p_ts)])
-                    parent_cells = torch.stack([hyp_states[hyp_id][p_t][1] for hyp_id, p_t in enumerate(p_ts)])
+                    parent_ts = Variable(self.new_long_tensor([hyp.frontier_node.created_time for hyp in hypotheses]))
+                    hyp_ids = Variable(self.new_long_tensor(list(range(hyp_num))))
+                    # (hyp_num, hidden_size)
+                    parent_states = history_states[parent_ts, hyp_ids]
+                    parent_cells = history_cells[parent_ts, hyp_ids]
 
                     if args.lstm == 'parent_feed':
                         h_tm1 = (h_tm1[0], h_tm1[1], parent_states, parent_cells)
@@ -592,7 +902,7 @@ class Parser(nn.Module):
 
             (h_t, cell_t), att_t = self.step(x, h_tm1, exp_src_encodings,
                                              exp_src_encodings_att_linear,
-                                             src_token_mask=None)
+                                             src_token_mask=exp_src_token_mask)
 
             # Variable(batch_size, grammar_size)
             # apply_rule_log_prob = torch.log(F.softmax(self.production_readout(att_t), dim=-1))
@@ -605,7 +915,8 @@ class Parser(nn.Module):
                 primitive_prob = gen_from_vocab_prob
             else:
                 # Variable(batch_size, src_sent_len)
-                primitive_copy_prob = self.src_pointer_net(src_encodings, None, att_t.unsqueeze(0)).squeeze(0)
+                primitive_copy_prob = self.src_pointer_net(exp_src_encodings, exp_src_token_mask,
+                                                           att_t.unsqueeze(0)).squeeze(0)
 
                 # Variable(batch_size, 2)
                 primitive_predictor_prob = F.softmax(self.primitive_predictor(att_t), dim=-1)
@@ -616,176 +927,425 @@ class Parser(nn.Module):
                 # if src_unk_pos_list:
                 #     primitive_prob[:, primitive_vocab.unk_id] = 1.e-10
 
-            gentoken_prev_hyp_ids = []
-            gentoken_new_hyp_unks = []
-            applyrule_new_hyp_scores = []
-            applyrule_new_hyp_prod_ids = []
-            applyrule_prev_hyp_ids = []
-
-            for hyp_id, hyp in enumerate(hypotheses):
-                # generate new continuations
+                # Variable(batch_size, src_sent_len)
+                gated_copy_prob = primitive_predictor_prob[:, 1].unsqueeze(1) * primitive_copy_prob
+
+                # add the copy probabilities of in-vocabulary source tokens to their generation probabilities,
+                # marginalizing over source positions with the same surface form
+                primitive_prob.scatter_add_(1, src_token_primitive_ids.index_select(0, hyp_example_ids_var),
+                                            gated_copy_prob * src_token_in_vocab_mask.index_select(0, hyp_example_ids_var))
+
+                # the probability of <unk> is replaced by the copy probability of the most likely
+                # out-of-vocabulary source token
+                # Variable(batch_size, max_unk_num)
+                unk_copy_prob = torch.bmm(gated_copy_prob.unsqueeze(1),
+                                          src_token_unk_slot_mask.index_select(0, hyp_example_ids_var)).squeeze(1)
+                best_unk_copy_prob, best_unk_slot_ids = torch.max(unk_copy_prob, dim=1)
+                exp_src_has_unk = src_has_unk.index_select(0, hyp_example_ids_var)
+                primitive_prob[:, primitive_vocab.unk_id] = exp_src_has_unk * best_unk_copy_prob + \
+                                                            (1. - exp_src_has_unk) * primitive_prob[:, primitive_vocab.unk_id]
+                best_unk_slot_ids = best_unk_slot_ids.data.cpu().tolist()
+
+            # the valid continuations of each live hypothesis, given by the type of its frontier field
+            # and whether it could be followed by Reduce or GenToken actions
+            production_mask = self.get_production_mask()
+            frontier_type_ids = []
+            reduce_flags = []
+            gentoken_flags = []
+            hyp_candidate_nums = []
+            for hyp in hypotheses:
                 action_types = self.transition_system.get_valid_continuation_types(hyp)
-
-                for action_type in action_types:
-                    if action_type == ApplyRuleAction:
-                        productions = self.transition_system.get_valid_continuating_productions(hyp)
-                        for production in productions:
-                            prod_id = self.grammar.prod2id[production]
-                            prod_score = apply_rule_log_prob[hyp_id, prod_id].data.item()
-                            new_hyp_score = hyp.score + prod_score
-
-                            applyrule_new_hyp_scores.append(new_hyp_score)
-                            applyrule_new_hyp_prod_ids.append(prod_id)
-                            applyrule_prev_hyp_ids.append(hyp_id)
-                    elif action_type == ReduceAction:
-                        action_score = apply_rule_log_prob[hyp_id, len(self.grammar)].data.item()
-                        new_hyp_score = hyp.score + action_score
-
-                        applyrule_new_hyp_scores.append(new_hyp_score)
-                        applyrule_new_hyp_prod_ids.append(len(self.grammar))
-                        applyrule_prev_hyp_ids.append(hyp_id)
-                    else:
-                        # GenToken action
-                        gentoken_prev_hyp_ids.append(hyp_id)
-                        hyp_copy_info = dict()  # of (token_pos, copy_prob)
-                        hyp_unk_copy_info = []
-
-                        if args.no_copy is False:
-                            for token, token_pos_list in aggregated_primitive_tokens.items():
-                                sum_copy_prob = torch.gather(primitive_copy_prob[hyp_id], 0, Variable(T.LongTensor(token_pos_list))).sum()
-                                gated_copy_prob = primitive_predictor_prob[hyp_id, 1] * sum_copy_prob
-
-                                if token in primitive_vocab:
-                                    token_id = primitive_vocab[token]
-                                    primitive_prob[hyp_id, token_id] = primitive_prob[hyp_id, token_id] + gated_copy_prob
-
-                                    hyp_copy_info[token] = (token_pos_list, gated_copy_prob.data.item())
-                                else:
-                                    hyp_unk_copy_info.append({'token': token, 'token_pos_list': token_pos_list,
-                                                              'copy_prob': gated_copy_prob.data.item()})
-
-                        if args.no_copy is False and len(hyp_unk_copy_info) > 0:
-                            unk_i = np.array([x['copy_prob'] for x in hyp_unk_copy_info]).argmax()
-                            token = hyp_unk_copy_info[unk_i]['token']
-                            primitive_prob[hyp_id, primitive_vocab.unk_id] = hyp_unk_copy_info[unk_i]['copy_prob']
-                            gentoken_new_hyp_unks.append(token)
-
-                            hyp_copy_info[token] = (hyp_unk_copy_info[unk_i]['token_pos_list'], hyp_unk_copy_info[unk_i]['copy_prob'])
-
-            new_hyp_scores = None
-            if applyrule_new_hyp_scores:
-                new_hyp_scores = Variable(self.new_tensor(applyrule_new_hyp_scores))
-            if gentoken_prev_hyp_ids:
-                primitive_log_prob = torch.log(primitive_prob)
-                gen_token_new_hyp_scores = (hyp_scores[gentoken_prev_hyp_ids].unsqueeze(1) + primitive_log_prob[gentoken_prev_hyp_ids, :]).view(-1)
-
-                if new_hyp_scores is None: new_hyp_scores = gen_token_new_hyp_scores
-                else: new_hyp_scores = torch.cat([new_hyp_scores, gen_token_new_hyp_scores])
-            top_new_hyp_scores, top_new_hyp_pos = torch.topk(new_hyp_scores,
-                                                             k=min(new_hyp_scores.size(0), beam_size - len(completed_hypotheses)))
+                frontier_type_id = (hyp.frontier_field.type if hyp.t > 0 else self.grammar.root_type).id
+                frontier_type_ids.append(frontier_type_id)
+                reduce_flags.append(1. if ReduceAction in action_types else 0.)
+                gentoken_flags.append(1. if GenTokenAction in action_types else 0.)
+                hyp_candidate_nums.append(self._type_production_num[frontier_type_id] +
+                                          (ReduceAction in action_types) +
+                                          (GenTokenAction in action_types) * primitive_prob.size(1))
+
+            # Variable(batch_size, len(grammar) + 1), valid ApplyRule and Reduce actions of each hypothesis
+            applyrule_mask = production_mask.index_select(0, Variable(self.new_long_tensor(frontier_type_ids)))
+            applyrule_mask[:, len(self.grammar)] = Variable(self.new_tensor(reduce_flags))
+            # Variable(batch_size, 1)
+            gentoken_mask = Variable(self.new_tensor(gentoken_flags)).unsqueeze(1)
+
+            # scores of all continuations, the first `len(grammar) + 1` columns are ApplyRule and Reduce actions,
+            # followed by GenToken actions of each primitive token
+            # Variable(batch_size, len(grammar) + 1 + primitive_vocab_size)
+            new_hyp_scores = torch.cat([apply_rule_log_prob.masked_fill(applyrule_mask == 0, -float('inf')),
+                                        torch.log(primitive_prob).masked_fill(gentoken_mask == 0, -float('inf'))],
+                                       dim=-1)
+            new_hyp_scores = hyp_scores.unsqueeze(1) + new_hyp_scores
+
+            # two-stage top-k: first over the continuations of each hypothesis, then over the
+            # hypotheses of each utterance
+            example_hyp_ids = OrderedDict()
+            for hyp_id, e_id in enumerate(hyp_example_ids):
+                example_hyp_ids.setdefault(e_id, []).append(hyp_id)
+            max_example_hyp_num = max(len(e_hyp_ids) for e_hyp_ids in example_hyp_ids.values())
+
+            hyp_top_k = min(beam_size, new_hyp_scores.size(1))
+            # Variable(batch_size, hyp_top_k)
+            hyp_top_new_hyp_scores, hyp_top_new_hyp_pos = torch.topk(new_hyp_scores, k=hyp_top_k, dim=1)
+            # pad with an extra row of -inf scores, so that utterances with less live hypotheses are filled with it
+            hyp_top_new_hyp_scores = torch.cat([hyp_top_new_hyp_scores,
+                                                Variable(self.new_tensor(1, hyp_top_k).fill_(-float('inf')))])
+            example_hyp_ids_var = Variable(self.new_long_tensor(
+                [e_hyp_ids + [hyp_num] * (max_example_hyp_num - len(e_hyp_ids)) for e_hyp_ids in example_hyp_ids.values()]))
+            # Variable(example_num, max_example_hyp_num * hyp_top_k)
+            example_new_hyp_scores = hyp_top_new_hyp_scores.index_select(0, example_hyp_ids_var.view(-1)).view(
+                len(example_hyp_ids), max_example_hyp_num * hyp_top_k)
+            example_top_new_hyp_scores, example_top_new_hyp_pos = torch.topk(
+                example_new_hyp_scores, k=min(beam_size, example_new_hyp_scores.size(1)), dim=1)
+
+            example_top_new_hyp_scores = example_top_new_hyp_scores.data.cpu().tolist()
+            example_top_new_hyp_pos = example_top_new_hyp_pos.data.cpu().tolist()
+            hyp_top_new_hyp_pos = hyp_top_new_hyp_pos.data.cpu().tolist()
 
             live_hyp_ids = []
             new_hypotheses = []
-            for new_hyp_score, new_hyp_pos in zip(top_new_hyp_scores.data.cpu(), top_new_hyp_pos.data.cpu()):
-                action_info = ActionInfo()
-                if new_hyp_pos < len(applyrule_new_hyp_scores):
-                    # it's an ApplyRule or Reduce action
-                    prev_hyp_id = applyrule_prev_hyp_ids[new_hyp_pos]
+            new_hyp_example_ids = []
+
+            for example_pos, (e_id, e_hyp_ids) in enumerate(example_hyp_ids.items()):
+                aggregated_primitive_tokens = batch_aggregated_primitive_tokens[e_id]
+                e_completed_hypotheses = completed_hypotheses[e_id]
+
+                top_k = min(sum(hyp_candidate_nums[hyp_id] for hyp_id in e_hyp_ids),
+                            beam_size - len(e_completed_hypotheses))
+                top_new_hyp_scores = example_top_new_hyp_scores[example_pos][:top_k]
+                top_new_hyp_pos = example_top_new_hyp_pos[example_pos][:top_k]
+
+                e_new_hypotheses = []
+                e_live_hyp_ids = []
+
+                for new_hyp_score, new_hyp_pos in zip(top_new_hyp_scores, top_new_hyp_pos):
+                    prev_hyp_id = e_hyp_ids[new_hyp_pos // hyp_top_k]
                     prev_hyp = hypotheses[prev_hyp_id]
+                    action_pos = hyp_top_new_hyp_pos[prev_hyp_id][new_hyp_pos % hyp_top_k]
 
-                    prod_id = applyrule_new_hyp_prod_ids[new_hyp_pos]
-                    # ApplyRule action
-                    if prod_id < len(self.grammar):
-                        production = self.grammar.id2prod[prod_id]
+                    action_info = ActionInfo()
+                    if action_pos < len(self.grammar):
+                        # ApplyRule action
+                        production = self.grammar.id2prod[action_pos]
                         action = ApplyRuleAction(production)
-                    # Reduce action
-                    else:
+                    elif action_pos == len(self.grammar):
+                        # Reduce action
                         action = ReduceAction()
-                else:
-                    # it's a GenToken action
-                    token_id = (new_hyp_pos - len(applyrule_new_hyp_scores)) % primitive_prob.size(1)
-
-                    k = (new_hyp_pos - len(applyrule_new_hyp_scores)) // primitive_prob.size(1)
-                    # try:
-                    # copy_info = gentoken_copy_infos[k]
-                    prev_hyp_id = gentoken_prev_hyp_ids[k]
-                    prev_hyp = hypotheses[prev_hyp_id]
-                    # except:
-                    #     print('k=%d' % k, file=sys.stderr)
-                    #     print('primitive_prob.size(1)=%d' % primitive_prob.size(1), file=sys.stderr)
-                    #     print('len copy_info=%d' % len(gentoken_copy_infos), file=sys.stderr)
-                    #     print('prev_hyp_id=%s' % ', '.join(str(i) for i in gentoken_prev_hyp_ids), file=sys.stderr)
-                    #     print('len applyrule_new_hyp_scores=%d' % len(applyrule_new_hyp_scores), file=sys.stderr)
-                    #     print('len gentoken_prev_hyp_ids=%d' % len(gentoken_prev_hyp_ids), file=sys.stderr)
-                    #     print('top_new_hyp_pos=%s' % top_new_hyp_pos, file=sys.stderr)
-                    #     print('applyrule_new_hyp_scores=%s' % applyrule_new_hyp_scores, file=sys.stderr)
-                    #     print('new_hyp_scores=%s' % new_hyp_scores, file=sys.stderr)
-                    #     print('top_new_hyp_scores=%s' % top_new_hyp_scores, file=sys.stderr)
-                    #
-                    #     torch.save((applyrule_new_hyp_scores, primitive_prob), 'data.bin')
-                    #
-                    #     # exit(-1)
-                    #     raise ValueError()
-
-                    if token_id == primitive_vocab.unk_id:
-                        if gentoken_new_hyp_unks:
-                            token = gentoken_new_hyp_unks[k]
-                        else:
-                            token = primitive_vocab.id2word[primitive_vocab.unk_id]
                     else:
-                        token = primitive_vocab.id2word[token_id.item()]
-
-                    action = GenTokenAction(token)
+                        # GenToken action
+                        token_id = action_pos - len(self.grammar) - 1
 
-                    if token in aggregated_primitive_tokens:
-                        action_info.copy_from_src = True
-                        action_info.src_token_position = aggregated_primitive_tokens[token]
+                        if token_id == primitive_vocab.unk_id:
+                            if args.no_copy is False and batch_src_unk_tokens[e_id]:
+                                token = batch_src_unk_tokens[e_id][best_unk_slot_ids[prev_hyp_id]]
+                            else:
+                                token = primitive_vocab.id2word[primitive_vocab.unk_id]
+                        else:
+                            token = primitive_vocab.id2word[token_id]
+
+                        action = GenTokenAction(token)
+
+                        if token in aggregated_primitive_tokens:
+                            action_info.copy_from_src = True
+                            action_info.src_token_position = aggregated_primitive_tokens[token]
+
+                        if debug:
+                            action_info.gen_copy_switch = 'n/a' if args.no_copy else primitive_predictor_prob[prev_hyp_id, :].log().cpu().data.numpy()
+                            action_info.in_vocab = token in primitive_vocab
+                            action_info.gen_token_prob = gen_from_vocab_prob[prev_hyp_id, token_id].log().cpu().data.item() \
+                                if token in primitive_vocab else 'n/a'
+                            action_info.copy_token_prob = torch.gather(primitive_copy_prob[prev_hyp_id],
+                                                                       0,
+                                                                       Variable(T.LongTensor(action_info.src_token_position))).sum().log().cpu().data.item() \
+                                if args.no_copy is False and action_info.copy_from_src else 'n/a'
+
+                    action_info.action = action
+                    action_info.t = t
+                    if t > 0:
+                        action_info.parent_t = prev_hyp.frontier_node.created_time
+                        action_info.frontier_prod = prev_hyp.frontier_node.production
+                        action_info.frontier_field = prev_hyp.frontier_field.field
 
                     if debug:
-                        action_info.gen_copy_switch = 'n/a' if args.no_copy else primitive_predictor_prob[prev_hyp_id, :].log().cpu().data.numpy()
-                        action_info.in_vocab = token in primitive_vocab
-                        action_info.gen_token_prob = gen_from_vocab_prob[prev_hyp_id, token_id].log().cpu().data.item() \
-                            if token in primitive_vocab else 'n/a'
-                        action_info.copy_token_prob = torch.gather(primitive_copy_prob[prev_hyp_id],
-                                                                   0,
-                                                                   Variable(T.LongTensor(action_info.src_token_position))).sum().log().cpu().data.item() \
-                            if args.no_copy is False and action_info.copy_from_src else 'n/a'
-
-                action_info.action = action
-                action_info.t = t
-                if t > 0:
-                    action_info.parent_t = prev_hyp.frontier_node.created_time
-                    action_info.frontier_prod = prev_hyp.frontier_node.production
-                    action_info.frontier_field = prev_hyp.frontier_field.field
+                        action_info.action_prob = new_hyp_score - prev_hyp.score
 
-                if debug:
-                    action_info.action_prob = new_hyp_score - prev_hyp.score
-
-                new_hyp = prev_hyp.clone_and_apply_action_info(action_info)
-                new_hyp.score = new_hyp_score
+                    new_hyp = prev_hyp.clone_and_apply_action_info(action_info)
+                    new_hyp.score = new_hyp_score
 
-                if new_hyp.completed:
-                    # add length normalization
-                    new_hyp.score /= (t+1)
-                    completed_hypotheses.append(new_hyp)
-                else:
-                    new_hypotheses.append(new_hyp)
-                    live_hyp_ids.append(prev_hyp_id)
+                    if new_hyp.completed:
+                        # add length normalization
+                        new_hyp.score /= (t+1)
+                        # only completed hypotheses are materialized into ASTs
+                        e_completed_hypotheses.append(new_hyp.to_decode_hypothesis())
+                    else:
+                        e_new_hypotheses.append(new_hyp)
+                        e_live_hyp_ids.append(prev_hyp_id)
+
+                if e_new_hypotheses and beam_margin is not None:
+                    # adaptive beam, live hypotheses have the same length and their scores are comparable
+                    best_live_score = max(hyp.score for hyp in e_new_hypotheses)
+                    e_kept_ids = [i for i, hyp in enumerate(e_new_hypotheses)
+                                  if hyp.score >= best_live_score - beam_margin]
+                    e_new_hypotheses = [e_new_hypotheses[i] for i in e_kept_ids]
+                    e_live_hyp_ids = [e_live_hyp_ids[i] for i in e_kept_ids]
+
+                if e_new_hypotheses and 0 < early_stop_k <= len(e_completed_hypotheses):
+                    # the score of a live hypothesis only decreases as more actions are applied, and it is
+                    # normalized by at most `decode_max_time_step` when completed. Since scores are negative,
+                    # `score / decode_max_time_step` bounds the normalized score of all its completions.
+                    # The heuristic uses the length so far, `t + 1` actions, instead
+                    length_normalizer = t + 1 if early_stop_heuristic else args.decode_max_time_step
+                    kth_best_completed_score = sorted([hyp.score for hyp in e_completed_hypotheses],
+                                                      reverse=True)[early_stop_k - 1]
+                    if all(hyp.score / length_normalizer <= kth_best_completed_score
+                           for hyp in e_new_hypotheses):
+                        e_new_hypotheses = []
+                        e_live_hyp_ids = []
+
+                new_hypotheses.extend(e_new_hypotheses)
+                new_hyp_example_ids.extend([e_id] * len(e_new_hypotheses))
+                live_hyp_ids.extend(e_live_hyp_ids)
 
             if live_hyp_ids:
-                hyp_states = [hyp_states[i] + [(h_t[i], cell_t[i])] for i in live_hyp_ids]
+                if args.no_parent_state is False:
+                    # reorder the history along with the beam
+                    live_hyp_ids_var = Variable(self.new_long_tensor(live_hyp_ids))
+                    history_states[t, :hyp_num] = h_t
+                    history_cells[t, :hyp_num] = cell_t
+                    history_states[:t + 1, :len(live_hyp_ids)] = history_states[:t + 1].index_select(1, live_hyp_ids_var)
+                    history_cells[:t + 1, :len(live_hyp_ids)] = history_cells[:t + 1].index_select(1, live_hyp_ids_var)
+
                 h_tm1 = (h_t[live_hyp_ids], cell_t[live_hyp_ids])
                 att_tm1 = att_t[live_hyp_ids]
                 hypotheses = new_hypotheses
+                hyp_example_ids = new_hyp_example_ids
                 hyp_scores = Variable(self.new_tensor([hyp.score for hyp in hypotheses]))
                 t += 1
             else:
                 break
 
-        completed_hypotheses.sort(key=lambda hyp: -hyp.score)
+        for e_completed_hypotheses in completed_hypotheses:
+            e_completed_hypotheses.sort(key=lambda hyp: -hyp.score)
 
         return completed_hypotheses
 
+    def greedy_parse(self, src_sent, context=None, debug=False):
+        """Perform greedy decoding to infer the target AST given a source utterance
+
+        A fast path of `parse(beam_size=1)` for low-latency serving. The single hypothesis
+        is expanded in place without beam bookkeeping: decoder states are kept in tensors,
+        the frontier is tracked incrementally, and the AST is only built once decoding
+        finishes. The result is the same as `parse(src_sent, beam_size=1)`.
+
+        Args:
+            src_sent: list of source utterance tokens
+            context: other context used for prediction
+            debug: record debug information in `ActionInfo`
+
+        Returns:
+            A list of at most one `DecodeHypothesis`
+        """
+
+        args = self.args
+        primitive_vocab = self.vocab.primitive
+        T = torch.cuda if args.cuda else torch
+
+        src_sent_var = nn_utils.to_input_variable([src_sent], self.vocab.source, cuda=args.cuda, training=False)
+
+        # Variable(1, src_sent_len, hidden_size * 2)
+        src_encodings, (last_state, last_cell) = self.encode(src_sent_var, [len(src_sent)])
+        # (1, src_sent_len, hidden_size)
+        src_encodings_att_linear = self.att_src_linear(src_encodings)
+
+        dec_init_vec = self.init_decoder_state(last_state, last_cell)
+        if args.lstm == 'parent_feed':
+            h_tm1 = dec_init_vec[0], dec_init_vec[1], \
+                    Variable(self.new_tensor(1, args.hidden_size).zero_()), \
+                    Variable(self.new_tensor(1, args.hidden_size).zero_())
+        else:
+            h_tm1 = dec_init_vec
+
+        aggregated_primitive_tokens = OrderedDict()
+        for token_pos, token in enumerate(src_sent):
+            aggregated_primitive_tokens.setdefault(token, []).append(token_pos)
+
+        if args.no_copy is False:
+            # same marginalization of copy probabilities as in `parse_batch()`
+            src_unk_tokens = [token for token in aggregated_primitive_tokens if token not in primitive_vocab]
+            src_unk_slot_ids = {token: slot_id for slot_id, token in enumerate(src_unk_tokens)}
+            src_token_primitive_ids = [0] * len(src_sent)
+            src_token_in_vocab_mask = [0.] * len(src_sent)
+            src_token_unk_slot_mask = [[0.] * max(len(src_unk_tokens), 1) for _ in range(len(src_sent))]
+            for token_pos, token in enumerate(src_sent):
+                if token in src_unk_slot_ids:
+                    src_token_unk_slot_mask[token_pos][src_unk_slot_ids[token]] = 1.
+                else:
+                    src_token_primitive_ids[token_pos] = primitive_vocab[token]
+                    src_token_in_vocab_mask[token_pos] = 1.
+
+            # (1, src_sent_len)
+            src_token_primitive_ids = Variable(self.new_long_tensor([src_token_primitive_ids]))
+            src_token_in_vocab_mask = Variable(self.new_tensor([src_token_in_vocab_mask]))
+            # (1, src_sent_len, max_unk_num)
+            src_token_unk_slot_mask = Variable(self.new_tensor([src_token_unk_slot_mask]))
+
+        if args.no_parent_state is False:
+            # (decode_max_time_step, hidden_size)
+            history_states = Variable(self.new_tensor(args.decode_max_time_step, args.hidden_size).zero_())
+            history_cells = Variable(self.new_tensor(args.decode_max_time_step, args.hidden_size).zero_())
+
+        production_mask = self.get_production_mask()
+        hyp = PersistentDecodeHypothesis()
+
+        for t in range(args.decode_max_time_step):
+            if t == 0:
+                with torch.no_grad():
+                    x = Variable(self.new_tensor(1, self.decoder_lstm.input_size).zero_())
+                if args.no_parent_field_type_embed is False:
+                    offset = args.action_embed_size  # prev_action
+                    offset += args.att_vec_size * (not args.no_input_feed)
+                    offset += args.action_embed_size * (not args.no_parent_production_embed)
+                    offset += args.field_embed_size * (not args.no_parent_field_embed)
+
+                    x[:, offset: offset + args.type_embed_size] = \
+                        self.type_embed.weight[self.grammar.root_type.id]
+            else:
+                a_tm1 = hyp.action_info.action
+                if isinstance(a_tm1, ApplyRuleAction):
+                    a_tm1_embed = self.production_embed.weight[a_tm1.production.id]
+                elif isinstance(a_tm1, ReduceAction):
+                    a_tm1_embed = self.production_embed.weight[len(self.grammar)]
+                else:
+                    a_tm1_embed = self.primitive_embed.weight[self.vocab.primitive[a_tm1.token]]
+
+                inputs = [a_tm1_embed.unsqueeze(0)]
+                if args.no_input_feed is False:
+                    inputs.append(att_tm1)
+                if args.no_parent_production_embed is False:
+                    inputs.append(self.production_embed(Variable(self.new_long_tensor(
+                        [hyp.frontier_node.production.id]))))
+                if args.no_parent_field_embed is False:
+                    inputs.append(self.field_embed(Variable(self.new_long_tensor(
+                        [hyp.frontier_field.field.id]))))
+                if args.no_parent_field_type_embed is False:
+                    inputs.append(self.type_embed(Variable(self.new_long_tensor(
+                        [hyp.frontier_field.type.id]))))
+
+                # parent states
+                if args.no_parent_state is False:
+                    p_t = hyp.frontier_node.created_time
+                    parent_states = history_states[p_t].unsqueeze(0)
+                    parent_cells = history_cells[p_t].unsqueeze(0)
+
+                    if args.lstm == 'parent_feed':
+                        h_tm1 = (h_tm1[0], h_tm1[1], parent_states, parent_cells)
+                    else:
+                        inputs.append(parent_states)
+
+                x = torch.cat(inputs, dim=-1)
+
+            (h_t, cell_t), att_t = self.step(x, h_tm1, src_encodings, src_encodings_att_linear, src_token_mask=None)
+
+            # Variable(1, grammar_size)
+            apply_rule_log_prob = F.log_softmax(self.production_readout(att_t), dim=-1)
+
+            # Variable(1, primitive_vocab_size)
+            gen_from_vocab_prob = F.softmax(self.tgt_token_readout(att_t), dim=-1)
+
+            if args.no_copy:
+                primitive_prob = gen_from_vocab_prob
+            else:
+                # Variable(1, src_sent_len)
+                primitive_copy_prob = self.src_pointer_net(src_encodings, None, att_t.unsqueeze(0)).squeeze(0)
+
+                # Variable(1, 2)
+                primitive_predictor_prob = F.softmax(self.primitive_predictor(att_t), dim=-1)
+
+                # Variable(1, primitive_vocab_size)
+                primitive_prob = primitive_predictor_prob[:, 0].unsqueeze(1) * gen_from_vocab_prob
+                gated_copy_prob = primitive_predictor_prob[:, 1].unsqueeze(1) * primitive_copy_prob
+                primitive_prob.scatter_add_(1, src_token_primitive_ids, gated_copy_prob * src_token_in_vocab_mask)
+
+                if src_unk_tokens:
+                    unk_copy_prob = torch.bmm(gated_copy_prob.unsqueeze(1), src_token_unk_slot_mask).squeeze(1)
+                    best_unk_copy_prob, best_unk_slot_id = torch.max(unk_copy_prob, dim=1)
+                    primitive_prob[:, primitive_vocab.unk_id] = best_unk_copy_prob
+
+            action_types = self.transition_system.get_valid_continuation_types(hyp)
+            frontier_type = hyp.frontier_field.type if t > 0 else self.grammar.root_type
+
+            # Variable(1, len(grammar) + 1)
+            applyrule_mask = production_mask[frontier_type.id].unsqueeze(0).clone()
+            applyrule_mask[:, len(self.grammar)] = 1. if ReduceAction in action_types else 0.
+            new_hyp_scores = [apply_rule_log_prob.masked_fill(applyrule_mask == 0, -float('inf'))]
+            if GenTokenAction in action_types:
+                new_hyp_scores.append(torch.log(primitive_prob))
+            else:
+                new_hyp_scores.append(Variable(self.new_tensor(primitive_prob.size()).fill_(-float('inf'))))
+            # Variable(1, len(grammar) + 1 + primitive_vocab_size)
+            new_hyp_scores = Variable(self.new_tensor([hyp.score])).unsqueeze(1) + torch.cat(new_hyp_scores, dim=-1)
+
+            new_hyp_score, action_pos = torch.max(new_hyp_scores, dim=1)
+            new_hyp_score = new_hyp_score.data.item()
+            action_pos = action_pos.data.item()
+
+            action_info = ActionInfo()
+            if action_pos < len(self.grammar):
+                action = ApplyRuleAction(self.grammar.id2prod[action_pos])
+            elif action_pos == len(self.grammar):
+                action = ReduceAction()
+            else:
+                token_id = action_pos - len(self.grammar) - 1
+                if token_id == primitive_vocab.unk_id:
+                    if args.no_copy is False and src_unk_tokens:
+                        token = src_unk_tokens[best_unk_slot_id.data.item()]
+                    else:
+                        token = primitive_vocab.id2word[primitive_vocab.unk_id]
+                else:
+                    token = primitive_vocab.id2word[token_id]
+
+                action = GenTokenAction(token)
+
+                if token in aggregated_primitive_tokens:
+                    action_info.copy_from_src = True
+                    action_info.src_token_position = aggregated_primitive_tokens[token]
+
+                if debug:
+                    action_info.gen_copy_switch = 'n/a' if args.no_copy else primitive_predictor_prob[0, :].log().cpu().data.numpy()
+                    action_info.in_vocab = token in primitive_vocab
+                    action_info.gen_token_prob = gen_from_vocab_prob[0, token_id].log().cpu().data.item() \
+                        if token in primitive_vocab else 'n/a'
+                    action_info.copy_token_prob = torch.gather(primitive_copy_prob[0],
+                                                               0,
+                                                               Variable(T.LongTensor(action_info.src_token_position))).sum().log().cpu().data.item() \
+                        if args.no_copy is False and action_info.copy_from_src else 'n/a'
+
+            action_info.action = action
+            action_info.t = t
+            if t > 0:
+                action_info.parent_t = hyp.frontier_node.created_time
+                action_info.frontier_prod = hyp.frontier_node.production
+                action_info.frontier_field = hyp.frontier_field.field
+
+            if debug:
+                action_info.action_prob = new_hyp_score - hyp.score
+
+            hyp = hyp.clone_and_apply_action_info(action_info)
+            hyp.score = new_hyp_score
+
+            if hyp.completed:
+                # add length normalization
+                hyp.score /= (t+1)
+                return [hyp.to_decode_hypothesis()]
+
+            if args.no_parent_state is False:
+                history_states[t] = h_t[0]
+                history_cells[t] = cell_t[0]
+            h_tm1 = (h_t, cell_t)
+            att_tm1 = att_t
+
+        return []
+
     def save(self, path):
         dir_name = os.path.dirname(path)
         if not os.path.exists(dir_name):
@@ -800,7 +1360,10 @@ class Parser(nn.Module):
         torch.save(params, path)
 
     @classmethod
-    def load(cls, model_path, cuda=False):
+    def load(cls, model_path, cuda=False, quantize=None):
+        if quantize:
+            assert not cuda, 'quantized models only run on CPU'
+            nn_utils.check_quantize_supported(quantize)
         params = torch.load(model_path, map_location=lambda storage, loc: storage)
         vocab = params['vocab']
         transition_system = params['transition_system']
@@ -817,4 +1380,7 @@ class Parser(nn.Module):
         if cuda: parser = parser.cuda()
         parser.eval()
 
+        if quantize:
+            nn_utils.quantize_model(parser, quantize)
+
         return parser
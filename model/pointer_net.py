@@ -48,3 +48,26 @@ class PointerNet(nn.Module):
         ptr_weights = F.softmax(weights, dim=-1)
 
         return ptr_weights
+
+    def packed_forward(self, src_encodings, src_token_mask, query_vec, example_ids):
+        """
+        :param src_encodings: Variable(batch_size, src_sent_len, hidden_size * 2)
+        :param src_token_mask: Variable(batch_size, src_sent_len)
+        :param query_vec: Variable(packed_action_num, query_vec_size)
+        :param example_ids: Variable(packed_action_num), the example of each query vector
+        :return: Variable(packed_action_num, src_sent_len)
+        """
+
+        # (batch_size, src_sent_len, query_vec_size)
+        if self.attention_type == 'affine':
+            src_encodings = self.src_encoding_linear(src_encodings)
+
+        # (packed_action_num, src_sent_len)
+        weights = torch.bmm(src_encodings[example_ids], query_vec.unsqueeze(2)).squeeze(2)
+
+        if src_token_mask is not None:
+            weights.data.masked_fill_(src_token_mask[example_ids], -float('inf'))
+
+        ptr_weights = F.softmax(weights, dim=-1)
+
+        return ptr_weights
@@ -157,7 +157,10 @@ class Reconstructor(nn.Module, RerankingFeature, Savable):
         torch.save(params, path)
 
     @staticmethod
-    def load(model_path, cuda=False):
+    def load(model_path, cuda=False, quantize=None):
+        if quantize:
+            assert not cuda, 'quantized models only run on CPU'
+            nn_utils.check_quantize_supported(quantize)
         decoder_params = torch.load(model_path, map_location=lambda storage, loc: storage)
         decoder_params['args'].cuda = cuda
 
@@ -167,4 +170,7 @@ class Reconstructor(nn.Module, RerankingFeature, Savable):
         if cuda: model = model.cuda()
         model.eval()
 
+        if quantize:
+            nn_utils.quantize_model(model, quantize)
+
         return model
@@ -91,7 +91,7 @@ class StructVAE(nn.Module):
         was_training = self.encoder.training
         self.encoder.eval()
 
-        hypotheses = [self.encoder.parse(e.src_sent, beam_size=self.args.sample_size) for e in examples]
+        hypotheses = self.encoder.parse_batch([e.src_sent for e in examples], beam_size=self.args.sample_size)
 
         if len(hypotheses) == 0:
             raise ValueError('No candidate hypotheses.')
@@ -46,8 +46,8 @@ def parse(dataset):
         print('------------------ Hypothesis %d ------------------' % hyp_id)
         print(hyp.code)
         print(hyp.tree.to_string())
-        print(hyp.score.item())
-        print(hyp.rerank_score.item())
+        print(float(hyp.score))
+        print(float(hyp.rerank_score))
 
         # print('Actions:')
         # for action_t in hyp.action_infos:
@@ -58,7 +58,7 @@ def parse(dataset):
         hyp_entry = dict(id=hyp_id + 1,
                          value=hyp.code,
                          tree_repr=hyp.tree.to_string(),
-                         score=hyp.rerank_score.item() if hasattr(hyp, 'rerank_score') else hyp.score.item(),
+                         score=float(hyp.rerank_score) if hasattr(hyp, 'rerank_score') else float(hyp.score),
                          actions=actions_repr)
 
         responses['hypotheses'].append(hyp_entry)
@@ -66,6 +66,11 @@ def parse(dataset):
     return jsonify(responses)
 
 
+@app.route('/cache_stats/<dataset>', methods=['GET'])
+def cache_stats(dataset):
+    return jsonify(parsers[dataset].cache_stats)
+
+
 
 if __name__ == '__main__':
     args = init_arg_parser().parse_args()
@@ -77,7 +82,12 @@ if __name__ == '__main__':
                                   example_processor_name=config['example_processor'],
                                   beam_size=config['beam_size'],
                                   reranker_path=config['reranker_path'],
-                                  cuda=args.cuda)
+                                  cuda=args.cuda,
+                                  early_stop_k=config.get('early_stop_k', 0),
+                                  early_stop_heuristic=config.get('early_stop_heuristic', False),
+                                  beam_margin=config.get('beam_margin'),
+                                  cache_size=config.get('cache_size', 1024),
+                                  quantize=config.get('quantize'))
 
         parsers[parser_id] = parser
 
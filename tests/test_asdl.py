@@ -0,0 +1,303 @@
+# coding=utf-8
+import ast
+import importlib
+import inspect
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+
+from asdl.asdl import ASDLGrammar, ASDLCompositeType
+from asdl.flat_ast import FlatAST
+from asdl.hypothesis import Hypothesis
+from components.action_info import ActionInfo, get_action_infos, get_action_infos_from_ast
+from components.decode_hypothesis import PersistentDecodeHypothesis
+from asdl.lang.py3.py3_transition_system import Python3TransitionSystem, python_ast_to_asdl_ast
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PY_GRAMMAR = os.path.join(ROOT, 'asdl/lang/py/py_asdl.txt')
+PY3_GRAMMAR = os.path.join(ROOT, 'asdl/lang/py3/py3_asdl.simplified.txt')
+
+STDLIB_MODULES = ['collections', 'json.decoder', 'string', 'textwrap']
+
+
+def load_stdlib_trees(grammar, max_size=100):
+    """the ASTs of the top-level statements and function definitions of a few standard library modules,
+    up to `max_size` nodes to keep the quadratic search of `Hypothesis.update_frontier_info` fast"""
+    trees = []
+    for module_name in STDLIB_MODULES:
+        module = ast.parse(inspect.getsource(importlib.import_module(module_name)))
+        stmts = module.body + [node for node in ast.walk(module)
+                               if isinstance(node, ast.FunctionDef) and node not in module.body]
+        for stmt in stmts:
+            try:
+                tree = python_ast_to_asdl_ast(ast.Module(body=[stmt]), grammar)
+            except KeyError:
+                # syntax not covered by the grammar, e.g. f-strings
+                continue
+
+            if tree.size <= max_size:
+                trees.append(tree)
+
+    return trees
+
+
+def run_python(code):
+    """run `code` in a fresh process, where no grammar is loaded"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + [env['PYTHONPATH']] if env.get('PYTHONPATH') else [ROOT])
+    return subprocess.check_output([sys.executable, '-c', textwrap.dedent(code)], cwd=ROOT, env=env).decode('utf-8')
+
+
+class SchemaNamespaceTest(unittest.TestCase):
+    def test_unpickle_resolves_to_own_grammar(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            prod_file = os.path.join(tmp_dir, 'prod.pkl')
+            # pickled where only its grammar is loaded
+            run_python('''
+                import pickle
+                from asdl.asdl import ASDLGrammar
+                grammar = ASDLGrammar.from_text(open(%r).read())
+                pickle.dump(grammar.get_prod_by_ctr_name('Call'), open(%r, 'wb'))
+            ''' % (PY3_GRAMMAR, prod_file))
+
+            # unpickled after loading another grammar first, which gives other ids to shared objects
+            output = run_python('''
+                import pickle
+                from asdl.asdl import ASDLGrammar
+                py_grammar = ASDLGrammar.from_text(open(%r).read())
+                py3_grammar = ASDLGrammar.from_text(open(%r).read())
+                prod = pickle.load(open(%r, 'rb'))
+                py3_prod = py3_grammar.get_prod_by_ctr_name('Call')
+                assert prod is py3_prod and prod.id == py3_grammar.prod2id[py3_prod], (prod.id, py3_prod.id)
+                assert prod != py_grammar.get_prod_by_ctr_name('Call')
+                print('ok')
+            ''' % (PY_GRAMMAR, PY3_GRAMMAR, prod_file))
+
+        self.assertEqual(output.strip(), 'ok')
+
+    def test_legacy_dataset_resolved_to_grammar(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dataset_file = os.path.join(tmp_dir, 'dataset.bin')
+            # schema objects and actions pickled as objects with a `__dict__`, before interning
+            run_python('''
+                import ast, copyreg, pickle
+                from asdl.asdl import ASDLGrammar, SchemaObject
+                from asdl.lang.py3.py3_transition_system import Python3TransitionSystem, python_ast_to_asdl_ast
+                from asdl.transition_system import ApplyRuleAction
+                from components.action_info import get_action_infos
+                from components.dataset import Example
+                SchemaObject.__reduce__ = lambda self: (copyreg.__newobj__, (self.__class__,),
+                                                        {name: getattr(self, name) for name in self._arg_names})
+                ApplyRuleAction.__reduce__ = lambda self: (copyreg.__newobj__, (ApplyRuleAction,),
+                                                           {'production': self.production})
+                grammar = ASDLGrammar.from_text(open(%r).read())
+                transition_system = Python3TransitionSystem(grammar)
+                tgt_ast = python_ast_to_asdl_ast(ast.parse('x = f(y, z.w)'), grammar)
+                tgt_actions = get_action_infos(['f'], transition_system.get_actions(tgt_ast))
+                example = Example(src_sent=['f'], tgt_actions=tgt_actions, tgt_code='x = f(y, z.w)', tgt_ast=tgt_ast)
+                pickle.dump([example], open(%r, 'wb'))
+            ''' % (PY3_GRAMMAR, dataset_file))
+
+            # resolved to the grammar it is loaded with, whatever other grammars are alive
+            output = run_python('''
+                from asdl.asdl import ASDLGrammar
+                from asdl.transition_system import ApplyRuleAction
+                from components.dataset import Dataset
+                py_grammar = ASDLGrammar.from_text(open(%r).read())
+                py_actions = [ApplyRuleAction(prod) for prod in py_grammar.productions]
+                py3_grammar = ASDLGrammar.from_text(open(%r).read())
+
+                example = Dataset.from_bin_file(%r).examples[0]
+                assert example.tgt_ast.production.id is None
+                assert example.tgt_ast.production == py3_grammar.get_prod_by_ctr_name('Module')
+
+                example = Dataset.from_bin_file(%r, py3_grammar).examples[0]
+                nodes = [example.tgt_ast]
+                while nodes:
+                    node = nodes.pop()
+                    assert node.production is py3_grammar.id2prod[node.production.id]
+                    for field in node.fields:
+                        assert field.field is py3_grammar.id2field[field.field.id]
+                        if py3_grammar.is_composite_type(field.type):
+                            nodes.extend(field.as_value_list)
+                for action_info in example.tgt_actions:
+                    if isinstance(action_info.action, ApplyRuleAction):
+                        assert action_info.action is ApplyRuleAction(py3_grammar.id2prod[action_info.action.production.id])
+                    if action_info.frontier_prod is not None:
+                        assert action_info.frontier_prod is py3_grammar.id2prod[action_info.frontier_prod.id]
+                        assert action_info.frontier_field is py3_grammar.id2field[action_info.frontier_field.id]
+                print('ok')
+            ''' % (PY_GRAMMAR, PY3_GRAMMAR, dataset_file, dataset_file))
+
+        self.assertEqual(output.strip(), 'ok')
+
+    def test_grammars_do_not_share_objects(self):
+        py_grammar = ASDLGrammar.from_text(open(PY_GRAMMAR).read())
+        py3_grammar = ASDLGrammar.from_text(open(PY3_GRAMMAR).read())
+
+        py3_expr = py3_grammar['expr'][0].type
+        py_expr = py_grammar['expr'][0].type
+        self.assertNotEqual(py_expr, py3_expr)
+        self.assertNotIn(py3_expr, py_grammar.type2id)
+        # types are looked up by name in a grammar
+        self.assertEqual(py_grammar[py3_expr], py_grammar['expr'])
+        self.assertEqual(py3_grammar[ASDLCompositeType('expr')], py3_grammar['expr'])
+
+        for grammar in (py_grammar, py3_grammar):
+            for objects, obj2id in ((grammar.productions, grammar.prod2id), (grammar.types, grammar.type2id),
+                                    (grammar.fields, grammar.field2id)):
+                self.assertTrue(all(obj.id == obj2id[obj] == i for i, obj in enumerate(objects)))
+
+    def test_free_standing_objects_match_every_grammar(self):
+        # constructed before and after the grammars, and not taken over by the first one
+        expr = ASDLCompositeType('expr')
+        py_grammar = ASDLGrammar.from_text(open(PY_GRAMMAR).read())
+        py3_grammar = ASDLGrammar.from_text(open(PY3_GRAMMAR).read())
+
+        for free_expr in (expr, ASDLCompositeType('expr')):
+            self.assertIsNone(free_expr.id)
+            for grammar in (py_grammar, py3_grammar):
+                grammar_expr = grammar['expr'][0].type
+                self.assertEqual(free_expr, grammar_expr)
+                self.assertEqual(hash(free_expr), hash(grammar_expr))
+                self.assertIn(free_expr, grammar.type2id)
+                self.assertEqual(grammar.type2id[free_expr], grammar_expr.id)
+                self.assertTrue(grammar.is_composite_type(free_expr))
+        self.assertNotEqual(ASDLCompositeType('expr'), ASDLCompositeType('stmt'))
+
+    def test_namespace_freed_with_grammar(self):
+        # flyweight actions do not keep the grammar alive
+        output = run_python('''
+            import ast, gc, weakref
+            from asdl.asdl import ASDLGrammar
+            from asdl.lang.py3.py3_transition_system import Python3TransitionSystem, python_ast_to_asdl_ast
+            from asdl.transition_system import ApplyRuleAction
+            grammar = ASDLGrammar.from_text(open(%r).read())
+            transition_system = Python3TransitionSystem(grammar)
+            actions = transition_system.get_actions(python_ast_to_asdl_ast(ast.parse('f(x)'), grammar))
+            assert ApplyRuleAction(actions[0].production) is actions[0]
+            namespace = weakref.ref(grammar.namespace)
+            del grammar, transition_system, actions
+            gc.collect()
+            assert namespace() is None
+            print('ok')
+        ''' % PY3_GRAMMAR)
+
+        self.assertEqual(output.strip(), 'ok')
+
+    def test_pickled_grammar(self):
+        grammar = ASDLGrammar.from_text(open(PY3_GRAMMAR).read())
+        unpickled = pickle.loads(pickle.dumps(grammar))
+
+        self.assertTrue(all(a is b for a, b in zip(grammar.productions, unpickled.productions)))
+
+
+class FrontierStackTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        grammar = ASDLGrammar.from_text(open(PY3_GRAMMAR).read())
+        cls.transition_system = Python3TransitionSystem(grammar)
+        cls.trees = load_stdlib_trees(grammar)
+
+    def assertSameFrontier(self, hyp, stack_hyp):
+        # nodes are identified by the time step of their creation
+        for h in (hyp, stack_hyp):
+            self.assertEqual(h.frontier_node is None, h.frontier_field is None)
+        if hyp.frontier_node is None:
+            self.assertIsNone(stack_hyp.frontier_node)
+        else:
+            self.assertEqual((hyp.frontier_node.production, hyp.frontier_node.created_time, hyp.frontier_field.field),
+                             (stack_hyp.frontier_node.production, stack_hyp.frontier_node.created_time,
+                              stack_hyp.frontier_field.field))
+        self.assertEqual(hyp.has_value_buffer, stack_hyp.has_value_buffer)
+        self.assertEqual(bool(hyp.completed), bool(stack_hyp.completed))
+
+    def test_frontier_stack_same_as_search(self):
+        self.assertTrue(self.trees)
+        for tree in self.trees:
+            hyp = Hypothesis()
+            stack_hyp = Hypothesis(use_frontier_stack=True)
+            # cloned hypotheses rebuild their stacks from their trees
+            cloned_stack_hyp = Hypothesis(use_frontier_stack=True)
+            persistent_hyp = PersistentDecodeHypothesis()
+            for action in self.transition_system.get_actions(tree):
+                hyp.apply_action(action)
+                stack_hyp.apply_action(action)
+                cloned_stack_hyp = cloned_stack_hyp.clone_and_apply_action(action)
+                persistent_hyp = persistent_hyp.clone_and_apply_action_info(ActionInfo(action))
+
+                self.assertSameFrontier(hyp, stack_hyp)
+                self.assertSameFrontier(hyp, cloned_stack_hyp)
+                self.assertSameFrontier(hyp, persistent_hyp)
+
+            self.assertTrue(stack_hyp.completed)
+            self.assertEqual(persistent_hyp.to_decode_hypothesis().tree, stack_hyp.tree)
+
+
+class ActionOracleTest(unittest.TestCase):
+    def test_action_infos_from_ast_same_as_replay(self):
+        grammar = ASDLGrammar.from_text(open(PY3_GRAMMAR).read())
+        transition_system = Python3TransitionSystem(grammar)
+        trees = load_stdlib_trees(grammar)
+
+        self.assertTrue(trees)
+        for tree in trees:
+            src_query = transition_system.tokenize_code(transition_system.ast_to_surface_code(tree))
+            actions = transition_system.get_actions(tree)
+            action_infos = get_action_infos(src_query, actions)
+            oracle_actions, oracle_action_infos = get_action_infos_from_ast(src_query, tree, transition_system)
+
+            # `GenTokenAction`s are compared by their tokens
+            self.assertEqual([repr(action) for action in oracle_actions], [repr(action) for action in actions])
+            for action_info, oracle_action_info in zip(action_infos, oracle_action_infos):
+                self.assertEqual(repr(oracle_action_info.action), repr(action_info.action))
+                for name in ('t', 'parent_t', 'frontier_prod', 'frontier_field', 'copy_from_src',
+                             'src_token_position'):
+                    self.assertEqual(getattr(oracle_action_info, name), getattr(action_info, name), name)
+
+
+class FlatASTTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.grammar = ASDLGrammar.from_text(open(PY3_GRAMMAR).read())
+        cls.transition_system = Python3TransitionSystem(cls.grammar)
+        cls.trees = load_stdlib_trees(cls.grammar)
+
+    def test_round_trip(self):
+        self.assertTrue(self.trees)
+        for tree in self.trees:
+            flat_tree = FlatAST.from_ast(tree)
+            self.assertEqual(flat_tree.to_ast(self.grammar), tree)
+            self.assertEqual(flat_tree.size, tree.size)
+            self.assertEqual(flat_tree, FlatAST.from_ast(tree.copy()))
+            self.assertEqual(pickle.loads(pickle.dumps(flat_tree)), flat_tree)
+
+            # `GenTokenAction`s are compared by their tokens
+            actions = self.transition_system.get_actions(tree)
+            self.assertEqual([repr(action) for action in flat_tree.to_actions(self.transition_system)],
+                             [repr(action) for action in actions])
+
+    def test_from_actions(self):
+        for tree in self.trees:
+            actions = self.transition_system.get_actions(tree)
+            hyp = Hypothesis(use_frontier_stack=True)
+            for action in actions:
+                hyp.apply_action(action)
+
+            self.assertEqual(FlatAST.from_actions(actions, self.grammar), FlatAST.from_ast(hyp.tree))
+
+    def test_from_actions_of_none_singleton(self):
+        tree = python_ast_to_asdl_ast(ast.parse('f(None)'), self.grammar)
+        flat_tree = FlatAST.from_actions(self.transition_system.get_actions(tree), self.grammar)
+
+        # the actions rebuild the None value as the token 'None'
+        self.assertNotEqual(flat_tree, FlatAST.from_ast(tree))
+        self.assertIn('None', flat_tree.tokens)
+
+
+if __name__ == '__main__':
+    unittest.main()
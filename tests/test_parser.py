@@ -0,0 +1,268 @@
+# coding=utf-8
+import ast
+import functools
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from asdl.asdl import ASDLGrammar
+from asdl.lang.py3.py3_transition_system import Python3TransitionSystem, python_ast_to_asdl_ast
+from common.utils import init_arg_parser
+from components.action_info import get_action_infos
+from components.dataset import Batch, Example
+from components.vocab import Vocab, VocabEntry
+from model import nn_utils
+from model.nn_utils import LabelSmoothing
+from model.parser import Parser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PY3_GRAMMAR = os.path.join(ROOT, 'asdl/lang/py3/py3_asdl.simplified.txt')
+
+SNIPPETS = [
+    'x = foo(bar, baz.qux)',
+    'for i in range(n):\n    print(i)',
+    'df.groupby(col).agg(func)',
+    'result = [x for x in items if x]',
+    'os.path.join(a, b)',
+    'with open(fname) as f:\n    data = f.read()',
+    'sorted(d.items(), key=operator.itemgetter)',
+    'if a and b:\n    c = d\nelse:\n    c = e',
+    'list(map(str, lst))',
+    'a, b = b, a',
+]
+
+
+def load_examples():
+    grammar = ASDLGrammar.from_text(open(PY3_GRAMMAR).read())
+    transition_system = Python3TransitionSystem(grammar)
+
+    examples = []
+    for idx, code in enumerate(SNIPPETS):
+        tgt_ast = python_ast_to_asdl_ast(ast.parse(code), grammar)
+        tgt_actions = transition_system.get_actions(tgt_ast)
+        src_sent = ['please'] + [token for token in transition_system.tokenize_code(code) if token.isidentifier()] + \
+                   ['now', 'id%d' % idx]
+        examples.append(Example(src_sent=src_sent, tgt_actions=get_action_infos(src_sent, tgt_actions),
+                                tgt_code=code, tgt_ast=tgt_ast, idx=idx))
+
+    vocab = Vocab(source=VocabEntry.from_corpus([e.src_sent for e in examples], size=1000, freq_cutoff=1),
+                  primitive=VocabEntry.from_corpus([[a.action.token for a in e.tgt_actions
+                                                     if hasattr(a.action, 'token')] for e in examples],
+                                                   size=1000, freq_cutoff=2),
+                  code=VocabEntry.from_corpus([transition_system.tokenize_code(e.tgt_code) for e in examples],
+                                              size=1000, freq_cutoff=1))
+
+    return transition_system, examples, vocab
+
+
+def init_parser(transition_system, vocab, *extra_args):
+    args = init_arg_parser().parse_args(['--mode', 'test', '--hidden_size', '32', '--embed_size', '16',
+                                         '--action_embed_size', '16', '--field_embed_size', '8',
+                                         '--type_embed_size', '8', '--att_vec_size', '32'] + list(extra_args))
+    torch.manual_seed(1)
+
+    return Parser(args, vocab, transition_system)
+
+
+def fit_parser(parser, examples, step_num=600):
+    """fit the snippets, so that the search finds them with confidence as a trained model would"""
+    optimizer = torch.optim.Adam(parser.parameters(), lr=0.01)
+    rng = np.random.RandomState(0)
+    parser.train()
+    for _ in range(step_num):
+        batch_examples = [examples[i] for i in rng.choice(len(examples), 8, replace=False)]
+        batch_examples.sort(key=lambda e: -len(e.src_sent))
+        optimizer.zero_grad()
+        loss = -parser.score(batch_examples)[0].mean()
+        loss.backward()
+        optimizer.step()
+    parser.eval()
+
+
+class HypothesesAssertions(object):
+    def assertSameHypotheses(self, hyps, other_hyps):
+        self.assertEqual(len(hyps), len(other_hyps))
+        for hyp, other_hyp in zip(hyps, other_hyps):
+            self.assertAlmostEqual(hyp.score, other_hyp.score, places=5)
+            # `GenTokenAction`s are compared by their tokens
+            self.assertEqual([repr(action) for action in hyp.actions],
+                             [repr(action) for action in other_hyp.actions])
+
+
+class BeamSearchTest(HypothesesAssertions, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        transition_system, cls.examples, vocab = load_examples()
+        # with parent states and input feeding, which are reordered along with the beam
+        cls.parser = init_parser(transition_system, vocab, '--decode_max_time_step', '40')
+        fit_parser(cls.parser, cls.examples, step_num=100)
+
+    def test_parse_batch_same_as_parse(self):
+        src_sents = [example.src_sent for example in self.examples]
+        with torch.no_grad():
+            for beam_size in (1, 5):
+                batch_hyps = self.parser.parse_batch(src_sents, beam_size=beam_size)
+                for src_sent, hyps in zip(src_sents, batch_hyps):
+                    self.assertTrue(hyps)
+                    self.assertSameHypotheses(hyps, self.parser.parse(src_sent, beam_size=beam_size))
+
+    def test_greedy_parse_same_as_beam_size_one(self):
+        # unseen utterances with out-of-vocabulary tokens as well
+        src_sents = [example.src_sent for example in self.examples] + \
+                    [example.src_sent[::-1] + ['unseen_token'] for example in self.examples]
+        with torch.no_grad():
+            for src_sent in src_sents:
+                hyps = self.parser.greedy_parse(src_sent)
+                beam_hyps = self.parser.parse(src_sent, beam_size=1)
+                self.assertSameHypotheses(hyps, beam_hyps)
+                for hyp, beam_hyp in zip(hyps, beam_hyps):
+                    self.assertEqual(hyp.tree, beam_hyp.tree)
+
+
+class BatchTest(unittest.TestCase):
+    def test_copies_are_only_checked_when_copying(self):
+        transition_system, examples, vocab = load_examples()
+        # action infos which do not mark the tokens found in the source as copies
+        for e in examples:
+            for action_info in e.tgt_actions:
+                action_info.copy_from_src = False
+                action_info.src_token_position = -1
+
+        batch = Batch(examples, transition_system.grammar, vocab, copy=False)
+        self.assertEqual(batch.primitive_copy_mask.data.sum().item(), 0)
+        with self.assertRaises(AssertionError):
+            Batch(examples, transition_system.grammar, vocab, copy=True)
+
+
+class ScoreTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.transition_system, examples, cls.vocab = load_examples()
+        # the encoder requires utterances sorted by their lengths in descending order
+        cls.examples = sorted(examples, key=lambda e: -len(e.src_sent))
+
+    def score_and_grads(self, parser, **args):
+        """per-example log-likelihoods and gradients of their sum, computed with the given options"""
+        for name, value in args.items():
+            setattr(parser.args, name, value)
+
+        parser.zero_grad()
+        scores = parser.score(self.examples)[0]
+        scores.sum().backward()
+        grads = {name: param.grad.clone() for name, param in parser.named_parameters() if param.grad is not None}
+
+        return scores.data, grads
+
+    def assertSameScores(self, parser, **args):
+        """compare `Parser.score` with the given options to the padded decoder and full softmax baseline"""
+        parser.train()
+        scores, grads = self.score_and_grads(parser, packed_decoder=False, lean_loss=False)
+        other_scores, other_grads = self.score_and_grads(parser, **args)
+
+        np.testing.assert_allclose(other_scores.numpy(), scores.numpy(), rtol=1e-4, atol=1e-4)
+        self.assertEqual(sorted(other_grads), sorted(grads))
+        for name, grad in grads.items():
+            np.testing.assert_allclose(other_grads[name].numpy(), grad.numpy(), rtol=1e-3, atol=1e-5, err_msg=name)
+
+    def test_packed_decoder(self):
+        for extra_args in ([], ['--no_copy'], ['--no_parent_state', '--no_input_feed']):
+            parser = init_parser(self.transition_system, self.vocab, *extra_args)
+            self.assertSameScores(parser, packed_decoder=True)
+
+    def test_lean_loss(self):
+        # chunks smaller than the batch, so that the log-likelihoods and gradients are computed over several
+        # checkpointed chunks
+        small_chunked_readout = functools.partial(nn_utils.chunked_readout, chunk_size=7)
+        with mock.patch.object(nn_utils, 'chunked_readout', small_chunked_readout):
+            for extra_args in ([], ['--no_copy'], ['--no_copy', '--primitive_token_label_smoothing', '0.1']):
+                parser = init_parser(self.transition_system, self.vocab, *extra_args)
+                self.assertSameScores(parser, lean_loss=True)
+                self.assertSameScores(parser, lean_loss=True, packed_decoder=True)
+
+    def test_label_smoothing_forward_logits(self):
+        label_smoothing = LabelSmoothing(0.1, 20, ignore_indices=[0, 1, 2])
+        logits = torch.randn(4, 6, 20)
+        target = torch.LongTensor(4, 6).random_(0, 20)
+
+        np.testing.assert_allclose(label_smoothing.forward_logits(logits, target).numpy(),
+                                   label_smoothing(F.log_softmax(logits, dim=-1), target).numpy(),
+                                   rtol=1e-4, atol=1e-5)
+
+
+class EarlyStopTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        transition_system, cls.examples, vocab = load_examples()
+        # a maximum length close to that of the snippets, which tightens the provable bound
+        cls.parser = init_parser(transition_system, vocab, '--no_parent_state', '--no_input_feed',
+                                 '--decode_max_time_step', '30')
+        fit_parser(cls.parser, cls.examples)
+
+    def test_early_stop_keeps_top_k_hypotheses(self):
+        src_sents = [example.src_sent for example in self.examples]
+        with torch.no_grad():
+            batch_hyps = self.parser.parse_batch(src_sents, beam_size=5)
+            for early_stop_k in (1, 3):
+                stopped_num = 0
+                early_stop_batch_hyps = self.parser.parse_batch(src_sents, beam_size=5, early_stop_k=early_stop_k)
+                for hyps, early_stop_hyps in zip(batch_hyps, early_stop_batch_hyps):
+                    # the search stopped before completing `beam_size` hypotheses
+                    stopped_num += len(early_stop_hyps) < len(hyps)
+                    self.assertGreaterEqual(len(early_stop_hyps), min(early_stop_k, len(hyps)))
+                    for hyp, early_stop_hyp in zip(hyps[:early_stop_k], early_stop_hyps):
+                        self.assertEqual(early_stop_hyp.tree, hyp.tree)
+                        self.assertAlmostEqual(early_stop_hyp.score, hyp.score, places=5)
+
+                self.assertGreater(stopped_num, 0)
+
+    def test_early_stop_heuristic_keeps_top_hypothesis(self):
+        stopped_num = 0
+        with torch.no_grad():
+            for example in self.examples:
+                hyps = self.parser.parse(example.src_sent, beam_size=5)
+                early_stop_hyps = self.parser.parse(example.src_sent, beam_size=5, early_stop_k=1,
+                                                    early_stop_heuristic=True)
+
+                # the heuristic is lossy in general, the fitted snippets are found with confidence though
+                stopped_num += len(early_stop_hyps) < len(hyps)
+                self.assertEqual(early_stop_hyps[0].tree, hyps[0].tree)
+                self.assertAlmostEqual(early_stop_hyps[0].score, hyps[0].score, places=5)
+
+        self.assertGreater(stopped_num, 0)
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class QuantizeTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.transition_system, cls.examples, cls.vocab = load_examples()
+
+    @unittest.skipIf(nn_utils.quantize_supported(), 'quantization is supported by the installed torch')
+    def test_unsupported_torch_fails_before_loading(self):
+        # the model file is not read
+        with self.assertRaisesRegex(RuntimeError, 'needs a newer torch'):
+            Parser.load(os.path.join(ROOT, 'no_such_model.bin'), quantize='int8')
+
+    @unittest.skipUnless(nn_utils.quantize_supported(), 'quantization needs a newer torch than the installed one')
+    def test_quantized_parser_loads_and_decodes(self):
+        parser = init_parser(self.transition_system, self.vocab, '--decode_max_time_step', '40')
+        fit_parser(parser, self.examples, step_num=100)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model_path = os.path.join(tmp_dir, 'model.bin')
+            parser.save(model_path)
+            quantized_parser = Parser.load(model_path, quantize='int8')
+
+        self.assertTrue(any(isinstance(module, torch.nn.quantized.dynamic.LSTMCell)
+                            for module in quantized_parser.modules()))
+        with torch.no_grad():
+            for example in self.examples:
+                hyps = quantized_parser.parse(example.src_sent, beam_size=5)
+                self.assertTrue(hyps)
+                self.assertTrue(all(hyp.completed for hyp in hyps))